@@ -0,0 +1,185 @@
+"""Replays recorded PPG files through the streaming beat detector and compares it with the offline one.
+
+Every recording is pushed in small blocks, as it would arrive from a live device, either as fast as
+possible or paced at a multiple of real time. The online beats are matched to the beats of
+rpeaks_from_ppg, and the detection rate, timing offset, latency and HR error are reported per file:
+
+    python -m benchmarks.replay_stream --ppg-data data/PPG_data --ppg-cache data/PPG_cache
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from functions.clearing_data.calc_r_peaks_from_ppg import calculate_hr, rpeaks_from_ppg
+from functions.clearing_data.ppg_cache import list_ppg_files, load_ppg_recording
+from functions.clearing_data.streaming_beats import StreamingBeatDetector
+
+
+def _nearest(sorted_values: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Returns, for every value, the position of the nearest element of a sorted array."""
+    right = np.clip(np.searchsorted(sorted_values, values), 1, len(sorted_values) - 1)
+    left = right - 1
+    return np.where(np.abs(sorted_values[right] - values) < np.abs(sorted_values[left] - values), right, left)
+
+
+def compare_beats(offline_peaks: np.ndarray, online: dict, sample_rate: float, tolerance: float = 0.1) -> dict:
+    """Matches the online beats to the offline R-peaks and summarizes the differences.
+
+    Args:
+        offline_peaks (np.ndarray): Sample indices of the offline R-peaks.
+        online (dict): Concatenated beats of ``StreamingBeatDetector.push``.
+        sample_rate (float): Sample rate of the recording in Hz.
+        tolerance (float): Largest time difference in seconds of a matched pair of beats.
+
+    Returns:
+        dict: Beat counts, the share of offline beats found ("sensitivity") and of online beats that
+        are real ("precision"), the median offset of the online beats in ms, the end-to-end latency
+        from the offline peak to the detection in ms, and the mean absolute HR error of intervals
+        whose two beats were both matched.
+    """
+    online_peaks = online["r_peak_index"]
+    result = {"offline_beats": len(offline_peaks), "online_beats": len(online_peaks)}
+    if len(offline_peaks) < 2 or len(online_peaks) == 0:
+        return result
+
+    # One-to-one pairs: the online beat nearest to an offline beat, and the other way around
+    nearest_online = _nearest(online_peaks, offline_peaks)
+    nearest_offline = _nearest(offline_peaks, online_peaks)
+    offline_index = np.flatnonzero(nearest_offline[nearest_online] == np.arange(len(offline_peaks)))
+    online_index = nearest_online[offline_index]
+    offsets = (online_peaks[online_index] - offline_peaks[offline_index]) / sample_rate
+    close = np.abs(offsets) <= tolerance
+    offline_index, online_index, offsets = offline_index[close], online_index[close], offsets[close]
+
+    detected_at = online_peaks + online["latency"] * sample_rate
+    latency = (detected_at[online_index] - offline_peaks[offline_index]) / sample_rate
+
+    # Intervals between consecutive offline beats that match consecutive online beats
+    _, offline_hr, _ = calculate_hr(offline_peaks, sample_rate)
+    consecutive = (np.diff(offline_index) == 1) & (np.diff(online_index) == 1)
+    hr_error = np.abs(online["HR"][online_index[1:][consecutive]] - offline_hr[offline_index[:-1][consecutive]])
+
+    result.update(
+        {
+            "matched_beats": len(offline_index),
+            "sensitivity": len(offline_index) / len(offline_peaks),
+            "precision": len(online_index) / len(online_peaks),
+            "offset_ms": float(np.median(offsets) * 1000) if len(offsets) else np.nan,
+            "latency_median_ms": float(np.median(latency) * 1000) if len(latency) else np.nan,
+            "latency_p95_ms": float(np.percentile(latency, 95) * 1000) if len(latency) else np.nan,
+            "latency_max_ms": float(latency.max() * 1000) if len(latency) else np.nan,
+            "hr_error_bpm": float(hr_error.mean()) if len(hr_error) else np.nan,
+        }
+    )
+    return result
+
+
+def replay_recording(
+    PPG_data_path: str,
+    file_name: str,
+    cache_dir: str | None = None,
+    block_seconds: float = 0.25,
+    speed: float | None = None,
+    tolerance: float = 0.1,
+) -> dict:
+    """Streams one PPG recording through the online detector and compares it with the offline one.
+
+    Args:
+        PPG_data_path (str): Path to the folder containing PPG files.
+        file_name (str): Name of the PPG file.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        block_seconds (float): Length of every pushed block in seconds.
+        speed (float | None): Pace of the replay as a multiple of real time, e.g. 10. If None, the
+            blocks are pushed as fast as possible.
+        tolerance (float): Largest time difference in seconds of a matched pair of beats.
+
+    Returns:
+        dict: The file name, the recording length, how many times faster than real time the detector
+        ran, and the comparison of ``compare_beats``.
+    """
+    recording = load_ppg_recording(os.path.join(PPG_data_path, file_name), cache_dir)
+    ppg_signal, sample_rate = np.asarray(recording.signal, dtype=np.float64), recording.sample_rate
+
+    detector = StreamingBeatDetector(sample_rate, recording.start_time)
+    block_size = max(int(block_seconds * sample_rate), 1)
+    pushed = []
+    busy = 0.0
+    replay_start = time.perf_counter()
+    for block_start in range(0, len(ppg_signal), block_size):
+        if speed is not None:
+            # Wait until the block would have been recorded
+            due = replay_start + (block_start + block_size) / sample_rate / speed
+            time.sleep(max(due - time.perf_counter(), 0))
+        push_start = time.perf_counter()
+        pushed.append(detector.push(ppg_signal[block_start : block_start + block_size]))
+        busy += time.perf_counter() - push_start
+
+    online = {key: np.concatenate([beats[key] for beats in pushed]) for key in pushed[0]}
+    duration = len(ppg_signal) / sample_rate
+    return {
+        "file_name": file_name,
+        "duration_s": duration,
+        "realtime_factor": duration / busy if busy > 0 else np.inf,
+        **compare_beats(rpeaks_from_ppg(ppg_signal, sample_rate), online, sample_rate, tolerance),
+    }
+
+
+def replay_folder(
+    PPG_data_path: str,
+    cache_dir: str | None = None,
+    n_workers: int = 1,
+    block_seconds: float = 0.25,
+    speed: float | None = None,
+    tolerance: float = 0.1,
+) -> pd.DataFrame:
+    """Replays every PPG file of a folder, in parallel if requested.
+
+    Returns:
+        pd.DataFrame: One row per file with the results of ``replay_recording``.
+    """
+    file_names = list_ppg_files(PPG_data_path)
+    args = [[value] * len(file_names) for value in (PPG_data_path, cache_dir)]
+    options = [[value] * len(file_names) for value in (block_seconds, speed, tolerance)]
+    if n_workers > 1 and len(file_names) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(file_names))) as executor:
+            results = list(executor.map(replay_recording, args[0], file_names, args[1], *options))
+    else:
+        results = list(map(replay_recording, args[0], file_names, args[1], *options))
+    return pd.DataFrame(results)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ppg-data", default="data/PPG_data", help="folder with the PPG files")
+    parser.add_argument("--ppg-cache", help="binary cache of the PPG files")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes replaying files in parallel")
+    parser.add_argument("--block", type=float, default=0.25, help="length of every pushed block in seconds")
+    parser.add_argument("--speed", type=float, help="pace as a multiple of real time (default: as fast as possible)")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="largest offset of matched beats in seconds")
+    parser.add_argument("--output", help="CSV file of the per-file results")
+    args = parser.parse_args(argv)
+
+    results = replay_folder(args.ppg_data, args.ppg_cache, args.workers, args.block, args.speed, args.tolerance)
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    with pd.option_context("display.width", 160, "display.max_columns", None):
+        print(results.round(3).to_string(index=False))
+    beats = results["offline_beats"].sum()
+    found = results["matched_beats"].sum() / beats
+    print(
+        f"\n{len(results)} recordings, {beats} offline beats: {found:.1%} found online,"
+        f" median latency {results['latency_median_ms'].median():.0f} ms"
+        f" (worst file p95 {results['latency_p95_ms'].max():.0f} ms),"
+        f" {results['duration_s'].sum() / 3600:.1f} h of signal at"
+        f" {results['realtime_factor'].median():.0f}x real time."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""Times and memory-profiles the cleaning stages and the analyses on a synthetic cohort.
+
+Every run is appended to a JSON Lines history file and compared with the previous run on the same
+cohort, so regressions show up between commits:
+
+    python -m benchmarks.run_benchmarks --participants 10 --minutes 15
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+
+# Figures are only rendered, never shown
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+
+from benchmarks.synthetic_cohort import generate_cohort  # noqa: E402
+from functions.clearing_data.adding_ppg_to_trial_comb import match_ppg_data  # noqa: E402
+from functions.clearing_data.calc_r_peaks_from_ppg import process_ppg_folder  # noqa: E402
+from functions.clearing_data.is_to_excel import calculate_is  # noqa: E402
+from functions.clearing_data.ppg_cache import build_ppg_cache  # noqa: E402
+from functions.clearing_data.trial_combined import filter_to_new_excel  # noqa: E402
+from functions.data_analysis.Average_valence_scrore_to_IS import analyze_valence_vs_IS  # noqa: E402
+from functions.data_analysis.HB_by_music_type import plot_hr_by_music_type  # noqa: E402
+from functions.data_analysis.is_to_music_type import analyze_music_type_vs_IS  # noqa: E402
+from functions.data_analysis.music_type_to_rt import analyze_rt_by_music_type  # noqa: E402
+from functions.data_analysis.valence_rating_by_music_type import plot_valence_by_music_type  # noqa: E402
+from functions.pipeline.runner import run_pipeline  # noqa: E402
+
+BENCHMARK_DIR = Path(__file__).parent
+SELECTED_COLUMNS = ["session", "music_type", "valence_rating", "RT", "PPG_music_start", "PPG_response_start"]
+
+
+def _rebuild_ppg_cache(PPG_data_path: str, cache_dir: str, n_workers: int) -> None:
+    """Converts all PPG files into an empty binary cache, so every run measures the full conversion."""
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    build_ppg_cache(PPG_data_path, cache_dir, n_workers)
+
+
+def _run_pipeline_cold(
+    trial_data_path: str, PPG_data_path: str, HBD_data_path: str, pipeline_path: str, cache_dir: str, n_workers: int
+) -> None:
+    """Runs every stage of the pipeline into an empty folder, so no stored result is reused."""
+    shutil.rmtree(pipeline_path, ignore_errors=True)
+    os.makedirs(pipeline_path)
+    run_pipeline(trial_data_path, PPG_data_path, HBD_data_path, pipeline_path, SELECTED_COLUMNS, cache_dir, n_workers)
+
+
+def benchmark_steps(cohort_path: str, output_path: str, n_workers: int = 1) -> list[tuple]:
+    """Lists the benchmarked steps in pipeline order, as (name, function) pairs.
+
+    Every step reads the files written by the previous ones, like the file-based workflow of main.py.
+    The default configuration of a step is followed by its optimized ones, named after the options
+    they use: the binary PPG cache, the grouped PPG matching and the batch IS fits. The cleaning stages
+    are also run end to end with ``run_pipeline``, once from scratch and once more on the unchanged
+    cohort, where every stage reuses its stored results.
+    """
+    trial_data_path = os.path.join(cohort_path, "trial_data")
+    PPG_data_path = os.path.join(cohort_path, "PPG_data")
+    HBD_data_path = os.path.join(cohort_path, "HBD_data")
+    cache_dir = os.path.join(output_path, "PPG_cache")
+    combined_data_file = os.path.join(output_path, "combined_data_trial.xlsx")
+    R_peak_data_path = os.path.join(output_path, "R-peaks_and_HR.xlsx")
+    pipeline_path = os.path.join(output_path, "pipeline")
+
+    return [
+        # filter_to_new_excel takes the output folder and writes combined_data_trial.xlsx into it
+        ("filter_to_new_excel", lambda: filter_to_new_excel(trial_data_path, SELECTED_COLUMNS, output_path)),
+        ("build_ppg_cache", lambda: _rebuild_ppg_cache(PPG_data_path, cache_dir, n_workers)),
+        ("match_ppg_data", lambda: match_ppg_data(combined_data_file, PPG_data_path)),
+        (
+            "match_ppg_data[grouped,cache]",
+            lambda: match_ppg_data(combined_data_file, PPG_data_path, cache_dir=cache_dir, grouped=True),
+        ),
+        ("process_ppg_folder", lambda: process_ppg_folder(PPG_data_path, output_path, n_workers=n_workers)),
+        (
+            "process_ppg_folder[cache]",
+            lambda: process_ppg_folder(PPG_data_path, output_path, cache_dir=cache_dir, n_workers=n_workers),
+        ),
+        ("calculate_is", lambda: calculate_is(HBD_data_path, combined_data_file)),
+        (
+            "calculate_is[batch]",
+            lambda: calculate_is(HBD_data_path, combined_data_file, batch=True, n_workers=n_workers),
+        ),
+        (
+            "run_pipeline",
+            lambda: _run_pipeline_cold(
+                trial_data_path, PPG_data_path, HBD_data_path, pipeline_path, cache_dir, n_workers
+            ),
+        ),
+        (
+            "run_pipeline[unchanged]",
+            lambda: run_pipeline(
+                trial_data_path, PPG_data_path, HBD_data_path, pipeline_path, SELECTED_COLUMNS, cache_dir, n_workers
+            ),
+        ),
+        ("plot_valence_by_music_type", lambda: plot_valence_by_music_type(combined_data_file)),
+        ("plot_hr_by_music_type", lambda: plot_hr_by_music_type(R_peak_data_path, combined_data_file)),
+        ("analyze_music_type_vs_IS", lambda: analyze_music_type_vs_IS(combined_data_file)),
+        ("analyze_rt_by_music_type", lambda: analyze_rt_by_music_type(combined_data_file)),
+        ("analyze_valence_vs_IS", lambda: analyze_valence_vs_IS(combined_data_file)),
+    ]
+
+
+def _run_quietly(step) -> None:
+    """Runs a step without its console output, warnings and figures."""
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        step()
+    plt.close("all")
+
+
+def measure_step(step, repeat: int = 1, track_memory: bool = True) -> dict:
+    """Measures the wall time, CPU time and peak Python memory of one step.
+
+    The times are the best of ``repeat`` runs. The peak memory is measured in one extra run, since
+    tracing the allocations slows the step down. Memory allocated in worker processes is not seen.
+
+    Returns:
+        dict: "wall_s", "cpu_s" and, if tracked, "peak_mib".
+    """
+    wall_times, cpu_times = [], []
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        _run_quietly(step)
+        wall_times.append(time.perf_counter() - wall_start)
+        cpu_times.append(time.process_time() - cpu_start)
+
+    result = {"wall_s": round(min(wall_times), 4), "cpu_s": round(min(cpu_times), 4)}
+    if track_memory:
+        tracemalloc.start()
+        try:
+            _run_quietly(step)
+            result["peak_mib"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def prepare_cohort(work_path: str, n_participants: int, session_minutes: float, seed: int, n_workers: int = 1) -> Path:
+    """Returns the folder of the requested synthetic cohort, generating it on first use."""
+    cohort_path = Path(work_path) / f"cohort-{n_participants}p-{session_minutes:g}min-seed{seed}"
+    marker_path = cohort_path / "cohort.json"
+    if not marker_path.exists():
+        print(f"Generating {n_participants} synthetic participants in {cohort_path} ...")
+        cohort = generate_cohort(cohort_path, n_participants, session_minutes, seed=seed, n_workers=n_workers)
+        marker_path.write_text(json.dumps(cohort))
+    return cohort_path
+
+
+def _git_commit() -> str | None:
+    """Returns the current commit of the repository, if available."""
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True
+        )
+        return output.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_path: str) -> list[dict]:
+    """Reads the previous benchmark runs from the JSON Lines history file."""
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(history_path: str, run: dict) -> None:
+    """Appends one benchmark run to the JSON Lines history file."""
+    os.makedirs(os.path.dirname(os.path.abspath(history_path)), exist_ok=True)
+    with open(history_path, "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+def compare_runs(previous: dict, current: dict, tolerance: float = 0.2) -> list[str]:
+    """Lists the steps whose wall time or peak memory grew by more than ``tolerance`` since ``previous``.
+
+    Args:
+        previous (dict): An earlier run on the same cohort.
+        current (dict): The new run.
+        tolerance (float): Allowed relative growth, e.g. 0.2 for 20 %.
+
+    Returns:
+        list[str]: One message per regression.
+    """
+    regressions = []
+    for step, metrics in current["steps"].items():
+        previous_metrics = previous["steps"].get(step, {})
+        for metric in ("wall_s", "peak_mib"):
+            before, after = previous_metrics.get(metric), metrics.get(metric)
+            # Ignore changes below the timer and allocator noise
+            if before is None or after is None or max(before, after) < 0.01:
+                continue
+            if after > before * (1 + tolerance):
+                regressions.append(
+                    f"{step}: {metric} went from {before} to {after} (+{(after / before - 1) * 100:.0f}%)"
+                    f" since {previous.get('commit') or previous['timestamp']}."
+                )
+    return regressions
+
+
+def run_benchmarks(
+    n_participants: int = 10,
+    session_minutes: float = 15.0,
+    seed: int = 0,
+    repeat: int = 1,
+    track_memory: bool = True,
+    n_workers: int = 1,
+    work_path: str | None = None,
+    history_path: str | None = None,
+    tolerance: float = 0.2,
+) -> dict:
+    """Benchmarks every step on a synthetic cohort, stores the run and reports regressions.
+
+    Args:
+        n_participants (int): Number of synthetic participants.
+        session_minutes (float): Length of every PPG recording in minutes.
+        seed (int): Seed of the synthetic cohort.
+        repeat (int): Number of timed runs of every step; the best one is kept.
+        track_memory (bool): If True, the peak Python memory of every step is measured.
+        n_workers (int): Worker processes for generating the cohort, building the PPG cache,
+            process_ppg_folder and the batch IS fits.
+        work_path (str | None): Folder of the generated cohorts and outputs. Defaults to benchmarks/work.
+        history_path (str | None): JSON Lines file of all runs. Defaults to benchmarks/results/history.jsonl.
+        tolerance (float): Allowed relative growth before a step is reported as a regression.
+
+    Returns:
+        dict: The stored run.
+    """
+    work_path = Path(work_path) if work_path else BENCHMARK_DIR / "work"
+    history_path = history_path or BENCHMARK_DIR / "results" / "history.jsonl"
+
+    cohort_path = prepare_cohort(work_path, n_participants, session_minutes, seed, n_workers)
+    output_path = cohort_path / "output"
+    os.makedirs(output_path, exist_ok=True)
+
+    run = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cohort": json.loads((cohort_path / "cohort.json").read_text()),
+        "repeat": repeat,
+        "n_workers": n_workers,
+        "steps": {},
+    }
+    for name, step in benchmark_steps(str(cohort_path), str(output_path), n_workers):
+        run["steps"][name] = measure_step(step, repeat, track_memory)
+        memory = f", peak {run['steps'][name]['peak_mib']} MiB" if track_memory else ""
+        print(f"{name}: {run['steps'][name]['wall_s']:.3f} s wall, {run['steps'][name]['cpu_s']:.3f} s CPU{memory}")
+
+    previous_runs = [
+        previous
+        for previous in load_history(history_path)
+        if previous["cohort"] == run["cohort"] and previous.get("n_workers") == n_workers
+    ]
+    if previous_runs:
+        regressions = compare_runs(previous_runs[-1], run, tolerance)
+        print("\n".join(regressions) if regressions else "No regressions since the previous run.")
+    append_history(history_path, run)
+    return run
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--participants", type=int, default=10, help="number of synthetic participants")
+    parser.add_argument("--minutes", type=float, default=15.0, help="length of every PPG recording in minutes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic cohort")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per step, the best one is kept")
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory profiling runs")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the generation and steps")
+    parser.add_argument("--work-dir", help="folder of the generated cohorts (default: benchmarks/work)")
+    parser.add_argument("--history", help="JSON Lines history file (default: benchmarks/results/history.jsonl)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative growth reported as a regression")
+    args = parser.parse_args(argv)
+
+    run_benchmarks(
+        n_participants=args.participants,
+        session_minutes=args.minutes,
+        seed=args.seed,
+        repeat=args.repeat,
+        track_memory=not args.no_memory,
+        n_workers=args.workers,
+        work_path=args.work_dir,
+        history_path=args.history,
+        tolerance=args.tolerance,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+PPG_SAMPLE_RATE = 100
+MUSIC_TYPES = ["tonal", "atonal", "discord"]
+HBD_DELAYS = [0, 150, 300, 450]
+HBD_REPETITIONS = 6
+
+# Trial timing of the study, in seconds: music, response and inter-trial interval
+MUSIC_SECONDS = 29.47
+RESPONSE_SECONDS = 15.22
+ITI_SECONDS = 10.2
+SESSION_LEAD_SECONDS = 30
+
+# Mean HR change while each music type is playing, in bpm
+MUSIC_HR_EFFECT = {"tonal": 0.0, "atonal": 1.0, "discord": 2.0}
+
+
+def _trial_schedule(rng: np.random.Generator, session: int, ppg_start: float, session_seconds: float) -> pd.DataFrame:
+    """Creates the trials of one session, spread over the PPG recording in the timing of the study."""
+    trial_seconds = MUSIC_SECONDS + RESPONSE_SECONDS + ITI_SECONDS
+    n_trials = max(int((session_seconds - 2 * SESSION_LEAD_SECONDS) // trial_seconds), 1)
+
+    music_start = ppg_start + SESSION_LEAD_SECONDS + trial_seconds * np.arange(n_trials) + rng.uniform(0, 0.05, n_trials)
+    response_start = music_start + MUSIC_SECONDS + rng.normal(0, 0.005, n_trials)
+    iti_start = response_start + RESPONSE_SECONDS + rng.normal(0, 0.005, n_trials)
+
+    # Every music type is played equally often, in a random order per block of three trials
+    music_type = np.concatenate([rng.permutation(MUSIC_TYPES) for _ in range(-(-n_trials // 3))])[:n_trials]
+    valence_offset = np.where(music_type == "tonal", 0.2, 0.0)
+    fmri_offset = ppg_start + SESSION_LEAD_SECONDS - 14.0
+
+    return pd.DataFrame(
+        {
+            "session": session,
+            "music_type": music_type,
+            "valence_rating": np.clip(rng.normal(0.4 + valence_offset, 0.15), 0, 1).round(2),
+            "RT": rng.lognormal(np.log(4), 0.3, n_trials),
+            "PPG_music_start": music_start,
+            "PPG_response_start": response_start,
+            "PPG_ITI_start": iti_start,
+            "fMRI_music_start": music_start - fmri_offset,
+            "fMRI_response_start": response_start - fmri_offset,
+            "fMRI_ITI_start": iti_start - fmri_offset,
+        }
+    )
+
+
+def _beat_times(rng: np.random.Generator, trials: pd.DataFrame, ppg_start: float, session_seconds: float, hr: float):
+    """Draws the beat onsets of a recording with respiratory sinus arrhythmia and a HR response to the music."""
+    music_start = trials["PPG_music_start"].to_numpy()
+    response_start = trials["PPG_response_start"].to_numpy()
+    hr_effect = trials["music_type"].map(MUSIC_HR_EFFECT).to_numpy()
+
+    n_max = int(session_seconds * 200 / 60) + 2
+    beat_times = np.empty(n_max)
+    rr_intervals = np.empty(n_max)
+    beat_time = ppg_start + rng.uniform(0, 60 / hr)
+    n_beats = 0
+    while beat_time < ppg_start + session_seconds and n_beats < n_max:
+        trial = np.searchsorted(music_start, beat_time, side="right") - 1
+        in_music = trial >= 0 and beat_time < response_start[trial]
+        beat_hr = hr + (hr_effect[trial] if in_music else 0.0)
+
+        rr = 60 / beat_hr * (1 + 0.04 * np.sin(2 * np.pi * 0.25 * beat_time) + 0.02 * rng.standard_normal())
+        rr = float(np.clip(rr, 0.4, 1.4))
+        beat_times[n_beats] = beat_time
+        rr_intervals[n_beats] = rr
+        beat_time += rr
+        n_beats += 1
+
+    return beat_times[:n_beats], rr_intervals[:n_beats]
+
+
+def _pulse_wave(rng: np.random.Generator, time: np.ndarray, beat_times: np.ndarray, rr_intervals: np.ndarray):
+    """Renders a PPG signal from beat onsets: a systolic and a diastolic wave per beat, baseline wander and noise."""
+    beat = np.clip(np.searchsorted(beat_times, time, side="right") - 1, 0, len(beat_times) - 1)
+    phase = (time - beat_times[beat]) / rr_intervals[beat]
+    amplitude = rng.normal(1, 0.1, len(beat_times))[beat]
+
+    systolic = np.exp(-((phase - 0.2) ** 2) / (2 * 0.07**2))
+    diastolic = 0.4 * np.exp(-((phase - 0.5) ** 2) / (2 * 0.1**2))
+    baseline = 0.3 * np.sin(2 * np.pi * 0.05 * time + rng.uniform(0, 2 * np.pi)) + 0.1 * np.sin(2 * np.pi * 0.25 * time)
+    noise = rng.normal(0, 0.05, len(time))
+    return amplitude * (systolic + diastolic) + baseline + noise - 0.4
+
+
+def _hbd_responses(rng: np.random.Generator, resting_rri: float) -> pd.DataFrame:
+    """Simulates the Heartbeat Discrimination Test of one participant from a Gaussian sync curve."""
+    A, mu, sigma, b = rng.uniform(0.2, 0.8), rng.uniform(0.1, 0.4), rng.uniform(0.1, 0.2), 0.1
+    delays = rng.permutation(np.repeat(HBD_DELAYS, HBD_REPETITIONS))
+    normalized_delays = delays / (resting_rri * 1000)
+    p_sync = np.clip(A * np.exp(-((normalized_delays - mu) ** 2) / (2 * sigma**2)) + b, 0, 1)
+
+    resting_rris = np.full(len(delays), np.nan)
+    resting_rris[0] = resting_rri
+    return pd.DataFrame(
+        {
+            "delay": delays,
+            "response": np.where(rng.random(len(delays)) < p_sync, "Sync", "Async"),
+            "confidence": rng.integers(8, 17, len(delays)) * 5,
+            "resting_RRI": resting_rris,
+        }
+    )
+
+
+def generate_participant(
+    data_path: str, participant_id: int, session_minutes: float = 15.0, n_sessions: int = 2, seed: int = 0
+) -> None:
+    """Writes the trial, PPG and HBD files of one synthetic participant.
+
+    Args:
+        data_path (str): Folder containing the trial_data, PPG_data and HBD_data folders.
+        participant_id (int): ID used in the file names.
+        session_minutes (float): Length of the PPG recording of every session in minutes.
+        n_sessions (int): Number of sessions.
+        seed (int): Seed of the cohort; every participant gets its own stream derived from it.
+    """
+    rng = np.random.default_rng([seed, participant_id])
+    data_path = Path(data_path)
+    session_seconds = session_minutes * 60
+    hr = rng.uniform(55, 85)
+
+    trials = []
+    ppg_start = rng.uniform(1000, 1500)
+    for session in range(1, n_sessions + 1):
+        session_trials = _trial_schedule(rng, session, ppg_start, session_seconds)
+        beat_times, rr_intervals = _beat_times(rng, session_trials, ppg_start, session_seconds, hr)
+
+        time = ppg_start + np.arange(int(session_seconds * PPG_SAMPLE_RATE)) / PPG_SAMPLE_RATE
+        ppg_signal = _pulse_wave(rng, time, beat_times, rr_intervals)
+        pd.DataFrame({"PPG": ppg_signal, "time": time}).to_csv(
+            data_path / "PPG_data" / f"sub-{participant_id:02d}_sess{session}_PPG.csv", index=False, float_format="%.6f"
+        )
+
+        trials.append(session_trials)
+        ppg_start += session_seconds + rng.uniform(60, 180)
+
+    pd.concat(trials, ignore_index=True).to_csv(
+        data_path / "trial_data" / f"sub-{participant_id:02d}_trial_data.csv", index=False
+    )
+    _hbd_responses(rng, 60 / hr).to_csv(data_path / "HBD_data" / f"sub-{participant_id:02d}_HBD.csv", index=False)
+
+
+def generate_cohort(
+    data_path: str,
+    n_participants: int = 10,
+    session_minutes: float = 15.0,
+    n_sessions: int = 2,
+    seed: int = 0,
+    n_workers: int = 1,
+) -> dict:
+    """Writes a synthetic cohort in the layout of the data folder.
+
+    The trial data follows the timing of the study (one trial per ~55 s, music types balanced),
+    the PPG files are sampled at 100 Hz with realistic pulse waveforms, baseline wander and noise,
+    and the HBD files hold 24 responses drawn from a Gaussian sync curve. Participants are written
+    one at a time, so memory use does not grow with the cohort size, and the cohort only depends
+    on the seed, not on the number of workers.
+
+    Args:
+        data_path (str): Folder where the trial_data, PPG_data and HBD_data folders are created.
+        n_participants (int): Number of participants.
+        session_minutes (float): Length of the PPG recording of every session in minutes.
+        n_sessions (int): Number of sessions per participant.
+        seed (int): Seed of the random generator.
+        n_workers (int): Number of worker processes writing participants in parallel.
+
+    Returns:
+        dict: The parameters of the cohort.
+    """
+    for folder in ["trial_data", "PPG_data", "HBD_data"]:
+        os.makedirs(Path(data_path) / folder, exist_ok=True)
+
+    participant_ids = range(1, n_participants + 1)
+    arguments = [[data_path] * n_participants, participant_ids]
+    arguments += [[value] * n_participants for value in (session_minutes, n_sessions, seed)]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(generate_participant, *arguments))
+    else:
+        list(map(generate_participant, *arguments))
+
+    return {
+        "n_participants": n_participants,
+        "session_minutes": session_minutes,
+        "n_sessions": n_sessions,
+        "seed": seed,
+    }
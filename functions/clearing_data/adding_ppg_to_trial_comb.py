@@ -1,23 +1,123 @@
-import os
-import re
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+from functions.clearing_data.loaders import FileIndex
+from functions.clearing_data.ppg_cache import load_ppg_recording
+from functions.clearing_data.window_features import PrefixStats, trial_window_features
+from functions.pipeline.instrumentation import instrumented, record, stage
 
-def match_ppg_data(combined_data_file: str, PPG_data_path: str) -> None:
-    """Matches PPG data to the trial data by comparing participant IDs and session numbers.
 
-    Args:
-        combined_data_file (str): Path to the Excel file containing combined data.
-        PPG_data_path (str): Path to the folder containing the PPG CSV files.
+# Trial columns holding times on the PPG clock that are resolved to sample indices in grouped mode
+PPG_TIME_COLUMNS = ["PPG_music_start", "PPG_response_start", "PPG_ITI_start"]
 
-    Returns:
-        None
+
+def _match_ppg_grouped(
+    trial_data: pd.DataFrame,
+    file_index: FileIndex,
+    cache_dir: str | None,
+    n_workers: int | None = None,
+    window_features: bool = False,
+) -> None:
+    """Resolves the PPG samples of all trials with one lookup per (participant, session) recording.
+
+    Adds the PPG value at ``PPG_response_start`` as ``PPG_data`` and, for every available column of
+    ``PPG_TIME_COLUMNS``, the index of the closest PPG sample as ``<column>_index``.
+
+    Args:
+        trial_data (pd.DataFrame): Trial data, updated in place.
+        file_index (FileIndex): The scanned PPG folder.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        n_workers (int | None): Number of threads loading the recordings.
+        window_features (bool): If True, the ``trial_window_features`` of the music, response and ITI
+            windows are added as well.
     """
-    # Load the data from the Excel file
-    trial_data = pd.read_excel(combined_data_file)
+    time_columns = [col for col in PPG_TIME_COLUMNS if col in trial_data.columns]
+    ppg_values = np.full(len(trial_data), np.nan)
+    sample_indices = {col: np.full(len(trial_data), -1, dtype=np.int64) for col in time_columns}
+    features = {}
+
+    groups = trial_data.groupby(["participant_id", "session"], sort=False).indices
+    matched_files = {key: file_index.find(*key) for key in groups}
+    record(files=sum(file is not None for file in matched_files.values()))
+
+    def load(matched_file):
+        try:
+            return load_ppg_recording(file_index.path(matched_file), cache_dir) if matched_file else None
+        except Exception as e:
+            return e
+
+    # The recordings are loaded on a thread pool; a float32 recording of the whole cohort fits in memory
+    with stage("read_ppg"):
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            recordings = list(executor.map(load, matched_files.values()))
+
+    for rows, matched_file, recording in zip(groups.values(), matched_files.values(), recordings):
+        if not matched_file:
+            record(skipped=1)
+            continue
+        if isinstance(recording, Exception):
+            print(f"Error processing file {matched_file}: {recording}")
+            record(failed=1)
+            continue
+
+        try:
+            for col in time_columns:
+                targets = trial_data[col].to_numpy(dtype=np.float64)[rows]
+                valid = ~np.isnan(targets)
+                sample_indices[col][rows[valid]] = recording.time_to_index(targets[valid])
+
+            response_indices = sample_indices["PPG_response_start"][rows]
+            matched = response_indices >= 0
+            ppg_values[rows[matched]] = recording.signal[response_indices[matched]]
+
+            if window_features:
+                with stage("window_features"):
+                    stats = PrefixStats(recording.signal, recording.sample_rate)
+                    recording_indices = {col: indices[rows] for col, indices in sample_indices.items()}
+                    for col, values in trial_window_features(stats, recording_indices).items():
+                        features.setdefault(col, np.full(len(trial_data), np.nan))[rows] = values.to_numpy()
+        except Exception as e:
+            print(f"Error processing file {matched_file}: {e}")
+            record(failed=1)
+
+    # Write all results back at once
+    trial_data["PPG_data"] = ppg_values
+    for col, indices in sample_indices.items():
+        trial_data[f"{col}_index"] = pd.Series(indices, index=trial_data.index, dtype="Int64").mask(indices < 0)
+    for col, values in features.items():
+        trial_data[col] = values
+
+
+@instrumented
+def add_ppg_data(
+    trial_data: pd.DataFrame,
+    PPG_data_path: str,
+    cache_dir: str | None = None,
+    grouped: bool = False,
+    file_index: FileIndex | None = None,
+    n_workers: int | None = None,
+    window_features: bool = False,
+) -> None:
+    """Adds the PPG value at the response start of every trial to the trial data.
 
+    Args:
+        trial_data (pd.DataFrame): Trial data, updated in place.
+        PPG_data_path (str): Path to the folder containing the PPG CSV files.
+        cache_dir (str | None): Folder of the binary PPG cache. When given, recordings are
+            memory-mapped from the cache instead of parsing the CSV files.
+        grouped (bool): If True, every recording is loaded once and all its trials are resolved
+            together, which also stores the sample indices of the trial start times.
+        file_index (FileIndex | None): The scanned PPG folder, scanned here if not given.
+        n_workers (int | None): Number of threads loading the recordings in grouped mode.
+        window_features (bool): In grouped mode, also add the mean, variance, amplitude range and slope
+            of the PPG signal over the music, response and ITI window of every trial, computed from the
+            prefix sums of every recording (see ``trial_window_features``).
+
+    Every recording is held as a ``PPGRecording``, so the closest sample of a time is computed from
+    the start time and sample rate instead of searching a time column.
+    """
     # Check if required columns exist in the DataFrame
     required_columns = ["session", "participant_id", "PPG_response_start"]
     missing_columns = [col for col in required_columns if col not in trial_data.columns]
@@ -26,50 +126,73 @@ def match_ppg_data(combined_data_file: str, PPG_data_path: str) -> None:
 
     # Create a new column for PPG values
     trial_data["PPG_data"] = None
-
-    # Pre-index available files by participant_id and session for faster lookup
-    file_index = {}
-    for file_name in os.listdir(PPG_data_path):
-        match = re.match(r"sub-(\d+)_sess(\d+)_PPG.csv", file_name)
-        if match:
-            file_participant_id = int(match.group(1))
-            file_session = int(match.group(2))
-            file_index[(file_participant_id, file_session)] = file_name
-
-    # Iterate over each row in the DataFrame
-    for index, row in trial_data.iterrows():
-        session = row["session"]
-        participant_id = row["participant_id"]
-        ppg_response_start = row["PPG_response_start"]
-
-        # Check if the corresponding PPG file exists
-        matched_file = file_index.get((participant_id, session))
-        if matched_file:
-            file_path = Path(PPG_data_path) / matched_file
-
-            try:
-                ppg_data = pd.read_csv(file_path)
-
-                # Check if the 'time' and 'PPG' columns exist
-                if "time" not in ppg_data.columns or "PPG" not in ppg_data.columns:
-                    print(f"Required columns 'time' or 'PPG' missing in {matched_file}")
-                    continue
-
-                # Find the row where the time is closest to the PPG_response_start value
-                closest_time_row = ppg_data.iloc[(ppg_data["time"] - ppg_response_start).abs().argmin()]
-
-                # Extract the PPG value corresponding to the closest time
-                ppg_value = closest_time_row["PPG"]
-
-                # Ensure PPG value is numeric
+    record(rows=len(trial_data))
+
+    # Available files are indexed by participant_id and session for faster lookup
+    if file_index is None:
+        file_index = FileIndex.scan(PPG_data_path, "ppg")
+
+    if grouped:
+        _match_ppg_grouped(trial_data, file_index, cache_dir, n_workers, window_features)
+    else:
+        # Every recording is loaded once, by the first of its trials
+        recordings = {}
+
+        # Iterate over each row in the DataFrame
+        for index, row in trial_data.iterrows():
+            session = row["session"]
+            participant_id = row["participant_id"]
+            ppg_response_start = row["PPG_response_start"]
+
+            # Check if the corresponding PPG file exists
+            matched_file = file_index.find(participant_id, session)
+            if matched_file:
                 try:
-                    ppg_value = float(ppg_value)
+                    if matched_file not in recordings:
+                        with stage("read_ppg"):
+                            recordings[matched_file] = load_ppg_recording(file_index.path(matched_file), cache_dir)
+                        record(files=1)
+                    recording = recordings[matched_file]
+
+                    # The closest sample is computed from the start time and sample rate of the recording;
+                    # from the cache, only the page holding it is read from the memory-mapped signal
+                    closest_index = recording.time_to_index(ppg_response_start)
+                    ppg_value = float(recording.signal[closest_index])
+                    if np.isnan(ppg_value):
+                        print(f"Invalid PPG value at {ppg_response_start} in {matched_file}. Skipping row.")
+                        continue
                     trial_data.loc[index, "PPG_data"] = ppg_value
-                except ValueError:
-                    print(f"Invalid PPG value {ppg_value} in {matched_file}. Skipping row.")
-            except Exception as e:
-                print(f"Error processing file {matched_file}: {e}")
+                except Exception as e:
+                    print(f"Error processing file {matched_file}: {e}")
+                    record(failed=1)
+            else:
+                record(skipped=1)
+
+
+@instrumented
+def match_ppg_data(
+    combined_data_file: str, PPG_data_path: str, cache_dir: str | None = None, grouped: bool = False
+) -> None:
+    """Matches PPG data to the trial data by comparing participant IDs and session numbers.
+
+    Args:
+        combined_data_file (str): Path to the Excel file containing combined data.
+        PPG_data_path (str): Path to the folder containing the PPG CSV files.
+        cache_dir (str | None): Folder of the binary PPG cache. When given, recordings are
+            memory-mapped from the cache instead of parsing the CSV files.
+        grouped (bool): If True, every recording is loaded once and all its trials are resolved
+            together, which also stores the sample indices of the trial start times.
+
+    Returns:
+        None
+    """
+    # Load the data from the Excel file
+    with stage("read_excel"):
+        trial_data = pd.read_excel(combined_data_file)
+
+    add_ppg_data(trial_data, PPG_data_path, cache_dir, grouped)
 
     # Save the updated Excel file
-    trial_data.to_excel(combined_data_file, index=False)
+    with stage("write_excel"):
+        trial_data.to_excel(combined_data_file, index=False)
     print("PPG is added to the final excel.")
@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+
+from functions.clearing_data.beat_trial_join import assign_beats_to_trials
+
+CUBE_DIMENSIONS = ["participant_id", "session", "music_type"]
+
+# Measures of the cube: HR comes from the beats inside the music windows, the others from the trials
+BEAT_MEASURES = ["HR"]
+TRIAL_MEASURES = ["RT", "valence_rating", "IS"]
+
+
+def _measure_cells(keys: pd.DataFrame, values: np.ndarray, measure: str) -> pd.DataFrame:
+    """Sums the non-missing values of one measure per cell as <measure>_n, _sum and _sumsq columns."""
+    valid = ~np.isnan(values)
+    frame = keys[valid].assign(value=values[valid], square=values[valid] ** 2)
+    grouped = frame.groupby(CUBE_DIMENSIONS, dropna=False, sort=False)
+    return pd.DataFrame(
+        {
+            f"{measure}_n": grouped["value"].count(),
+            f"{measure}_sum": grouped["value"].sum(),
+            f"{measure}_sumsq": grouped["square"].sum(),
+        }
+    )
+
+
+def _dimension_keys(table: pd.DataFrame, session_column: str = "session") -> pd.DataFrame:
+    """Returns the cube dimensions of every row. Missing dimensions are stored as -1 or an empty string."""
+    keys = pd.DataFrame(index=range(len(table)))
+    keys["participant_id"] = table["participant_id"].to_numpy() if "participant_id" in table.columns else -1
+    keys["session"] = table[session_column].to_numpy() if session_column in table.columns else -1
+    keys["music_type"] = table["music_type"].to_numpy() if "music_type" in table.columns else ""
+    return keys
+
+
+class AggregateCube:
+    """Count, sum and sum of squares of HR, RT, valence rating and IS per participant, session and
+    music type.
+
+    The cube is built once from the trial and beat tables and holds a few rows per participant, so
+    the ANOVAs, correlations and summary tables of the analyses are computed from it without
+    scanning the beats again. Cells of single participants can be rebuilt when their data changes.
+
+    Attributes:
+        cells (pd.DataFrame): One row per cell with the dimension columns and <measure>_n,
+            <measure>_sum and <measure>_sumsq for every measure.
+    """
+
+    def __init__(self, cells: pd.DataFrame):
+        self.cells = cells
+
+    @classmethod
+    def from_tables(cls, trials: pd.DataFrame, beats: pd.DataFrame | None = None) -> "AggregateCube":
+        """Builds the cube from the trial table and, if given, the beat table.
+
+        Args:
+            trials (pd.DataFrame): Trial table with participant_id, session, music_type and the trial
+                measures. Missing measures are left out of the cube.
+            beats (pd.DataFrame | None): Beat table; every beat counts under the trial whose music
+                window contains it. Requires the PPG_music_start and PPG_response_start trial columns.
+
+        Returns:
+            AggregateCube: The cube.
+        """
+        trial_keys = _dimension_keys(trials)
+        parts = [
+            _measure_cells(trial_keys, trials[measure].to_numpy(dtype=np.float64), measure)
+            for measure in TRIAL_MEASURES
+            if measure in trials.columns
+        ]
+
+        if beats is not None and len(trials) and {"PPG_music_start", "PPG_response_start"} <= set(trials.columns):
+            trial_of_beat = assign_beats_to_trials(beats, trials)
+            inside = trial_of_beat >= 0
+            beat_keys = trial_keys.iloc[trial_of_beat[inside]].reset_index(drop=True)
+            for measure in BEAT_MEASURES:
+                values = beats[measure].to_numpy(dtype=np.float64)[inside]
+                parts.append(_measure_cells(beat_keys, values, measure))
+
+        if not parts:
+            return cls(pd.DataFrame(columns=CUBE_DIMENSIONS))
+        cells = pd.concat(parts, axis=1).fillna(0)
+        cells = cells.sort_index(na_position="last").reset_index()
+        count_columns = [col for col in cells.columns if col.endswith("_n")]
+        cells[count_columns] = cells[count_columns].astype(np.int64)
+        return cls(cells)
+
+    def update(self, trials: pd.DataFrame, beats: pd.DataFrame | None, participant_ids) -> "AggregateCube":
+        """Rebuilds the cells of the given participants from the tables and keeps all other cells.
+
+        Args:
+            trials (pd.DataFrame): The full trial table.
+            beats (pd.DataFrame | None): The full beat table.
+            participant_ids (iterable): Participants whose trials, beats or IS changed.
+
+        Returns:
+            AggregateCube: The updated cube.
+        """
+        participant_ids = list(participant_ids)
+        if "participant_id" not in trials.columns or "participant_id" not in self.cells.columns:
+            return AggregateCube.from_tables(trials, beats)
+
+        changed_trials = trials[trials["participant_id"].isin(participant_ids)]
+        changed_beats = beats[beats["participant_id"].isin(participant_ids)] if beats is not None else None
+        rebuilt = AggregateCube.from_tables(changed_trials.reset_index(drop=True), changed_beats).cells
+        kept = self.cells[~self.cells["participant_id"].isin(participant_ids)]
+
+        # Participants without any trials left have no rebuilt cells
+        cells = pd.concat([part for part in (kept, rebuilt) if len(part)] or [rebuilt], ignore_index=True)
+        measure_columns = [col for col in cells.columns if col not in CUBE_DIMENSIONS]
+        cells[measure_columns] = cells[measure_columns].fillna(0)
+        count_columns = [col for col in measure_columns if col.endswith("_n")]
+        cells[count_columns] = cells[count_columns].astype(np.int64)
+        cells = cells.sort_values(CUBE_DIMENSIONS, na_position="last", ignore_index=True)
+        return AggregateCube(cells)
+
+    @classmethod
+    def merge(cls, cubes: list["AggregateCube"]) -> "AggregateCube":
+        """Combines cubes built from separate parts of the data, e.g. the shards of a cohort.
+
+        Counts, sums and sums of squares add up, so the merged cube equals the cube of all data at once.
+        Cells present in several cubes are summed and measures missing from a cube count as zero.
+
+        Args:
+            cubes (list[AggregateCube]): The cubes to combine.
+
+        Returns:
+            AggregateCube: The merged cube.
+        """
+        parts = [cube.cells for cube in cubes if len(cube.cells)]
+        if not parts:
+            return cls(pd.DataFrame(columns=CUBE_DIMENSIONS))
+        cells = pd.concat(parts, ignore_index=True)
+        # Columns in the order of from_tables, whichever cube has which measures
+        measure_columns = [
+            f"{measure}_{statistic}"
+            for measure in TRIAL_MEASURES + BEAT_MEASURES
+            for statistic in ("n", "sum", "sumsq")
+            if f"{measure}_{statistic}" in cells.columns
+        ]
+        cells[measure_columns] = cells[measure_columns].fillna(0)
+        cells = cells.groupby(CUBE_DIMENSIONS, dropna=False, sort=False)[measure_columns].sum()
+        cells = cells.sort_index(na_position="last").reset_index()
+        count_columns = [col for col in cells.columns if col.endswith("_n")]
+        cells[count_columns] = cells[count_columns].astype(np.int64)
+        return cls(cells)
+
+    def group_stats(self, measure: str, by: str | list[str] = "music_type") -> pd.DataFrame:
+        """Summarizes a measure per group of cells.
+
+        Args:
+            measure (str): "HR", "RT", "valence_rating" or "IS".
+            by (str | list[str]): Dimension(s) to group by.
+
+        Returns:
+            pd.DataFrame: n, sum, sumsq, mean, std (sample standard deviation) and var per group;
+            groups without values are left out.
+        """
+        if f"{measure}_n" not in self.cells.columns:
+            raise ValueError(f"The aggregate cube has no '{measure}' values.")
+
+        stats = (
+            self.cells.groupby(by, dropna=False)[[f"{measure}_n", f"{measure}_sum", f"{measure}_sumsq"]]
+            .sum()
+            .set_axis(["n", "sum", "sumsq"], axis=1)
+        )
+        stats = stats[stats["n"] > 0]
+        stats["mean"] = stats["sum"] / stats["n"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = (stats["sumsq"] - stats["n"] * stats["mean"] ** 2) / (stats["n"] - 1)
+        stats["var"] = variance.where(stats["n"] > 1).clip(lower=0)
+        stats["std"] = np.sqrt(stats["var"])
+        return stats
+
+    def anova(self, measure: str, by: str = "music_type") -> tuple[float, float]:
+        """One-way ANOVA of a measure between the groups, equal to ``scipy.stats.f_oneway`` on the
+        observations of the cells.
+
+        Returns:
+            tuple[float, float]: The F-statistic and its p-value.
+        """
+        # Imported here so that building the cube during ingest does not import scipy
+        from scipy.stats import f as f_distribution
+
+        stats = self.group_stats(measure, by).dropna(subset=["mean"])
+        n_total, grand_sum = stats["n"].sum(), stats["sum"].sum()
+        between_ss = (stats["sum"] ** 2 / stats["n"]).sum() - grand_sum**2 / n_total
+        within_ss = stats["sumsq"].sum() - (stats["sum"] ** 2 / stats["n"]).sum()
+
+        df_between, df_within = len(stats) - 1, n_total - len(stats)
+        if df_between < 1 or df_within < 1:
+            return float("nan"), float("nan")
+        f_stat = (between_ss / df_between) / (within_ss / df_within)
+        return float(f_stat), float(f_distribution.sf(f_stat, df_between, df_within))
+
+    def correlation(self, measure_x: str, measure_y: str, by: str = "participant_id") -> tuple[float, float, int]:
+        """Pearson correlation between the means of two measures per group, e.g. per participant.
+
+        Groups missing either measure are left out.
+
+        Returns:
+            tuple[float, float, int]: The correlation, its p-value and the number of groups.
+        """
+        from scipy.stats import pearsonr
+
+        means = pd.concat(
+            [self.group_stats(measure_x, by)["mean"], self.group_stats(measure_y, by)["mean"]], axis=1, join="inner"
+        ).dropna()
+        if len(means) < 3:
+            return float("nan"), float("nan"), len(means)
+        correlation, p_value = pearsonr(means.iloc[:, 0], means.iloc[:, 1])
+        return float(correlation), float(p_value), len(means)
+
+    def code_correlation(self, measure: str, by: str = "music_type") -> float:
+        """Pearson correlation between the observations of a measure and the category code of a
+        dimension, where the categories are numbered 0, 1, ... in sorted order and missing ones -1, as
+        by ``pd.Categorical``.
+        """
+        stats = self.group_stats(measure, by).sort_index(na_position="last")
+        codes = np.where(stats.index.isna(), -1, np.arange(len(stats)))
+        n = stats["n"].sum()
+        sum_x, sum_y = (codes * stats["n"]).sum(), stats["sum"].sum()
+        covariance = (codes * stats["sum"]).sum() - sum_x * sum_y / n
+        variance_x = (codes**2 * stats["n"]).sum() - sum_x**2 / n
+        variance_y = stats["sumsq"].sum() - sum_y**2 / n
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return float(covariance / np.sqrt(variance_x * variance_y))
@@ -0,0 +1,260 @@
+import abc
+import gzip
+import os
+import shutil
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from functions.clearing_data.loaders import CSV_ENGINE
+
+try:
+    # Needed for the partitioned Parquet and Feather sinks only
+    import pyarrow  # noqa: F401
+
+    ARROW_AVAILABLE = True
+except ImportError:
+    ARROW_AVAILABLE = False
+
+BEAT_TABLE_NAME = "R-peaks_and_HR"
+BEAT_DTYPES = {
+    "participant_id": "int32",
+    "session_id": "int16",
+    "r_peak_index": "int64",
+    "r_peak_time": "float64",
+    "RR": "float64",
+    "HR": "float64",
+}
+
+# Data rows of an Excel sheet, one row is taken by the header
+EXCEL_MAX_ROWS = 1_048_575
+
+# Name of the partition folder of a participant in the Parquet and Feather datasets
+PARTITION_PREFIX = "participant_id="
+
+
+class BeatSink(abc.ABC):
+    """Writes the beat table one recording at a time, so the whole table never has to be held in memory.
+
+    ``write`` is called once per recording, in participant and session order, and ``close`` once at the
+    end. The output is only created by the first write, so no file is left behind if no beats were found.
+
+    Attributes:
+        path (Path): The output file or folder.
+        rows (int): Number of beats written so far.
+    """
+
+    suffix = ""
+
+    def __init__(self, final_data_path: str):
+        self.path = Path(final_data_path) / (BEAT_TABLE_NAME + self.suffix)
+        self.rows = 0
+
+    def write(self, beats: pd.DataFrame) -> None:
+        """Appends the beats of one recording."""
+        if self.rows == 0:
+            self._open()
+        self._write(beats)
+        self.rows += len(beats)
+
+    def close(self) -> None:
+        """Finishes the output and reports where it was saved."""
+        if self.rows == 0:
+            print("No R-peaks or HR were extracted.")
+            return
+        self._close()
+        print(f"R-peaks and HR saved to {self.path.name}.")
+
+    def _open(self) -> None:
+        # The output of a previous run is replaced, not appended to
+        if self.path.is_dir():
+            shutil.rmtree(self.path)
+        elif self.path.exists():
+            self.path.unlink()
+
+    @abc.abstractmethod
+    def _write(self, beats: pd.DataFrame) -> None:
+        """Appends the beats of one recording to the opened output."""
+
+    def _close(self) -> None:
+        pass
+
+
+class ExcelSink(BeatSink):
+    """Collects the beats and writes them to one Excel sheet at the end, since Excel files cannot be appended to.
+
+    Raises a ValueError as soon as the beats would exceed the rows of a sheet.
+    """
+
+    suffix = ".xlsx"
+
+    def _open(self) -> None:
+        super()._open()
+        self._tables = []
+
+    def _write(self, beats: pd.DataFrame) -> None:
+        if self.rows + len(beats) > EXCEL_MAX_ROWS:
+            raise ValueError(
+                f"More than {EXCEL_MAX_ROWS} beats do not fit in an Excel sheet; use the csv, sqlite or parquet sink."
+            )
+        self._tables.append(beats)
+
+    def _close(self) -> None:
+        pd.concat(self._tables, ignore_index=True).to_excel(self.path, index=False)
+        self._tables = []
+
+
+class CsvSink(BeatSink):
+    """Appends the beats to a gzip-compressed CSV file."""
+
+    suffix = ".csv.gz"
+
+    def _open(self) -> None:
+        super()._open()
+        self._file = gzip.open(self.path, "wt", compresslevel=6, newline="")
+
+    def _write(self, beats: pd.DataFrame) -> None:
+        beats.to_csv(self._file, header=self.rows == 0, index=False)
+
+    def _close(self) -> None:
+        self._file.close()
+
+
+class SqliteSink(BeatSink):
+    """Appends the beats to the beats table of a SQLite file, indexed by participant at the end."""
+
+    suffix = ".sqlite"
+
+    def _open(self) -> None:
+        super()._open()
+        self._connection = sqlite3.connect(self.path)
+
+    def _write(self, beats: pd.DataFrame) -> None:
+        beats.to_sql("beats", self._connection, index=False, if_exists="append")
+        self._connection.commit()
+
+    def _close(self) -> None:
+        self._connection.execute("CREATE INDEX beats_participant ON beats (participant_id)")
+        self._connection.commit()
+        self._connection.close()
+
+
+class ParquetSink(BeatSink):
+    """Writes the beats as a Parquet dataset partitioned by participant.
+
+    Every recording becomes one zstd-compressed file ``participant_id=<id>/sess<session>.parquet``. The
+    participant ID is only stored in the folder name, as in Hive-style partitioned datasets, so the
+    folder can also be read with ``pd.read_parquet`` or other Arrow-based tools.
+    """
+
+    suffix = ".parquet"
+
+    def _open(self) -> None:
+        super()._open()
+        self.path.mkdir()
+
+    def _write(self, beats: pd.DataFrame) -> None:
+        for participant_id, recording in beats.groupby("participant_id", sort=False):
+            partition = self.path / f"{PARTITION_PREFIX}{participant_id}"
+            partition.mkdir(exist_ok=True)
+            for session_id, session in recording.groupby("session_id", sort=False):
+                self._write_file(session.drop(columns="participant_id"), partition / f"sess{session_id}{self.suffix}")
+
+    def _write_file(self, beats: pd.DataFrame, file_path: Path) -> None:
+        beats.to_parquet(file_path, index=False, compression="zstd")
+
+
+class FeatherSink(ParquetSink):
+    """Writes the beats as an Arrow IPC (Feather) dataset partitioned by participant, like ``ParquetSink``.
+
+    Feather files are larger than Parquet files but can be read without decoding.
+    """
+
+    suffix = ".feather"
+
+    def _write_file(self, beats: pd.DataFrame, file_path: Path) -> None:
+        beats.reset_index(drop=True).to_feather(file_path, compression="zstd")
+
+
+BEAT_SINKS = {"excel": ExcelSink, "csv": CsvSink, "sqlite": SqliteSink, "parquet": ParquetSink, "feather": FeatherSink}
+
+
+def open_beat_sink(sink: str, final_data_path: str) -> BeatSink:
+    """Returns the sink writing the beat table to the given folder.
+
+    Args:
+        sink (str): "excel", "csv", "sqlite", "parquet" or "feather".
+        final_data_path (str): Folder of the output.
+
+    Returns:
+        BeatSink: The sink, writing to R-peaks_and_HR with the file type of the sink.
+
+    Raises:
+        ValueError: If the sink is unknown or needs pyarrow, which is not installed.
+    """
+    if sink not in BEAT_SINKS:
+        raise ValueError(f"Unknown beat sink {sink}, expected one of {list(BEAT_SINKS)}.")
+    if issubclass(BEAT_SINKS[sink], ParquetSink) and not ARROW_AVAILABLE:
+        raise ValueError(f"The {sink} sink needs pyarrow, which is not installed.")
+    return BEAT_SINKS[sink](final_data_path)
+
+
+def _read_partitions(path: Path, participant_ids) -> pd.DataFrame:
+    """Reads the files of the wanted participants from a dataset written by ``ParquetSink`` or ``FeatherSink``."""
+    partitions = {}
+    for folder in os.listdir(path):
+        if folder.startswith(PARTITION_PREFIX):
+            partitions[int(folder[len(PARTITION_PREFIX) :])] = path / folder
+    if participant_ids is not None:
+        partitions = {key: folder for key, folder in partitions.items() if key in participant_ids}
+
+    tables = []
+    for participant_id in sorted(partitions):
+        # Recordings in session order, e.g. sess2 before sess10
+        for file_name in sorted(os.listdir(partitions[participant_id]), key=lambda name: int(name[4:].split(".")[0])):
+            file_path = partitions[participant_id] / file_name
+            table = pd.read_parquet(file_path) if file_name.endswith(".parquet") else pd.read_feather(file_path)
+            tables.append(table.assign(participant_id=participant_id))
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=list(BEAT_DTYPES))
+
+
+def read_beat_table(source: str, participant_ids=None) -> pd.DataFrame:
+    """Reads the beat table written by any of the sinks, optionally only for some participants.
+
+    Partitioned datasets and SQLite files only read the beats of the wanted participants; CSV and Excel
+    files are read completely and filtered.
+
+    Args:
+        source (str): Path to the R-peaks file or dataset folder.
+        participant_ids (array-like | None): Participants to read, by default all.
+
+    Returns:
+        pd.DataFrame: R-peaks and HR, one row per beat, with the columns and types of ``BEAT_DTYPES``.
+    """
+    path = Path(source)
+    if participant_ids is not None:
+        participant_ids = {int(participant_id) for participant_id in participant_ids}
+
+    if path.is_dir():
+        beats = _read_partitions(path, participant_ids)
+    elif path.suffix == ".sqlite":
+        with closing(sqlite3.connect(path)) as connection:
+            if participant_ids is None:
+                beats = pd.read_sql("SELECT * FROM beats", connection)
+            else:
+                placeholders = ", ".join("?" * len(participant_ids))
+                query = f"SELECT * FROM beats WHERE participant_id IN ({placeholders})"
+                beats = pd.read_sql(query, connection, params=sorted(participant_ids))
+    else:
+        if path.suffix == ".xlsx":
+            beats = pd.read_excel(path)
+        else:
+            beats = pd.read_csv(path, dtype=BEAT_DTYPES, engine="c" if str(path).endswith(".gz") else CSV_ENGINE)
+        if participant_ids is not None:
+            beats = beats[np.isin(beats["participant_id"], list(participant_ids))].reset_index(drop=True)
+
+    columns = [col for col in BEAT_DTYPES if col in beats.columns]
+    return beats.loc[:, columns].astype({col: BEAT_DTYPES[col] for col in columns})
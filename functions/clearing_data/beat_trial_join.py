@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+
+def assign_beats_to_trials(beats: pd.DataFrame, trials: pd.DataFrame) -> np.ndarray:
+    """Finds, for every beat, the trial whose music window contains it.
+
+    The music window of a trial runs from ``PPG_music_start`` (inclusive) to ``PPG_response_start``
+    (exclusive) on the clock of the PPG recording. Beats are matched on their ``r_peak_time``
+    with one sorted-array lookup per (participant, session), so memory stays linear in the number
+    of beats. The windows of a session are assumed not to overlap.
+
+    Args:
+        beats (pd.DataFrame): Beat table with participant_id, session_id and r_peak_time columns.
+        trials (pd.DataFrame): Trial table with participant_id, session, PPG_music_start and
+            PPG_response_start columns.
+
+    Returns:
+        np.ndarray: Row position in ``trials`` of the trial of every beat, or -1 for beats that
+        fall outside all music windows.
+    """
+    if "r_peak_time" not in beats.columns:
+        raise ValueError("The beat table has no 'r_peak_time' column. Rerun the PPG processing stage.")
+
+    trial_of_beat = np.full(len(beats), -1, dtype=np.int64)
+    music_starts = trials["PPG_music_start"].to_numpy(dtype=np.float64)
+    response_starts = trials["PPG_response_start"].to_numpy(dtype=np.float64)
+    beat_times = beats["r_peak_time"].to_numpy(dtype=np.float64)
+
+    trial_groups = trials.groupby(["participant_id", "session"], sort=False).indices
+    beat_groups = beats.groupby(["participant_id", "session_id"], sort=False).indices
+
+    for key, beat_rows in beat_groups.items():
+        trial_rows = trial_groups.get(key)
+        if trial_rows is None:
+            continue
+
+        # Windows of the session, sorted by their start
+        trial_rows = trial_rows[np.argsort(music_starts[trial_rows], kind="stable")]
+        starts = music_starts[trial_rows]
+        ends = response_starts[trial_rows]
+
+        times = beat_times[beat_rows]
+        window = np.searchsorted(starts, times, side="right") - 1
+        inside = window >= 0
+        inside[inside] = times[inside] < ends[window[inside]]
+        trial_of_beat[beat_rows[inside]] = trial_rows[window[inside]]
+
+    return trial_of_beat
+
+
+def beats_in_trials(beats: pd.DataFrame, trials: pd.DataFrame, columns: list[str] | None = None) -> pd.DataFrame:
+    """Returns the beats that fall into a music window, labelled with their trial.
+
+    Args:
+        beats (pd.DataFrame): Beat table with participant_id, session_id and r_peak_time columns.
+        trials (pd.DataFrame): Trial table with participant_id, session, PPG_music_start and
+            PPG_response_start columns.
+        columns (list[str] | None): Trial columns copied to the beats, by default music_type.
+
+    Returns:
+        pd.DataFrame: The matched beats with a "trial" column (row position in ``trials``) and
+        the requested trial columns.
+    """
+    columns = ["music_type"] if columns is None else columns
+    trial_of_beat = assign_beats_to_trials(beats, trials)
+    inside = trial_of_beat >= 0
+
+    matched = beats[inside].reset_index(drop=True)
+    matched["trial"] = trial_of_beat[inside]
+    for col in columns:
+        matched[col] = trials[col].to_numpy()[matched["trial"].to_numpy()]
+    return matched
+
+
+def summarize_trial_hr(beats: pd.DataFrame, trials: pd.DataFrame) -> pd.DataFrame:
+    """Summarizes the HR of the beats inside the music window of every trial.
+
+    Args:
+        beats (pd.DataFrame): Beat table with participant_id, session_id, r_peak_time and HR columns.
+        trials (pd.DataFrame): Trial table with participant_id, session, music_type,
+            PPG_music_start and PPG_response_start columns.
+
+    Returns:
+        pd.DataFrame: One row per trial with participant_id, session, music_type, n_beats,
+        HR_mean and HR_std (NaN for trials with fewer beats than needed).
+    """
+    trial_of_beat = assign_beats_to_trials(beats, trials)
+    inside = trial_of_beat >= 0
+    hr_values = beats["HR"].to_numpy(dtype=np.float64)[inside]
+    trial_ids = trial_of_beat[inside]
+
+    # Per-trial count, sum and sum of squares in one pass each
+    n_beats = np.bincount(trial_ids, minlength=len(trials))
+    hr_sum = np.bincount(trial_ids, weights=hr_values, minlength=len(trials))
+    hr_sum_squares = np.bincount(trial_ids, weights=hr_values**2, minlength=len(trials))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hr_mean = hr_sum / n_beats
+        hr_variance = np.where(n_beats > 1, (hr_sum_squares - n_beats * hr_mean**2) / (n_beats - 1), np.nan)
+
+    summary = trials.loc[:, ["participant_id", "session", "music_type"]].reset_index(drop=True)
+    summary["n_beats"] = n_beats
+    summary["HR_mean"] = hr_mean
+    summary["HR_std"] = np.sqrt(np.clip(hr_variance, 0, None))
+    return summary
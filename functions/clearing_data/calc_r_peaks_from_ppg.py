@@ -1,90 +1,320 @@
 import os
-import re
-from pathlib import Path
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 from scipy.signal import cheby2, find_peaks, sosfiltfilt
 
+from functions.clearing_data.beat_sinks import open_beat_sink
+from functions.clearing_data.loaders import file_key
+from functions.clearing_data.ppg_cache import list_ppg_files, load_ppg_recording
+from functions.pipeline.instrumentation import instrumented, record, stage
 
-def process_ppg_folder(PPG_data_path: str, final_data_path: str) -> None:
-    """Processes all PPG files in the specified folder, extracts R-peaks, calculates HR,
-    and saves the results in a single Excel file.
+
+# Default detection parameters: pass band of the filter in Hz, prominence threshold relative to the
+# maximum of the filtered signal, minimum time between peaks in seconds, and the physiological limits
+# of the RR intervals in seconds and of the HR in bpm
+PPG_BAND = (0.5, 5)
+PROMINENCE_FACTOR = 0.15
+MIN_PEAK_DISTANCE = 0.6
+RR_LIMITS = (0.3, 1.5)
+HR_LIMITS = (40, 200)
+
+
+@lru_cache(maxsize=None)
+def _ppg_bandpass(sample_rate, band=PPG_BAND):
+    """Designs the band-pass filter applied to the PPG signal before peak detection.
+
+    The design only depends on the sample rate and the band, so it is computed once per combination.
+    """
+    return cheby2(4, 20, list(band), btype="bandpass", fs=sample_rate, output="sos")
+
+
+def filter_ppg(ppg_signal, sample_rate, band=PPG_BAND):
+    """Band-pass filters a PPG signal forwards and backwards, without phase shift."""
+    return sosfiltfilt(_ppg_bandpass(sample_rate, tuple(band)), ppg_signal)
+
+
+def rpeaks_from_ppg(
+    ppg_signal, sample_rate, band=PPG_BAND, prominence_factor=PROMINENCE_FACTOR, min_distance=MIN_PEAK_DISTANCE
+):
+    """Extracts R-peaks from a PPG signal."""
+    filtered_data = filter_ppg(ppg_signal, sample_rate, band)
+
+    prominence_threshold = filtered_data.max() * prominence_factor
+    r_peaks, _ = find_peaks(filtered_data, prominence=prominence_threshold, distance=int(sample_rate * min_distance))
+    return r_peaks
+
+
+def rpeaks_from_ppg_chunked(
+    ppg_signal,
+    sample_rate,
+    block_seconds=300,
+    overlap_seconds=30,
+    global_threshold=False,
+    band=PPG_BAND,
+    prominence_factor=PROMINENCE_FACTOR,
+    min_distance=MIN_PEAK_DISTANCE,
+):
+    """Extracts R-peaks from a PPG signal block by block, with memory bounded by the block size.
+
+    Each block is filtered together with ``overlap_seconds`` of signal on both sides, so the
+    zero-phase filter and the minimum peak distance behave as on the full recording, and only
+    the peaks inside the block itself are kept. The signal can be a memory-mapped array, in
+    which case only one extended block is held in memory at a time.
 
     Args:
-        PPG_data_path (str): Path to the folder containing PPG files.
-        final_data_path (str): Path to save the resulting Excel file with R-peaks and HR.
+        ppg_signal (np.ndarray): The PPG signal.
+        sample_rate (float): Sample rate of the signal in Hz.
+        block_seconds (float): Length of a block in seconds.
+        overlap_seconds (float): Signal added on each side of a block in seconds.
+        global_threshold (bool): If False, the prominence threshold is taken from the maximum of
+            each extended block. If True, a first pass over the blocks finds the maximum of the
+            whole filtered recording, which reproduces ``rpeaks_from_ppg``.
+        band, prominence_factor, min_distance: Detection parameters, as for ``rpeaks_from_ppg``.
+
+    Returns:
+        np.ndarray: Indices of the R-peaks.
     """
-    all_results = []
+    sos = _ppg_bandpass(sample_rate, tuple(band))
+    min_distance = int(sample_rate * min_distance)
+    block_size = max(int(block_seconds * sample_rate), 1)
+    overlap = int(overlap_seconds * sample_rate)
+    n_samples = len(ppg_signal)
 
-    def rpeaks_from_ppg(ppg_signal, sample_rate):
-        """Extracts R-peaks from a PPG signal."""
-        filter_range = [0.5, 5]
-        sos = cheby2(4, 20, filter_range, btype="bandpass", fs=sample_rate, output="sos")
-        filtered_data = sosfiltfilt(sos, ppg_signal)
+    def filtered_blocks():
+        for block_start in range(0, n_samples, block_size):
+            block_end = min(block_start + block_size, n_samples)
+            window_start = max(block_start - overlap, 0)
+            window_end = min(block_end + overlap, n_samples)
+            window = np.asarray(ppg_signal[window_start:window_end], dtype=np.float64)
+            yield block_start, block_end, window_start, sosfiltfilt(sos, window)
 
-        prominence_threshold = max(filtered_data) * 0.15
-        min_distance = int(sample_rate * 0.6)
+    if global_threshold:
+        signal_max = max(
+            filtered[block_start - window_start : block_end - window_start].max()
+            for block_start, block_end, window_start, filtered in filtered_blocks()
+        )
 
-        r_peaks, _ = find_peaks(filtered_data, prominence=prominence_threshold, distance=min_distance)
-        return r_peaks
+    r_peaks = []
+    for block_start, block_end, window_start, filtered in filtered_blocks():
+        prominence_threshold = (signal_max if global_threshold else filtered.max()) * prominence_factor
+        peaks, _ = find_peaks(filtered, prominence=prominence_threshold, distance=min_distance)
+        peaks += window_start
+        r_peaks.append(peaks[(peaks >= block_start) & (peaks < block_end)])
 
-    def calculate_hr(r_peaks, sample_rate):
-        """Calculates Heart Rate (HR) from R-peaks."""
-        rr_intervals = np.diff(r_peaks) / sample_rate
-        valid_rr_intervals = [rr for rr in rr_intervals if 0.3 <= rr <= 1.5]
-        hr_values = 60 / np.array(valid_rr_intervals)
-        return [hr for hr in hr_values if 40 <= hr <= 200]
+    return np.concatenate(r_peaks) if r_peaks else np.array([], dtype=np.int64)
 
-    for file_name in os.listdir(PPG_data_path):
-        if file_name.endswith(".csv"):
-            file_path = os.path.join(PPG_data_path, file_name)
 
-            try:
-                match = re.match(r"sub-(\d+)_sess(\d+)_PPG.csv", file_name)
-                if not match:
-                    print(f"File name does not match expected pattern: {file_name}")
-                    continue
+def calculate_hr(r_peaks, sample_rate, rr_limits=RR_LIMITS, hr_limits=HR_LIMITS):
+    """Calculates Heart Rate (HR) from R-peaks.
 
-                participant_id = match.group(1)
-                session_id = match.group(2)
+    The arrays are aligned with ``r_peaks[:-1]``: entry i describes the beat starting at
+    ``r_peaks[i]``.
 
-                data = pd.read_csv(file_path)
-                if "PPG" not in data.columns:
-                    print(f"File {file_name} is missing the required 'PPG' column.")
-                    continue
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: RR intervals in seconds, HR values in bpm and
+        a mask of the beats whose RR interval and HR are within the physiological limits.
+    """
+    rr_intervals = np.diff(r_peaks) / sample_rate
+    hr_values = 60 / rr_intervals
+    valid = (
+        (rr_intervals >= rr_limits[0])
+        & (rr_intervals <= rr_limits[1])
+        & (hr_values >= hr_limits[0])
+        & (hr_values <= hr_limits[1])
+    )
+    return rr_intervals, hr_values, valid
+
+
+def _process_ppg_file(
+    PPG_data_path: str, file_name: str, cache_dir: str | None, block_seconds: float | None = None
+) -> tuple:
+    """Extracts R-peaks and HR from a single PPG file.
+
+    A file that cannot be processed is not reported here; its message is part of the result and is
+    printed by the caller of ``iter_beats``.
+
+    Returns:
+        tuple: (participant_id, session_id, beats, message), where beats maps "r_peak_index",
+        "r_peak_time", "RR" and "HR" to arrays of the valid beats. beats is None and message is set
+        if the file could not be processed.
+    """
+    file_path = os.path.join(PPG_data_path, file_name)
+
+    try:
+        key = file_key(file_name, "ppg")
+        if key is None:
+            return None, None, None, f"File name does not match expected pattern: {file_name}"
+
+        participant_id, session_id = key
 
-                ppg_signal = data["PPG"].values
-                sample_rate = 100
+        with stage("read_ppg"):
+            recording = load_ppg_recording(file_path, cache_dir)
+        ppg_signal, sample_rate = recording.signal, recording.sample_rate
 
+        with stage("detect_peaks"):
+            if block_seconds is not None:
+                r_peaks = rpeaks_from_ppg_chunked(ppg_signal, sample_rate, block_seconds)
+            else:
                 r_peaks = rpeaks_from_ppg(ppg_signal, sample_rate)
-                if len(r_peaks) == 0:
-                    print(f"No R-peaks detected in {file_name}.")
-                    continue
-
-                hr_values = calculate_hr(r_peaks, sample_rate)
-                if len(hr_values) == 0:
-                    print(f"No valid HR values calculated for {file_name}.")
-                    continue
-
-                for i, hr in enumerate(hr_values):
-                    if i < len(r_peaks) - 1:
-                        all_results.append(
-                            {
-                                "participant_id": participant_id,
-                                "session_id": session_id,
-                                "r_peak_index": r_peaks[i],
-                                "HR": hr,
-                            }
-                        )
-
-            except Exception as e:
-                print(f"Failed to process {file_name}: {e}")
-
-    if all_results:
-        results_df = pd.DataFrame(all_results)
-        output_path = Path(final_data_path) / "R-peaks_and_HR.xlsx"
-        results_df.to_excel(output_path, index=False)
-        print("R-peaks and HR saved to R-peaks_and_HR excel file.")
+        if len(r_peaks) == 0:
+            return None, None, None, f"No R-peaks detected in {file_name}."
+
+        rr_intervals, hr_values, valid = calculate_hr(r_peaks, sample_rate)
+        if not valid.any():
+            return None, None, None, f"No valid HR values calculated for {file_name}."
+
+        beat_indices = r_peaks[:-1][valid]
+        beats = {
+            "r_peak_index": beat_indices,
+            "r_peak_time": recording.index_to_time(beat_indices),
+            "RR": rr_intervals[valid],
+            "HR": hr_values[valid],
+        }
+        return participant_id, session_id, beats, None
+
+    except Exception as e:
+        return None, None, None, f"Failed to process {file_name}: {e}"
+
+
+def iter_beats(
+    PPG_data_path: str,
+    file_names: list[str],
+    cache_dir: str | None = None,
+    n_workers: int = 1,
+    block_seconds: float | None = None,
+) -> Iterator[tuple]:
+    """Yields the beats of the given PPG files one file at a time, as the files are processed.
+
+    Args:
+        PPG_data_path (str): Path to the folder containing PPG files.
+        file_names (list[str]): Names of the PPG files to process.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        n_workers (int): Number of worker processes.
+        block_seconds (float | None): Block length for chunked peak detection, if used.
+
+    Yields:
+        tuple: (participant_id, session_id, beats, message) of every file, in the order of ``file_names``.
+    """
+    folders = [PPG_data_path] * len(file_names)
+    cache_dirs = [cache_dir] * len(file_names)
+    block_lengths = [block_seconds] * len(file_names)
+
+    if n_workers > 1 and len(file_names) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(file_names))) as executor:
+            yield from executor.map(_process_ppg_file, folders, file_names, cache_dirs, block_lengths)
     else:
-        print("No R-peaks or HR were extracted.")
+        yield from map(_process_ppg_file, folders, file_names, cache_dirs, block_lengths)
+
+
+@instrumented
+def extract_beats(
+    PPG_data_path: str,
+    file_names: list[str],
+    cache_dir: str | None = None,
+    n_workers: int = 1,
+    block_seconds: float | None = None,
+) -> list[tuple]:
+    """Extracts the valid beats of the given PPG files, printing a message for every file that fails.
+
+    Args:
+        PPG_data_path (str): Path to the folder containing PPG files.
+        file_names (list[str]): Names of the PPG files to process.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        n_workers (int): Number of worker processes.
+        block_seconds (float | None): Block length for chunked peak detection, if used.
+
+    Returns:
+        list[tuple]: (participant_id, session_id, beats, message) for every file, in the order of
+        ``file_names``.
+    """
+    file_results = list(iter_beats(PPG_data_path, file_names, cache_dir, n_workers, block_seconds))
+
+    for _, _, _, message in file_results:
+        if message is not None:
+            print(message)
+
+    n_beats = sum(len(beats["HR"]) for _, _, beats, _ in file_results if beats is not None)
+    failed = sum(message is not None for _, _, _, message in file_results)
+    record(rows=n_beats, files=len(file_names), failed=failed)
+
+    return file_results
+
+
+def build_beat_table(file_results: list[tuple]) -> pd.DataFrame | None:
+    """Concatenates the per-recording beats into one typed table.
+
+    Args:
+        file_results (list[tuple]): Results of ``extract_beats``; failed files are ignored.
+
+    Returns:
+        pd.DataFrame | None: The beat table, or None if no beats were extracted.
+    """
+    all_results = [(participant_id, session_id, beats) for participant_id, session_id, beats, _ in file_results]
+    all_results = [result for result in all_results if result[2] is not None]
+    if not all_results:
+        return None
+
+    # Build the typed beat table from the per-recording arrays in one go
+    n_beats = [len(beats["HR"]) for _, _, beats in all_results]
+    return pd.DataFrame(
+        {
+            "participant_id": np.repeat([result[0] for result in all_results], n_beats).astype(np.int32),
+            "session_id": np.repeat([result[1] for result in all_results], n_beats).astype(np.int16),
+            "r_peak_index": np.concatenate([beats["r_peak_index"] for _, _, beats in all_results]),
+            "r_peak_time": np.concatenate([beats["r_peak_time"] for _, _, beats in all_results]),
+            "RR": np.concatenate([beats["RR"] for _, _, beats in all_results]),
+            "HR": np.concatenate([beats["HR"] for _, _, beats in all_results]),
+        }
+    )
+
+
+@instrumented
+def process_ppg_folder(
+    PPG_data_path: str,
+    final_data_path: str,
+    cache_dir: str | None = None,
+    n_workers: int = 1,
+    block_seconds: float | None = None,
+    sink: str = "excel",
+) -> None:
+    """Processes all PPG files in the specified folder, extracts R-peaks, calculates HR,
+    and saves the results in a single table.
+
+    The beats of every recording are handed to the output sink as soon as the recording is processed.
+    Except for the Excel sink, which can only write the finished table, they are appended to the output
+    right away, so the memory use does not grow with the number of recordings.
+
+    Args:
+        PPG_data_path (str): Path to the folder containing PPG files.
+        final_data_path (str): Folder where the R-peaks and HR table is saved.
+        cache_dir (str | None): Folder of the binary PPG cache. When given, recordings are
+            memory-mapped from the cache instead of parsing the CSV files.
+        n_workers (int): Number of worker processes. With more than one worker the files are
+            processed in parallel; the output is sorted by participant and session either way.
+        block_seconds (float | None): If given, peaks are detected block by block with
+            ``rpeaks_from_ppg_chunked``, which keeps the memory use of long recordings bounded
+            when they are read from the binary cache.
+        sink (str): Output format, one of ``BEAT_SINKS``: "excel" (R-peaks_and_HR.xlsx, limited to
+            about a million beats), "csv" (gzip-compressed), "sqlite", or the "parquet" and "feather"
+            datasets partitioned by participant, which need pyarrow.
+    """
+    beat_sink = open_beat_sink(sink, final_data_path)
+    file_names = list_ppg_files(PPG_data_path)
+
+    # Results come back in file order, so the output is deterministic
+    failed = 0
+    for result in iter_beats(PPG_data_path, file_names, cache_dir, n_workers, block_seconds):
+        if result[3] is not None:
+            print(result[3])
+            failed += 1
+            continue
+        with stage("write_beats"):
+            beat_sink.write(build_beat_table([result]))
+
+    with stage("write_beats"):
+        beat_sink.close()
+    record(rows=beat_sink.rows, files=len(file_names), failed=failed)
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import pandas as pd
+
+from functions.clearing_data.aggregate_cube import AggregateCube
+from functions.clearing_data.beat_sinks import read_beat_table
+from functions.pipeline.instrumentation import instrumented, record, stage
+
+DATASET_FILE_NAME = "analysis_dataset.sqlite"
+
+
+class AnalysisDataset:
+    """The combined trial table and the beat table of a run, loaded once and shared by every
+    cleaning stage and analysis.
+
+    The tables are persisted in a single SQLite file, which is much faster to read and write
+    than the Excel files; those are only written on request by ``export_excel``.
+
+    Attributes:
+        trials (pd.DataFrame): Combined trial data, one row per trial.
+        beats (pd.DataFrame | None): R-peaks and HR, one row per beat.
+        cube (AggregateCube | None): Aggregates of the measures per participant, session and music
+            type, kept up to date by the pipeline.
+    """
+
+    def __init__(self, trials: pd.DataFrame, beats: pd.DataFrame | None = None, cube: AggregateCube | None = None):
+        self.trials = trials
+        self.beats = beats
+        self.cube = cube
+
+    @classmethod
+    @instrumented
+    def load(cls, store_path: str) -> "AnalysisDataset":
+        """Loads the dataset from its SQLite store.
+
+        Args:
+            store_path (str): Path to the SQLite file written by ``save``.
+
+        Returns:
+            AnalysisDataset: The loaded dataset.
+        """
+        with closing(sqlite3.connect(store_path)) as connection:
+            tables = set(pd.read_sql("SELECT name FROM sqlite_master WHERE type = 'table'", connection)["name"])
+            trials = pd.read_sql("SELECT * FROM trials", connection) if "trials" in tables else pd.DataFrame()
+            beats = pd.read_sql("SELECT * FROM beats", connection) if "beats" in tables else None
+            cube = AggregateCube(pd.read_sql("SELECT * FROM cube", connection)) if "cube" in tables else None
+        record(rows=len(trials) + (len(beats) if beats is not None else 0), files=1)
+        return cls(trials, beats, cube)
+
+    @classmethod
+    def from_excel(cls, combined_data_file: str, R_peak_data_path: str | None = None) -> "AnalysisDataset":
+        """Loads the dataset from the Excel files written by the file-based cleaning functions.
+
+        Args:
+            combined_data_file (str): Path to the combined trial data Excel file.
+            R_peak_data_path (str | None): Path to the R-peaks and HR Excel file, if available.
+
+        Returns:
+            AnalysisDataset: The loaded dataset.
+        """
+        beats = pd.read_excel(R_peak_data_path) if R_peak_data_path else None
+        return cls(pd.read_excel(combined_data_file), beats)
+
+    @classmethod
+    def merge(cls, datasets: list["AnalysisDataset"]) -> "AnalysisDataset":
+        """Combines datasets of disjoint sets of participants, e.g. the shards of a cohort.
+
+        Trials and beats are ordered by participant, keeping the order within every participant, so the
+        tables equal those of a single run over all participants. The cubes are merged from their sums.
+
+        Args:
+            datasets (list[AnalysisDataset]): The datasets to combine.
+
+        Returns:
+            AnalysisDataset: The merged dataset.
+
+        Raises:
+            ValueError: If a participant is part of more than one dataset.
+        """
+        seen = set()
+        for dataset in datasets:
+            participant_ids = set(dataset.trials.get("participant_id", []))
+            if dataset.beats is not None:
+                participant_ids.update(dataset.beats["participant_id"])
+            if seen & participant_ids:
+                raise ValueError(f"Participants {sorted(seen & participant_ids)} are part of more than one dataset.")
+            seen |= participant_ids
+
+        def combine(tables):
+            tables = [table for table in tables if table is not None and len(table.columns)]
+            if not tables:
+                return None
+            # Columns in the order of the most complete table, e.g. one with IS values
+            columns = list(max(tables, key=lambda table: len(table.columns)).columns)
+            columns += [col for table in tables for col in table.columns if col not in columns]
+            combined = pd.concat(tables, ignore_index=True).loc[:, list(dict.fromkeys(columns))]
+            return combined.sort_values("participant_id", kind="stable", ignore_index=True)
+
+        trials = combine([dataset.trials for dataset in datasets])
+        cubes = [dataset.cube for dataset in datasets if dataset.cube is not None]
+        return cls(
+            trials if trials is not None else pd.DataFrame(),
+            combine([dataset.beats for dataset in datasets]),
+            AggregateCube.merge(cubes) if cubes else None,
+        )
+
+    @instrumented
+    def save(self, store_path: str) -> None:
+        """Writes the dataset to its SQLite store, replacing the previous content.
+
+        Args:
+            store_path (str): Path to the SQLite file.
+        """
+        # Write to a temporary file first so an interrupted run never leaves a half-written store
+        tmp_path = Path(str(store_path) + ".tmp")
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+        with closing(sqlite3.connect(tmp_path)) as connection:
+            self.trials.to_sql("trials", connection, index=False)
+            if self.beats is not None:
+                self.beats.to_sql("beats", connection, index=False)
+            if self.cube is not None:
+                self.cube.cells.to_sql("cube", connection, index=False)
+            connection.commit()
+        os.replace(tmp_path, store_path)
+
+    @instrumented
+    def export_excel(self, final_data_path: str) -> None:
+        """Exports the tables to combined_data_trial.xlsx and R-peaks_and_HR.xlsx.
+
+        Args:
+            final_data_path (str): Folder where the Excel files are saved.
+        """
+        self.trials.to_excel(Path(final_data_path) / "combined_data_trial.xlsx", index=False)
+        if self.beats is not None:
+            self.beats.to_excel(Path(final_data_path) / "R-peaks_and_HR.xlsx", index=False)
+        print("Dataset exported to the combined_data_trial and R-peaks_and_HR excel files.")
+
+
+def load_trial_table(source) -> pd.DataFrame:
+    """Returns the trial table of a dataset, or reads it from the combined data Excel file.
+
+    Args:
+        source (str | AnalysisDataset): A loaded dataset or the path to the combined data file.
+
+    Returns:
+        pd.DataFrame: The combined trial data.
+    """
+    if isinstance(source, AnalysisDataset):
+        return source.trials
+    with stage("read_excel"):
+        return pd.read_excel(source)
+
+
+def load_beat_table(source, participant_ids=None) -> pd.DataFrame:
+    """Returns the beat table of a dataset, or reads it from the output of ``process_ppg_folder``.
+
+    Args:
+        source (str | AnalysisDataset): A loaded dataset or the path to the R-peaks file or dataset folder.
+        participant_ids (array-like | None): Participants whose beats are needed, by default all. Only
+            their partitions are read from a partitioned dataset; a loaded dataset is returned whole.
+
+    Returns:
+        pd.DataFrame: R-peaks and HR, one row per beat.
+    """
+    if isinstance(source, AnalysisDataset):
+        if source.beats is None:
+            raise ValueError("The dataset does not contain a beat table.")
+        return source.beats
+    with stage("read_beats"):
+        return read_beat_table(source, participant_ids)
+
+
+def load_cube(source, trials: pd.DataFrame, beats: pd.DataFrame | None = None) -> AggregateCube:
+    """Returns the aggregate cube stored with a dataset, or builds it from the given tables.
+
+    Args:
+        source (str | AnalysisDataset): A loaded dataset or the path the tables were read from.
+        trials (pd.DataFrame): The trial table of the source.
+        beats (pd.DataFrame | None): The beat table, if the HR is needed.
+
+    Returns:
+        AggregateCube: The aggregates of the measures.
+    """
+    if isinstance(source, AnalysisDataset) and source.cube is not None:
+        return source.cube
+    return AggregateCube.from_tables(trials, beats)
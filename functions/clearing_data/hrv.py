@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+from functions.clearing_data.beat_trial_join import assign_beats_to_trials
+
+# Bump when the metrics change, so the results cached per recording are computed again
+HRV_VERSION = 1
+HRV_COLUMNS = ["n_intervals", "SDNN", "RMSSD", "pNN50", "LF", "HF", "LF_HF"]
+
+# Frequency bands of the spectral metrics in Hz, and the frequencies the periodogram is evaluated at
+LF_BAND = (0.04, 0.15)
+HF_BAND = (0.15, 0.4)
+HRV_FREQUENCIES = np.arange(8, 81) * 0.005
+
+# Fewest RR intervals of a window for the spectral metrics
+MIN_SPECTRAL_INTERVALS = 10
+
+# Beats per block of the periodogram, which bounds the size of its (beats x frequencies) arrays
+BLOCK_BEATS = 20_000
+
+# Largest gap in seconds between the end of an RR interval and the next beat for the two to be consecutive
+CONSECUTIVE_TOLERANCE = 1e-3
+
+
+def _band_weights(frequencies: np.ndarray, band: tuple[float, float]) -> np.ndarray:
+    """Returns the trapezoid weights that integrate a spectrum sampled at ``frequencies`` over a band."""
+    inside = (frequencies >= band[0] - 1e-9) & (frequencies <= band[1] + 1e-9)
+    weights = np.zeros(len(frequencies))
+    steps = np.diff(frequencies) * (inside[1:] & inside[:-1])
+    weights[1:] += steps / 2
+    weights[:-1] += steps / 2
+    return weights
+
+
+def lomb_scargle_windows(times: np.ndarray, values: np.ndarray, starts: np.ndarray, frequencies: np.ndarray):
+    """Lomb-Scargle periodogram of several series at once, equal to ``scipy.signal.lombscargle`` per series.
+
+    Args:
+        times (np.ndarray): Sample times in seconds, the series one after the other.
+        values (np.ndarray): Centered sample values.
+        starts (np.ndarray): Position of the first sample of every series.
+        frequencies (np.ndarray): Frequencies in Hz.
+
+    Returns:
+        np.ndarray: The periodogram, one row per series.
+    """
+    phase = np.multiply.outer(times, 2 * np.pi * frequencies)
+    cos, sin = np.cos(phase), np.sin(phase)
+    counts = np.diff(np.append(starts, len(times)))[:, None]
+
+    # Per-series sums of the terms of the periodogram, from which the time offset tau follows in closed form
+    y_cos = np.add.reduceat(values[:, None] * cos, starts, axis=0)
+    y_sin = np.add.reduceat(values[:, None] * sin, starts, axis=0)
+    cos_2 = np.add.reduceat(cos * cos - sin * sin, starts, axis=0)
+    sin_2 = np.add.reduceat(2 * sin * cos, starts, axis=0)
+    cos_cos, sin_sin, cos_sin = (counts + cos_2) / 2, (counts - cos_2) / 2, sin_2 / 2
+
+    tau = np.arctan2(sin_2, cos_2) / 2
+    c, s = np.cos(tau), np.sin(tau)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 0.5 * (
+            (c * y_cos + s * y_sin) ** 2 / (c**2 * cos_cos + 2 * c * s * cos_sin + s**2 * sin_sin)
+            + (c * y_sin - s * y_cos) ** 2 / (c**2 * sin_sin - 2 * c * s * cos_sin + s**2 * cos_cos)
+        )
+
+
+def window_hrv(
+    beat_times: np.ndarray, rr_intervals: np.ndarray, window: np.ndarray, n_windows: int
+) -> pd.DataFrame:
+    """Computes the HRV metrics of many windows at once from the RR intervals that start in them.
+
+    All windows are handled together with bincounts and segmented sums over the beats sorted by window,
+    so the cost does not depend on the number of windows. Successive differences are only taken between
+    consecutive beats, so gaps left by rejected intervals do not count.
+
+    Args:
+        beat_times (np.ndarray): Time of every beat in seconds.
+        rr_intervals (np.ndarray): Interval from every beat to the next one in seconds.
+        window (np.ndarray): Window of every beat, from 0 to n_windows - 1.
+        n_windows (int): Number of windows.
+
+    Returns:
+        pd.DataFrame: One row per window with n_intervals, SDNN and RMSSD (ms), pNN50 (%), the LF and HF
+        power (ms²) of the Lomb-Scargle spectrum of the RR series and LF_HF. Metrics that cannot be
+        computed from the intervals of a window are NaN.
+    """
+    order = np.lexsort((beat_times, window))
+    times, rr, window = beat_times[order], rr_intervals[order] * 1000, window[order]
+
+    n = np.bincount(window, minlength=n_windows)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(window, weights=rr, minlength=n_windows) / n
+        deviation = rr - mean[window]
+        sdnn = np.sqrt(np.bincount(window, weights=deviation**2, minlength=n_windows) / (n - 1))
+
+        consecutive = (window[1:] == window[:-1]) & (
+            np.abs(times[:-1] + rr[:-1] / 1000 - times[1:]) < CONSECUTIVE_TOLERANCE
+        )
+        differences = np.diff(rr)[consecutive]
+        difference_window = window[:-1][consecutive]
+        n_differences = np.bincount(difference_window, minlength=n_windows)
+        rmssd = np.sqrt(np.bincount(difference_window, weights=differences**2, minlength=n_windows) / n_differences)
+        pnn50 = 100 * np.bincount(difference_window, weights=np.abs(differences) > 50, minlength=n_windows)
+        pnn50 = pnn50 / n_differences
+
+    # Spectral metrics, for the windows with enough intervals, a block of windows at a time
+    lf, hf = np.full(n_windows, np.nan), np.full(n_windows, np.nan)
+    keep = (n >= MIN_SPECTRAL_INTERVALS)[window]
+    times, deviation, window = times[keep], deviation[keep], window[keep]
+    starts = np.flatnonzero(np.r_[True, window[1:] != window[:-1]]) if len(window) else np.array([], dtype=np.int64)
+    lf_weights, hf_weights = _band_weights(HRV_FREQUENCIES, LF_BAND), _band_weights(HRV_FREQUENCIES, HF_BAND)
+
+    block_of_window = starts // BLOCK_BEATS
+    block_starts = np.flatnonzero(np.r_[True, np.diff(block_of_window) > 0]) if len(starts) else []
+    for first, last in zip(block_starts, np.append(block_starts[1:], len(starts)).astype(np.int64)):
+        rows = slice(starts[first], starts[last] if last < len(starts) else len(window))
+        power = lomb_scargle_windows(
+            times[rows] - times[rows][0], deviation[rows], starts[first:last] - starts[first], HRV_FREQUENCIES
+        )
+        # One-sided power spectral density, which integrates to the variance of the series
+        windows = window[starts[first:last]]
+        density = 2 * power * (mean[windows] / 1000)[:, None]
+        lf[windows], hf[windows] = density @ lf_weights, density @ hf_weights
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pd.DataFrame(
+            {
+                "n_intervals": n,
+                "SDNN": np.where(n > 1, sdnn, np.nan),
+                "RMSSD": np.where(n_differences > 0, rmssd, np.nan),
+                "pNN50": np.where(n_differences > 0, pnn50, np.nan),
+                "LF": lf,
+                "HF": hf,
+                "LF_HF": lf / hf,
+            }
+        )
+
+
+def trial_hrv(beats: pd.DataFrame, trials: pd.DataFrame) -> pd.DataFrame:
+    """Computes the HRV metrics of the RR intervals that start inside the music window of every trial.
+
+    Args:
+        beats (pd.DataFrame): Beat table with participant_id, session_id, r_peak_time and RR columns.
+        trials (pd.DataFrame): Trial table with participant_id, session, PPG_music_start and
+            PPG_response_start columns.
+
+    Returns:
+        pd.DataFrame: The ``HRV_COLUMNS`` of ``window_hrv``, one row per trial in the order of ``trials``.
+    """
+    trial_of_beat = assign_beats_to_trials(beats, trials)
+    inside = trial_of_beat >= 0
+    window = trial_of_beat[inside]
+
+    # Times relative to the start of their window keep the phases of the periodogram precise
+    music_starts = trials["PPG_music_start"].to_numpy(dtype=np.float64)
+    beat_times = beats["r_peak_time"].to_numpy(dtype=np.float64)[inside] - music_starts[window]
+    rr_intervals = beats["RR"].to_numpy(dtype=np.float64)[inside]
+    return window_hrv(beat_times, rr_intervals, window, len(trials))
@@ -1,87 +1,298 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 from scipy.optimize import curve_fit
 
+from functions.clearing_data.loaders import FileIndex, file_key, read_table
+from functions.pipeline.instrumentation import instrumented, record, stage
+
+
+def gaussian(x, A, mu, sigma, b):
+    """Gaussian function for curve fitting."""
+    return A * np.exp(-((x - mu) ** 2) / (2 * sigma**2)) + b
+
+
+def gaussian_jacobian(x, A, mu, sigma, b):
+    """Analytic Jacobian of the Gaussian function with respect to (A, mu, sigma, b)."""
+    exponential = np.exp(-((x - mu) ** 2) / (2 * sigma**2))
+    return np.column_stack(
+        [
+            exponential,
+            A * exponential * (x - mu) / sigma**2,
+            A * exponential * (x - mu) ** 2 / sigma**3,
+            np.ones_like(x),
+        ]
+    )
+
+
+# Bounds and default initial guess of the Gaussian fit
+GAUSSIAN_BOUNDS = ([0, 0, 0, -1], [1, 1, 1, 1])
+GAUSSIAN_P0 = [0.5, 0.5, 0.1, 0]
 
-def calculate_is(HBD_data_path: str, combined_data_file: str):
-    """Calculates Interoceptive Sensitivity (IS) for each participant using the Heartbeat Discrimination Test data
-    and updates the combined Excel file.
+
+def _fit_is(
+    normalized_delays: np.ndarray, sync_ratios: np.ndarray, p0: list[float] = GAUSSIAN_P0
+) -> tuple[float, bool]:
+    """Fits the Gaussian with its analytic Jacobian and derives the IS value.
+
+    ``participant_is`` and ``compute_is_values_batch`` both fit through here, so a participant gets
+    the same IS value either way unless the batch fits are warm-started from another guess.
+
+    Returns:
+        tuple[float, bool]: The IS value (NaN if it cannot be derived) and whether the fit failed, which
+        the callers report.
+    """
+    try:
+        popt, _ = curve_fit(
+            gaussian, normalized_delays, sync_ratios, p0=p0, bounds=GAUSSIAN_BOUNDS, jac=gaussian_jacobian
+        )
+    except RuntimeError:
+        return np.nan, True
+
+    A = popt[0]
+    return (1 - A if 0 < A < 1 else np.nan), False
+
+
+def participant_is(HBD_data_path: str, file: str) -> tuple[int | None, float | None]:
+    """Calculates the Interoceptive Sensitivity (IS) of one participant from their HBD file.
 
     Args:
         HBD_data_path (str): Path to the folder containing Heartbeat Discrimination Test CSV files.
-        combined_data_file (str): Path to the combined Excel file to update.
+        file (str): Name of the participant's HBD file.
+
+    Returns:
+        tuple[int | None, float | None]: The participant ID and IS value. The IS value is NaN if no
+        Gaussian could be fitted and None if the participant has to be skipped altogether.
     """
+    # Extract participant ID from file name
+    key = file_key(file, "hbd")
+    if key is None:
+        print(f"Could not extract participant ID from file name: {file}. Skipping.")
+        return None, None
+    participant_id = key[0]
 
-    def gaussian(x, A, mu, sigma, b):
-        """Gaussian function for curve fitting."""
-        return A * np.exp(-((x - mu) ** 2) / (2 * sigma**2)) + b
+    # Load HBD data
+    with stage("read_csv"):
+        hbd_data = read_table(os.path.join(HBD_data_path, file), "hbd")
 
-    # Load combined data
-    combined_data = pd.read_excel(combined_data_file)
+    # Extract resting RRI
+    resting_rri = hbd_data["resting_RRI"].dropna().iloc[0] if not hbd_data["resting_RRI"].isna().all() else None
+    if resting_rri is None or resting_rri <= 0:
+        print(f"Invalid or missing resting RRI for participant {participant_id}. Skipping.")
+        return participant_id, None
+
+    # Convert resting RRI to milliseconds
+    resting_rri_ms = resting_rri * 1000
+    hbd_data["response"] = hbd_data["response"].map({"Sync": 1, "Async": 0})
+
+    if hbd_data["response"].isnull().any():
+        print(f"Invalid responses for participant {participant_id}. Skipping.")
+        return participant_id, None
+
+    # Calculate normalized delays
+    hbd_data["normalized_delay"] = hbd_data["delay"] / resting_rri_ms
+
+    # Calculate sync ratios for each normalized delay
+    normalized_delays = hbd_data["normalized_delay"].unique()
+    sync_ratios = [hbd_data[hbd_data["normalized_delay"] == delay]["response"].mean() for delay in normalized_delays]
+
+    # Skip if no valid sync_ratios or all values are identical
+    if not sync_ratios or len(set(sync_ratios)) == 1:
+        print(f"No valid or varying sync_ratios for participant {participant_id}. Skipping.")
+        return participant_id, np.nan
+
+    # Fit Gaussian function to calculate IS
+    with stage("curve_fit"):
+        IS_value, failed = _fit_is(normalized_delays[: len(sync_ratios)], np.asarray(sync_ratios))
+    if failed:
+        print(f"Gaussian fitting failed for participant {participant_id}. Setting IS to NaN.")
+
+    return participant_id, IS_value
+
+
+def apply_is_values(combined_data: pd.DataFrame, is_values: dict) -> None:
+    """Writes IS values into the combined data.
+
+    Args:
+        combined_data (pd.DataFrame): Combined trial data, updated in place.
+        is_values (dict): IS value per participant ID.
+    """
+    if not is_values:
+        return
+
+    # Map all participants at once; rows of participants without a new value keep their IS
+    participant_ids = combined_data["participant_id"]
+    current_values = combined_data["IS"] if "IS" in combined_data.columns else np.nan
+    combined_data["IS"] = participant_ids.map(is_values).where(participant_ids.isin(list(is_values)), current_values)
+
+
+@instrumented
+def compute_is_values(HBD_data_path: str, file_index: FileIndex | None = None) -> dict:
+    """Calculates the IS value of every participant with a usable HBD file.
 
+    Args:
+        HBD_data_path (str): Path to the folder containing Heartbeat Discrimination Test CSV files.
+        file_index (FileIndex | None): The scanned HBD folder, scanned here if not given.
+
+    Returns:
+        dict: IS value per participant ID.
+    """
     # List all HBD files
-    hbd_files = [file for file in os.listdir(HBD_data_path) if file.endswith(".csv")]
+    hbd_files = (file_index or FileIndex.scan(HBD_data_path, "hbd")).files
 
+    is_values = {}
     for file in hbd_files:
-        # Extract participant ID from file name
-        try:
-            participant_id = int(file.split("_")[0].split("-")[1])
-        except ValueError:
+        participant_id, IS_value = participant_is(HBD_data_path, file)
+        if IS_value is not None:
+            is_values[participant_id] = IS_value
+
+    n_failed = sum(np.isnan(IS_value) for IS_value in is_values.values())
+    record(rows=len(is_values), files=len(hbd_files), skipped=len(hbd_files) - len(is_values), failed=n_failed)
+    return is_values
+
+
+@instrumented
+def compute_is_values_batch(
+    HBD_data_path: str, n_workers: int = 1, warm_start: bool = False, file_index: FileIndex | None = None
+) -> dict:
+    """Calculates the IS value of every participant with a usable HBD file, all participants at once.
+
+    The HBD files are combined into one table, the sync ratios of all participants are computed in
+    a single groupby, and the Gaussian fits run on a process pool. Every fit is the one of
+    ``participant_is``, with the analytic Jacobian from the default guess.
+
+    Args:
+        HBD_data_path (str): Path to the folder containing Heartbeat Discrimination Test CSV files.
+        n_workers (int): Number of worker processes for the fits.
+        warm_start (bool): If True, the initial guess of every fit is the Gaussian fitted to the pooled
+            sync ratios of the whole cohort instead of the fixed default guess. With few delay levels
+            several Gaussians often fit a participant equally well, and a fit from another guess can
+            end on another one of them, so the IS values can differ from those of ``participant_is``.
+        file_index (FileIndex | None): The scanned HBD folder, scanned here if not given.
+
+    Returns:
+        dict: IS value per participant ID.
+    """
+    # Load all HBD files into one table, reading them on a thread pool
+    file_index = file_index or FileIndex.scan(HBD_data_path, "hbd")
+    hbd_files = file_index.files
+    for file in hbd_files:
+        if file_index.participant_id(file) is None:
             print(f"Could not extract participant ID from file name: {file}. Skipping.")
-            continue
 
-        # Load HBD data
-        hbd_data = pd.read_csv(os.path.join(HBD_data_path, file))
+    named_files = [file for file in hbd_files if file_index.participant_id(file) is not None]
+    with stage("read_csv"):
+        tables = file_index.read_all(n_workers=n_workers, file_names=named_files)
+    hbd_frames = [
+        hbd_data.assign(participant_id=file_index.participant_id(file))
+        for file, hbd_data in zip(named_files, tables)
+        if hbd_data is not None
+    ]
 
-        # Extract resting RRI
-        resting_rri = hbd_data["resting_RRI"].dropna().iloc[0] if not hbd_data["resting_RRI"].isna().all() else None
-        if resting_rri is None or resting_rri <= 0:
-            print(f"Invalid or missing resting RRI for participant {participant_id}. Skipping.")
-            continue
+    if not hbd_frames:
+        return {}
+    hbd_data = pd.concat(hbd_frames, ignore_index=True)
 
-        # Convert resting RRI to milliseconds
-        resting_rri_ms = resting_rri * 1000
-        hbd_data["response"] = hbd_data["response"].map({"Sync": 1, "Async": 0})
+    # Resting RRI and response validity of every participant in one pass
+    by_participant = hbd_data.groupby("participant_id", sort=False)
+    resting_rri = by_participant["resting_RRI"].first()
+    hbd_data["response"] = hbd_data["response"].map({"Sync": 1, "Async": 0})
+    invalid_responses = hbd_data["response"].isna().groupby(hbd_data["participant_id"], sort=False).any()
 
-        if hbd_data["response"].isnull().any():
+    valid_participants = []
+    for participant_id, rri in resting_rri.items():
+        if np.isnan(rri) or rri <= 0:
+            print(f"Invalid or missing resting RRI for participant {participant_id}. Skipping.")
+        elif invalid_responses[participant_id]:
             print(f"Invalid responses for participant {participant_id}. Skipping.")
-            continue
+        else:
+            valid_participants.append(participant_id)
 
-        # Calculate normalized delays
-        hbd_data["normalized_delay"] = hbd_data["delay"] / resting_rri_ms
+    hbd_data = hbd_data[hbd_data["participant_id"].isin(valid_participants)]
 
-        # Calculate sync ratios for each normalized delay
-        normalized_delays = hbd_data["normalized_delay"].unique()
-        sync_ratios = [
-            hbd_data[hbd_data["normalized_delay"] == delay]["response"].mean() for delay in normalized_delays
-        ]
-
-        # print(f"Normalized delays for participant {participant_id}: {normalized_delays}")
-        # print(f"Sync ratios for participant {participant_id}: {sync_ratios}")
+    # Calculate normalized delays and the sync ratio of every (participant, delay) pair
+    hbd_data = hbd_data.assign(
+        normalized_delay=hbd_data["delay"] / (hbd_data["participant_id"].map(resting_rri) * 1000)
+    )
+    sync_ratios = hbd_data.groupby(["participant_id", "normalized_delay"], sort=False)["response"].mean().reset_index()
 
-        # Skip if no valid sync_ratios or all values are identical
-        if not sync_ratios or len(set(sync_ratios)) == 1:
+    is_values = {}
+    fit_participants = []
+    for participant_id, ratios in sync_ratios.groupby("participant_id", sort=False)["response"]:
+        if ratios.nunique() == 1:
             print(f"No valid or varying sync_ratios for participant {participant_id}. Skipping.")
-            combined_data.loc[combined_data["participant_id"] == participant_id, "IS"] = np.nan
-            continue
+            is_values[participant_id] = np.nan
+        else:
+            fit_participants.append(participant_id)
+
+    fit_data = sync_ratios[sync_ratios["participant_id"].isin(fit_participants)]
+    groups = list(fit_data.groupby("participant_id", sort=False))
+    delays = [group["normalized_delay"].to_numpy() for _, group in groups]
+    ratios = [group["response"].to_numpy() for _, group in groups]
 
-        # Fit Gaussian function to calculate IS
+    p0 = GAUSSIAN_P0
+    if warm_start and fit_participants:
+        # Start every fit from the curve of the whole cohort, kept strictly inside the bounds
         try:
-            bounds = ([0, 0, 0, -1], [1, 1, 1, 1])
             popt, _ = curve_fit(
-                gaussian, normalized_delays[: len(sync_ratios)], sync_ratios, p0=[0.5, 0.5, 0.1, 0], bounds=bounds
+                gaussian,
+                fit_data["normalized_delay"].to_numpy(),
+                fit_data["response"].to_numpy(),
+                p0=GAUSSIAN_P0,
+                bounds=GAUSSIAN_BOUNDS,
+                jac=gaussian_jacobian,
             )
-            A, mu, sigma, b = popt
-            IS_value = 1 - A if 0 < A < 1 else np.nan
+            p0 = list(np.clip(popt, np.array(GAUSSIAN_BOUNDS[0]) + 1e-3, np.array(GAUSSIAN_BOUNDS[1]) - 1e-3))
         except RuntimeError:
-            IS_value = np.nan
+            print("Gaussian fitting failed for the cohort. Using the default initial guess.")
+
+    p0s = [p0] * len(fit_participants)
+    with stage("curve_fit"):
+        if n_workers > 1 and len(fit_participants) > 1:
+            with ProcessPoolExecutor(max_workers=min(n_workers, len(fit_participants))) as executor:
+                fits = list(executor.map(_fit_is, delays, ratios, p0s, chunksize=16))
+        else:
+            fits = list(map(_fit_is, delays, ratios, p0s))
+
+    for (participant_id, _), (IS_value, failed) in zip(groups, fits):
+        if failed:
             print(f"Gaussian fitting failed for participant {participant_id}. Setting IS to NaN.")
+        is_values[participant_id] = IS_value
+
+    n_failed = sum(np.isnan(IS_value) for IS_value in is_values.values())
+    record(rows=len(is_values), files=len(hbd_files), skipped=len(hbd_files) - len(is_values), failed=n_failed)
+    return is_values
+
+
+@instrumented
+def calculate_is(
+    HBD_data_path: str, combined_data_file: str, batch: bool = False, n_workers: int = 1, warm_start: bool = False
+):
+    """Calculates Interoceptive Sensitivity (IS) for each participant using the Heartbeat Discrimination Test data
+    and updates the combined Excel file.
+
+    Args:
+        HBD_data_path (str): Path to the folder containing Heartbeat Discrimination Test CSV files.
+        combined_data_file (str): Path to the combined Excel file to update.
+        batch (bool): If True, all participants are processed together by ``compute_is_values_batch``.
+        n_workers (int): Number of worker processes for the fits in batch mode.
+        warm_start (bool): In batch mode, start every fit from the Gaussian fitted to the whole cohort.
+    """
+    # Load combined data
+    with stage("read_excel"):
+        combined_data = pd.read_excel(combined_data_file)
+
+    if batch:
+        is_values = compute_is_values_batch(HBD_data_path, n_workers, warm_start)
+    else:
+        is_values = compute_is_values(HBD_data_path)
 
-        # Update IS value in the combined data
-        combined_data.loc[combined_data["participant_id"] == participant_id, "IS"] = IS_value
+    # Update IS values in the combined data
+    apply_is_values(combined_data, is_values)
 
     # Save updated combined data
-    combined_data.to_excel(combined_data_file, index=False)
+    with stage("write_excel"):
+        combined_data.to_excel(combined_data_file, index=False)
     print("Calculation complete. IS values have been added to the combined_data_trial file.")
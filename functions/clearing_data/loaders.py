@@ -0,0 +1,206 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    # Parses CSV files on several threads and without holding the GIL
+    import pyarrow  # noqa: F401
+
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+PPG_FILE_PATTERN = r"sub-(\d+)_sess(\d+)_PPG.csv"
+
+
+class FileSchema:
+    """Naming pattern, file types and column types of one kind of input file.
+
+    Attributes:
+        pattern (str): Regular expression matched against the start of a file name. Its groups are
+            the participant ID and, for PPG recordings, the session.
+        extensions (tuple[str, ...]): File types of the kind.
+        dtypes (dict): Type of every known column.
+        columns (list[str]): Columns read by default.
+    """
+
+    __slots__ = ("pattern", "extensions", "dtypes", "columns")
+
+    def __init__(self, pattern: str, extensions: tuple[str, ...], dtypes: dict, columns: list[str]):
+        self.pattern = pattern
+        self.extensions = extensions
+        self.dtypes = dtypes
+        self.columns = columns
+
+
+SCHEMAS = {
+    # Session is read as float so that missing values can be dropped before it is turned into an integer
+    "trial": FileSchema(
+        r"sub-(\d+)",
+        (".csv", ".xlsx"),
+        {
+            "session": "float64",
+            "music_type": "object",
+            "valence_rating": "float64",
+            "RT": "float64",
+            "PPG_music_start": "float64",
+            "PPG_response_start": "float64",
+            "PPG_ITI_start": "float64",
+        },
+        ["session", "music_type", "valence_rating", "RT", "PPG_music_start", "PPG_response_start"],
+    ),
+    "hbd": FileSchema(
+        r"sub-(\d+)_",
+        (".csv",),
+        {"delay": "float64", "response": "object", "confidence": "float64", "resting_RRI": "float64"},
+        ["delay", "response", "resting_RRI"],
+    ),
+    "ppg": FileSchema(PPG_FILE_PATTERN, (".csv",), {"time": "float64", "PPG": "float32"}, ["PPG"]),
+}
+
+
+def file_key(file_name: str, kind: str) -> tuple[int, ...] | None:
+    """Returns the participant ID (and session, for PPG recordings) in a file name, or None."""
+    match = re.match(SCHEMAS[kind].pattern, file_name)
+    return tuple(int(group) for group in match.groups()) if match else None
+
+
+def read_table(
+    file_path: str, kind: str, columns: list[str] | None = None, optional_columns: list[str] = ()
+) -> pd.DataFrame:
+    """Reads the given columns of an input file with the types declared by its schema.
+
+    Args:
+        file_path (str): Path to a CSV or Excel file.
+        kind (str): "trial", "hbd" or "ppg".
+        columns (list[str] | None): Required columns, by default those of the schema.
+        optional_columns (list[str]): Columns that are read if the file has them.
+
+    Returns:
+        pd.DataFrame: The columns that were found, in the order of the file. Values of numeric
+        columns that cannot be parsed are NaN.
+
+    Raises:
+        ValueError: If a required column is missing.
+    """
+    schema = SCHEMAS[kind]
+    columns = list(schema.columns if columns is None else columns)
+    wanted = columns + [col for col in optional_columns if col not in columns]
+    dtypes = {col: schema.dtypes[col] for col in wanted if col in schema.dtypes}
+    is_excel = str(file_path).endswith(".xlsx")
+
+    if len(wanted) == len(columns):
+        usecols = columns
+    elif is_excel or CSV_ENGINE == "c":
+        usecols = set(wanted).__contains__
+    else:
+        # The pyarrow engine only accepts a list of existing columns, so all columns are read
+        usecols = None
+
+    def read(dtype):
+        if is_excel:
+            return pd.read_excel(file_path, usecols=usecols, dtype=dtype)
+        return pd.read_csv(file_path, usecols=usecols, dtype=dtype, engine=CSV_ENGINE)
+
+    try:
+        data = read(dtypes)
+    except (KeyError, ValueError):
+        # Either a required column is missing (a KeyError with pyarrow) or a value does not match its type
+        try:
+            data = read(None)
+        except (KeyError, ValueError):
+            data = None
+        if data is not None:
+            for col, dtype in dtypes.items():
+                if col in data.columns and dtype != "object":
+                    data[col] = pd.to_numeric(data[col], errors="coerce").astype(dtype)
+
+    if data is None or not all(col in data.columns for col in columns):
+        raise ValueError(f"File {Path(file_path).name} is missing one or more required columns: {columns}")
+    return data if usecols is not None else data.loc[:, [col for col in data.columns if col in wanted]]
+
+
+class FileIndex:
+    """The input files of one kind in a folder, found with a single directory scan.
+
+    Files are ordered by participant ID, session and name; files whose name does not match the
+    pattern of the schema come last and have no key.
+
+    Attributes:
+        folder (str): The scanned folder.
+        kind (str): "trial", "hbd" or "ppg".
+        files (list[str]): The file names.
+        keys (dict): (participant_id,) or (participant_id, session) of every matching file name.
+    """
+
+    def __init__(self, folder: str, kind: str, file_names: list[str]):
+        self.folder = folder
+        self.kind = kind
+        self.keys = {}
+        for file_name in file_names:
+            key = file_key(file_name, kind)
+            if key is not None:
+                self.keys[file_name] = key
+        self.files = sorted(
+            file_names, key=lambda name: (0, *self.keys[name], name) if name in self.keys else (1, name)
+        )
+        self._by_key = {key: file_name for file_name, key in self.keys.items()}
+
+    @classmethod
+    def scan(cls, folder: str, kind: str) -> "FileIndex":
+        """Lists the files of a folder that have one of the file types of the kind."""
+        extensions = SCHEMAS[kind].extensions
+        return cls(folder, kind, [file_name for file_name in os.listdir(folder) if file_name.endswith(extensions)])
+
+    def subset(self, participant_ids) -> "FileIndex":
+        """Returns the index of the files of the given participants, e.g. ``range(1, 51)``.
+
+        Files whose name does not match the pattern are left out, since they have no participant ID.
+        """
+        file_names = [file_name for file_name in self.files if self.participant_id(file_name) in participant_ids]
+        return FileIndex(self.folder, self.kind, file_names)
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def path(self, file_name: str) -> str:
+        """Returns the path of a file of the index."""
+        return os.path.join(self.folder, file_name)
+
+    def participant_id(self, file_name: str) -> int | None:
+        """Returns the participant ID in a file name, or None if the name does not match the pattern."""
+        key = self.keys.get(file_name)
+        return key[0] if key else None
+
+    def find(self, *key: int) -> str | None:
+        """Returns the file of a participant (and session), or None if there is none."""
+        return self._by_key.get(tuple(key))
+
+    def read_all(
+        self, columns: list[str] | None = None, n_workers: int | None = None, file_names: list[str] | None = None
+    ) -> list[pd.DataFrame | None]:
+        """Reads the given columns of every file of the index on a thread pool.
+
+        Args:
+            columns (list[str] | None): Required columns, by default those of the schema.
+            n_workers (int | None): Number of reading threads, by default chosen by the thread pool.
+            file_names (list[str] | None): Files to read, by default all files of the index.
+
+        Returns:
+            list[pd.DataFrame | None]: The tables in the order of the files; None for files that are
+            missing a required column, which is reported.
+        """
+        file_names = self.files if file_names is None else file_names
+
+        def read(file_name):
+            try:
+                return read_table(self.path(file_name), self.kind, columns)
+            except ValueError as e:
+                print(e)
+                return None
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(read, file_names))
@@ -0,0 +1,232 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks, peak_prominences
+
+from functions.clearing_data.calc_r_peaks_from_ppg import (
+    HR_LIMITS,
+    MIN_PEAK_DISTANCE,
+    PPG_BAND,
+    PROMINENCE_FACTOR,
+    RR_LIMITS,
+    calculate_hr,
+    filter_ppg,
+)
+from functions.clearing_data.loaders import file_key
+from functions.clearing_data.ppg_cache import list_ppg_files, load_ppg_recording
+from functions.pipeline.instrumentation import instrumented, record, stage
+
+PARAMETER_COLUMNS = [
+    "band_low",
+    "band_high",
+    "prominence_factor",
+    "min_distance",
+    "rr_min",
+    "rr_max",
+    "hr_min",
+    "hr_max",
+]
+SUMMARY_COLUMNS = ["n_peaks", "n_beats", "valid_fraction", "mean_hr", "median_hr", "sd_hr"]
+
+
+def parse_limits(text: str) -> tuple[float, float]:
+    """Parses a pair of limits such as "0.5-5" into (0.5, 5.0)."""
+    low, _, high = text.partition("-")
+    try:
+        limits = float(low), float(high)
+    except ValueError:
+        raise ValueError(f"Invalid limits {text}, expected e.g. 0.5-5.") from None
+    if limits[0] >= limits[1]:
+        raise ValueError(f"Invalid limits {text}, the lower limit must be below the upper one.")
+    return limits
+
+
+def parameter_grid(
+    bands=(PPG_BAND,),
+    prominence_factors=(PROMINENCE_FACTOR,),
+    min_distances=(MIN_PEAK_DISTANCE,),
+    rr_limits=(RR_LIMITS,),
+    hr_limits=(HR_LIMITS,),
+) -> pd.DataFrame:
+    """Builds every combination of the given peak-detection settings.
+
+    Args:
+        bands: Pass bands of the filter in Hz, as (low, high) pairs.
+        prominence_factors: Prominence thresholds relative to the maximum of the filtered signal.
+        min_distances: Minimum times between peaks in seconds.
+        rr_limits: Limits of the valid RR intervals in seconds, as (min, max) pairs.
+        hr_limits: Limits of the valid HR in bpm, as (min, max) pairs.
+
+    Returns:
+        pd.DataFrame: One row per parameter set, numbered by the parameter_set column, with the
+        ``PARAMETER_COLUMNS``.
+    """
+    combinations = itertools.product(bands, prominence_factors, min_distances, rr_limits, hr_limits)
+    grid = pd.DataFrame(
+        [(*band, factor, distance, *rr, *hr) for band, factor, distance, rr, hr in combinations],
+        columns=PARAMETER_COLUMNS,
+    ).astype(np.float64)
+    grid.insert(0, "parameter_set", np.arange(len(grid)))
+    return grid
+
+
+def _hr_summary(r_peaks: np.ndarray, sample_rate: float, rr_limits: tuple, hr_limits: tuple) -> tuple:
+    """Returns the ``SUMMARY_COLUMNS`` of the valid HR values of the given peaks, NaN if there are none."""
+    _, hr_values, valid = calculate_hr(r_peaks, sample_rate, rr_limits, hr_limits)
+    hr_values = hr_values[valid]
+    return (
+        len(r_peaks),
+        len(hr_values),
+        len(hr_values) / (len(r_peaks) - 1) if len(r_peaks) > 1 else np.nan,
+        hr_values.mean() if len(hr_values) else np.nan,
+        np.median(hr_values) if len(hr_values) else np.nan,
+        hr_values.std(ddof=1) if len(hr_values) > 1 else np.nan,
+    )
+
+
+def _nest_parameter_sets(grid: pd.DataFrame) -> dict:
+    """Groups the parameter sets as {band: {min_distance: {prominence_factor: [(parameter_set, rr, hr)]}}}."""
+    nested = {}
+    for row in grid[["parameter_set"] + PARAMETER_COLUMNS].itertuples(index=False, name=None):
+        parameter_set, band_low, band_high, factor, distance, rr_min, rr_max, hr_min, hr_max = row
+        limits = nested.setdefault((band_low, band_high), {}).setdefault(distance, {}).setdefault(factor, [])
+        limits.append((int(parameter_set), (rr_min, rr_max), (hr_min, hr_max)))
+    return nested
+
+
+def _sweep_recording(PPG_data_path: str, file_name: str, cache_dir: str | None, parameter_sets: dict) -> tuple:
+    """Detects the peaks of a single PPG file with every parameter set.
+
+    The recording is read once and filtered once per band, and the prominences of all local maxima of
+    the filtered signal are computed once per band. ``find_peaks`` applies the minimum distance before
+    the prominence, so the peaks of a parameter set are the maxima left by the distance whose
+    prominence reaches the threshold, exactly as if ``find_peaks`` was called with both.
+
+    Args:
+        PPG_data_path (str): Path to the folder containing PPG files.
+        file_name (str): Name of the PPG file.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        parameter_sets (dict): Parameter sets as nested by ``_nest_parameter_sets``.
+
+    Returns:
+        tuple: (rows, message), where rows holds the parameter_set, participant_id, session_id and the
+        ``SUMMARY_COLUMNS`` of every parameter set. rows is None if the file could not be processed, and
+        message says why; ``sweep_folder`` prints it.
+    """
+    try:
+        key = file_key(file_name, "ppg")
+        if key is None:
+            return None, f"File name does not match expected pattern: {file_name}"
+
+        participant_id, session_id = key
+
+        with stage("read_ppg"):
+            recording = load_ppg_recording(os.path.join(PPG_data_path, file_name), cache_dir)
+        ppg_signal, sample_rate = recording.signal, recording.sample_rate
+
+        rows = []
+        with stage("detect_peaks"):
+            for band, distances in parameter_sets.items():
+                filtered_data = filter_ppg(ppg_signal, sample_rate, band)
+                signal_max = filtered_data.max()
+                maxima, _ = find_peaks(filtered_data)
+                prominences = peak_prominences(filtered_data, maxima)[0]
+
+                for min_distance, factors in distances.items():
+                    candidates, _ = find_peaks(filtered_data, distance=int(sample_rate * min_distance))
+                    candidate_prominences = prominences[np.searchsorted(maxima, candidates)]
+
+                    for factor, limits in factors.items():
+                        r_peaks = candidates[candidate_prominences >= signal_max * factor]
+                        for parameter_set, rr_limits, hr_limits in limits:
+                            summary = _hr_summary(r_peaks, sample_rate, rr_limits, hr_limits)
+                            rows.append((parameter_set, participant_id, session_id, *summary))
+        return rows, None
+
+    except Exception as e:
+        return None, f"Failed to process {file_name}: {e}"
+
+
+@instrumented
+def sweep_folder(
+    PPG_data_path: str, grid: pd.DataFrame, cache_dir: str | None = None, n_workers: int = 1
+) -> pd.DataFrame:
+    """Runs the peak detection of every PPG file in the folder with every parameter set of the grid.
+
+    Each file is read and filtered once per band, however many parameter sets the grid holds, so a
+    sweep over many prominence, distance and limit settings costs little more than a single run.
+
+    Args:
+        PPG_data_path (str): Path to the folder containing PPG files.
+        grid (pd.DataFrame): Parameter sets, as built by ``parameter_grid``.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        n_workers (int): Number of worker processes. With more than one worker the files are
+            processed in parallel.
+
+    Returns:
+        pd.DataFrame: One row per parameter set and recording with the parameter_set, the
+        ``PARAMETER_COLUMNS``, participant_id, session_id and the ``SUMMARY_COLUMNS``: the number of
+        peaks, the number of valid beats, their fraction of all beats, and the mean, median and
+        standard deviation of the valid HR values.
+    """
+    file_names = list_ppg_files(PPG_data_path)
+    folders = [PPG_data_path] * len(file_names)
+    cache_dirs = [cache_dir] * len(file_names)
+    parameter_sets = [_nest_parameter_sets(grid)] * len(file_names)
+
+    if n_workers > 1 and len(file_names) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(file_names))) as executor:
+            file_results = list(executor.map(_sweep_recording, folders, file_names, cache_dirs, parameter_sets))
+    else:
+        file_results = list(map(_sweep_recording, folders, file_names, cache_dirs, parameter_sets))
+
+    for _, message in file_results:
+        if message is not None:
+            print(message)
+
+    rows = [row for file_rows, _ in file_results if file_rows is not None for row in file_rows]
+    summaries = pd.DataFrame(rows, columns=["parameter_set", "participant_id", "session_id"] + SUMMARY_COLUMNS)
+    results = grid.merge(summaries, on="parameter_set", how="right")
+    results = results.sort_values(["parameter_set", "participant_id", "session_id"], ignore_index=True)
+    record(rows=len(results), files=len(file_names), failed=sum(message is not None for _, message in file_results))
+    return results
+
+
+def summarize_sweep(results: pd.DataFrame) -> pd.DataFrame:
+    """Pools the recordings of every parameter set of a sweep.
+
+    Args:
+        results (pd.DataFrame): Output of ``sweep_folder``.
+
+    Returns:
+        pd.DataFrame: One row per parameter set with its ``PARAMETER_COLUMNS``, the number of recordings
+        with valid beats, the number of valid beats, their fraction of all beats, the mean and standard
+        deviation of the HR over all valid beats, and the median of the recording medians.
+    """
+    beats = results["n_beats"].to_numpy(dtype=np.float64)
+    mean_hr = results["mean_hr"].fillna(0).to_numpy()
+    # Sums of the HR values and their squares per recording, from which the pooled statistics follow
+    pooled = results.assign(
+        recordings=beats > 0,
+        n_intervals=np.clip(results["n_peaks"] - 1, 0, None),
+        hr_sum=beats * mean_hr,
+        hr_sumsq=(beats - 1).clip(0) * results["sd_hr"].fillna(0).to_numpy() ** 2 + beats * mean_hr**2,
+    )
+    summary = pooled.groupby(["parameter_set"] + PARAMETER_COLUMNS).agg(
+        recordings=("recordings", "sum"),
+        n_beats=("n_beats", "sum"),
+        n_intervals=("n_intervals", "sum"),
+        hr_sum=("hr_sum", "sum"),
+        hr_sumsq=("hr_sumsq", "sum"),
+        median_hr=("median_hr", "median"),
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        summary["valid_fraction"] = summary["n_beats"] / summary["n_intervals"]
+        summary["mean_hr"] = summary["hr_sum"] / summary["n_beats"]
+        variance = (summary["hr_sumsq"] - summary["n_beats"] * summary["mean_hr"] ** 2) / (summary["n_beats"] - 1)
+    summary["sd_hr"] = np.sqrt(variance.where(summary["n_beats"] > 1).clip(lower=0))
+    columns = ["recordings", "n_beats", "valid_fraction", "mean_hr", "median_hr", "sd_hr"]
+    return summary.reset_index()[["parameter_set"] + PARAMETER_COLUMNS + columns]
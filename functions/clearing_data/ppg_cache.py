@@ -0,0 +1,205 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from functions.clearing_data.loaders import FileIndex, read_table
+
+# Bump when the on-disk layout changes so old caches are rebuilt
+CACHE_VERSION = 1
+
+# Sample rate of PPG files without a time column
+DEFAULT_SAMPLE_RATE = 100
+
+
+class PPGRecording:
+    """A uniformly sampled PPG recording.
+
+    The signal is kept as one contiguous float32 array (possibly memory-mapped from the cache), and
+    the time axis as its start time and sample rate, so a recording takes a quarter of the memory
+    of a float64 PPG and time table and times are converted to samples with arithmetic.
+
+    Attributes:
+        signal (np.ndarray): The float32 PPG samples.
+        start_time (float): Time of the first sample on the clock of the recording.
+        sample_rate (float): Sample rate in Hz.
+    """
+
+    __slots__ = ("signal", "start_time", "sample_rate")
+
+    def __init__(self, signal, start_time: float = 0.0, sample_rate: float = DEFAULT_SAMPLE_RATE):
+        self.signal = np.ascontiguousarray(signal, dtype=np.float32)
+        self.start_time = float(start_time)
+        self.sample_rate = float(sample_rate)
+
+    def __len__(self) -> int:
+        return len(self.signal)
+
+    @property
+    def duration(self) -> float:
+        """Length of the recording in seconds."""
+        return len(self.signal) / self.sample_rate
+
+    def time_to_index(self, times):
+        """Returns the index of the sample closest to each time, clipped to the recording.
+
+        Ties are resolved towards the earlier sample, like ``argmin`` on the absolute difference.
+        """
+        positions = (np.asarray(times, dtype=np.float64) - self.start_time) * self.sample_rate
+        return np.clip(np.ceil(positions - 0.5), 0, len(self.signal) - 1).astype(np.int64)
+
+    def index_to_time(self, indices):
+        """Returns the time of each sample index."""
+        return self.start_time + np.asarray(indices) / self.sample_rate
+
+    def times(self) -> np.ndarray:
+        """Returns the float64 time axis of the whole recording."""
+        return self.index_to_time(np.arange(len(self.signal)))
+
+    @classmethod
+    def from_csv(cls, file_path: str) -> "PPGRecording":
+        """Reads a PPG CSV file with a PPG and, optionally, a uniform time column.
+
+        Args:
+            file_path (str): Path to the PPG CSV file.
+
+        Returns:
+            PPGRecording: The recording. Without a time column it starts at 0 and is sampled at
+            ``DEFAULT_SAMPLE_RATE``. Non-numeric PPG values become NaN.
+        """
+        file_path = Path(file_path)
+        data = read_table(file_path, "ppg", ["PPG"], optional_columns=["time"])
+        signal = data["PPG"].to_numpy(dtype=np.float32)
+        if "time" not in data.columns or len(data) < 2:
+            start_time = float(data["time"].iloc[0]) if "time" in data.columns and len(data) else 0.0
+            return cls(signal, start_time, DEFAULT_SAMPLE_RATE)
+
+        # The time column is only redundant if the sampling is uniform
+        time = data["time"].to_numpy(dtype=np.float64)
+        sample_rate = round((len(time) - 1) / (time[-1] - time[0]), 3)
+        expected_time = time[0] + np.arange(len(time)) / sample_rate
+        if np.abs(time - expected_time).max() > 0.5 / sample_rate:
+            raise ValueError(f"File {file_path.name} is not uniformly sampled.")
+        return cls(signal, time[0], sample_rate)
+
+
+def list_ppg_files(PPG_data_path: str) -> list[str]:
+    """Lists the PPG CSV files of a folder, ordered by participant and session."""
+    return FileIndex.scan(PPG_data_path, "ppg").files
+
+
+def _cache_paths(file_path: Path, cache_dir: str) -> tuple[Path, Path]:
+    """Returns the signal and metadata paths of the cache entry for a PPG CSV file."""
+    stem = Path(file_path).stem
+    return Path(cache_dir) / f"{stem}.npy", Path(cache_dir) / f"{stem}.json"
+
+
+def _source_stamp(file_path: Path) -> dict:
+    """Returns the size and modification time used to detect changed source files."""
+    stat = os.stat(file_path)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def convert_ppg_csv(file_path: str, cache_dir: str) -> dict:
+    """Converts one PPG CSV file into the binary cache.
+
+    The PPG column is stored as a float32 ``.npy`` file and the uniform ``time`` column
+    is replaced by its start time and sample rate in a JSON sidecar.
+
+    Args:
+        file_path (str): Path to the PPG CSV file.
+        cache_dir (str): Folder where the cache entries are stored.
+
+    Returns:
+        dict: The metadata written for the recording.
+    """
+    file_path = Path(file_path)
+    recording = PPGRecording.from_csv(file_path)
+    if len(recording) < 2:
+        raise ValueError(f"File {file_path.name} has too few samples to be cached.")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    signal_path, meta_path = _cache_paths(file_path, cache_dir)
+    meta = {
+        "version": CACHE_VERSION,
+        "start_time": recording.start_time,
+        "sample_rate": recording.sample_rate,
+        "n_samples": len(recording),
+        **_source_stamp(file_path),
+    }
+
+    # Write to temporary files first so an interrupted run never leaves a half-written entry
+    tmp_signal_path = signal_path.with_name(signal_path.name + ".tmp")
+    with open(tmp_signal_path, "wb") as f:
+        np.save(f, recording.signal)
+    tmp_meta_path = meta_path.with_name(meta_path.name + ".tmp")
+    tmp_meta_path.write_text(json.dumps(meta))
+    os.replace(tmp_signal_path, signal_path)
+    os.replace(tmp_meta_path, meta_path)
+
+    return meta
+
+
+def load_ppg_recording(file_path: str, cache_dir: str | None = None) -> PPGRecording:
+    """Loads a PPG recording from the binary cache, (re)building the entry when needed.
+
+    The entry is rebuilt whenever the size or modification time of the source CSV differs
+    from the values stored at conversion time.
+
+    Args:
+        file_path (str): Path to the PPG CSV file.
+        cache_dir (str | None): Folder where the cache entries are stored. If None, the CSV file
+            is parsed instead.
+
+    Returns:
+        PPGRecording: The recording, with the float32 signal memory-mapped from the cache.
+    """
+    if cache_dir is None:
+        return PPGRecording.from_csv(file_path)
+
+    signal_path, meta_path = _cache_paths(file_path, cache_dir)
+
+    meta = None
+    if meta_path.exists() and signal_path.exists():
+        meta = json.loads(meta_path.read_text())
+        if meta.get("version") != CACHE_VERSION or any(
+            meta.get(key) != value for key, value in _source_stamp(file_path).items()
+        ):
+            meta = None
+
+    if meta is None:
+        meta = convert_ppg_csv(file_path, cache_dir)
+
+    return PPGRecording(np.load(signal_path, mmap_mode="r"), meta["start_time"], meta["sample_rate"])
+
+
+def build_ppg_cache(PPG_data_path: str, cache_dir: str, n_workers: int | None = None) -> int:
+    """Converts every PPG CSV file in a folder into the binary cache, on a thread pool.
+
+    Entries that are already up to date are left untouched.
+
+    Args:
+        PPG_data_path (str): Path to the folder containing the PPG CSV files.
+        cache_dir (str): Folder where the cache entries are stored.
+        n_workers (int | None): Number of converting threads, by default chosen by the thread pool.
+
+    Returns:
+        int: Number of recordings available in the cache.
+    """
+    file_index = FileIndex.scan(PPG_data_path, "ppg")
+
+    def cache(file_name):
+        try:
+            load_ppg_recording(file_index.path(file_name), cache_dir)
+            return True
+        except Exception as e:
+            print(f"Failed to cache {file_name}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        cached = sum(executor.map(cache, file_index.files))
+
+    print(f"{cached} PPG recordings are available in the binary cache.")
+    return cached
@@ -0,0 +1,136 @@
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi
+
+from functions.clearing_data.calc_r_peaks_from_ppg import HR_LIMITS, RR_LIMITS, _ppg_bandpass
+
+
+class StreamingBeatDetector:
+    """Detects R-peaks in a live PPG stream and reports every beat with its instantaneous HR.
+
+    Samples can be pushed in blocks of any size. They are band-pass filtered with the same filter
+    as ``rpeaks_from_ppg``, but causally, with the filter state kept between pushes. A local maximum
+    of the filtered signal is reported as a beat once the signal has fallen from it by the prominence
+    threshold, so a beat is known a fraction of a beat after its peak instead of at the end of the
+    recording. The threshold is ``threshold_factor`` times a peak envelope of the filtered signal
+    that decays over ``envelope_seconds``, the online counterpart of the global maximum used offline.
+
+    Args:
+        sample_rate (float): Sample rate of the stream in Hz.
+        start_time (float): Time of the first sample on the clock of the recording.
+        threshold_factor (float): Prominence threshold relative to the peak envelope.
+        min_distance (float): Minimum time between two beats in seconds.
+        envelope_seconds (float): Time constant of the decay of the peak envelope in seconds.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 100,
+        start_time: float = 0.0,
+        threshold_factor: float = 0.15,
+        min_distance: float = 0.6,
+        envelope_seconds: float = 10.0,
+    ):
+        self.sample_rate = sample_rate
+        self.start_time = start_time
+        self.threshold_factor = threshold_factor
+        self.min_distance = int(sample_rate * min_distance)
+        self._sos = _ppg_bandpass(sample_rate)
+        self._zi = None
+        self._decay = np.exp(-1 / (envelope_seconds * sample_rate))
+
+        # Detection state, carried over between pushes
+        self.n_samples = 0
+        self._envelope = 0.0
+        self._last_beat = None
+        self._previous_peak = np.nan
+        self._candidate = None
+        self._candidate_value = -np.inf
+        self._trough_before = np.inf
+        self._trough_after = np.inf
+
+    def push(self, samples) -> dict:
+        """Filters a block of samples and returns the beats confirmed by it.
+
+        Args:
+            samples (array-like): The next PPG samples of the stream.
+
+        Returns:
+            dict: Arrays of the new beats: "r_peak_index" (sample index in the stream), "r_peak_time",
+            "RR" and "HR" (interval to the previous beat, NaN for the first one), "valid" (RR and HR
+            within the limits of ``calculate_hr``) and "latency" (seconds from the peak to the sample
+            that confirmed it).
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if len(samples) == 0:
+            return self._beats([], [])
+        if self._zi is None:
+            # Start the filter in the steady state of the first sample to avoid a large transient
+            self._zi = sosfilt_zi(self._sos) * samples[0]
+        filtered, self._zi = sosfilt(self._sos, samples, zi=self._zi)
+
+        peaks, confirmed_at = self._detect(filtered.tolist())
+        self.n_samples += len(samples)
+        return self._beats(peaks, confirmed_at)
+
+    def _detect(self, filtered: list[float]) -> tuple[list[int], list[int]]:
+        """Runs the peak detection state machine over a filtered block."""
+        decay, factor, min_distance = self._decay, self.threshold_factor, self.min_distance
+        envelope, last_beat = self._envelope, self._last_beat
+        candidate, candidate_value = self._candidate, self._candidate_value
+        trough_before, trough_after = self._trough_before, self._trough_after
+        peaks, confirmed_at = [], []
+
+        for index, value in enumerate(filtered, start=self.n_samples):
+            envelope = max(value, envelope * decay)
+            if value > candidate_value:
+                if last_beat is not None and index - last_beat < min_distance:
+                    trough_before = min(trough_before, value)
+                else:
+                    # A new, higher local maximum; the dip since the previous candidate is part of its left base
+                    trough_before = min(trough_before, trough_after)
+                    candidate, candidate_value, trough_after = index, value, np.inf
+                continue
+
+            trough_after = min(trough_after, value)
+            threshold = factor * envelope
+            if (
+                candidate is not None
+                and candidate_value - trough_after >= threshold
+                and candidate_value - trough_before >= threshold
+            ):
+                peaks.append(candidate)
+                confirmed_at.append(index)
+                last_beat = candidate
+                # The minimum after this beat is the left base of the next one
+                trough_before, trough_after = trough_after, np.inf
+                candidate, candidate_value = None, -np.inf
+
+        self._envelope, self._last_beat = envelope, last_beat
+        self._candidate, self._candidate_value = candidate, candidate_value
+        self._trough_before, self._trough_after = trough_before, trough_after
+        return peaks, confirmed_at
+
+    def _beats(self, peaks: list[int], confirmed_at: list[int]) -> dict:
+        """Turns confirmed peaks into beats with the RR interval to the previous beat."""
+        peaks = np.asarray(peaks, dtype=np.int64)
+        previous = np.concatenate([[self._previous_peak], peaks[:-1]]) if len(peaks) else peaks
+        if len(peaks):
+            self._previous_peak = int(peaks[-1])
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rr_intervals = (peaks - previous) / self.sample_rate
+            hr_values = 60 / rr_intervals
+        valid = (
+            (rr_intervals >= RR_LIMITS[0])
+            & (rr_intervals <= RR_LIMITS[1])
+            & (hr_values >= HR_LIMITS[0])
+            & (hr_values <= HR_LIMITS[1])
+        )
+        return {
+            "r_peak_index": peaks,
+            "r_peak_time": self.start_time + peaks / self.sample_rate,
+            "RR": rr_intervals,
+            "HR": hr_values,
+            "valid": valid,
+            "latency": (np.asarray(confirmed_at, dtype=np.int64) - peaks) / self.sample_rate,
+        }
@@ -1,40 +1,75 @@
-import os
 from pathlib import Path
 
 import pandas as pd
 
+from functions.clearing_data.loaders import FileIndex
+from functions.pipeline.instrumentation import instrumented, record, stage
 
-def filter_to_new_excel(trial_data_path: str, selected_columns: list[str], combined_data_file: str) -> None:
-    """Reads CSV and Excel files from a folder, extracts selected columns,
-    and saves cleaned data to an Excel file without averaging valence ratings.
+
+@instrumented
+def combine_trial_data(
+    trial_data_path: str,
+    selected_columns: list[str],
+    n_workers: int | None = None,
+    file_index: FileIndex | None = None,
+) -> pd.DataFrame:
+    """Reads CSV and Excel files from a folder and combines the selected columns of all participants.
+
+    Only the selected columns are read, with the types of the trial schema, and the files are read on
+    a thread pool. The participant ID is taken from the "sub-XX" part of the file name; files without
+    it are reported and skipped.
 
     Args:
         trial_data_path (str): Path to the folder containing trial data files.
         selected_columns (list[str]): List of column names to extract.
-        combined_data_file (str): Path to save the final combined Excel file.
+        n_workers (int | None): Number of reading threads, by default chosen by the thread pool.
+        file_index (FileIndex | None): The scanned trial data folder, scanned here if not given.
+
+    Returns:
+        pd.DataFrame: The combined trial data without rows containing missing values.
     """
-    combined_data = pd.DataFrame()
+    if file_index is None:
+        file_index = FileIndex.scan(trial_data_path, "trial")
+    file_names = file_index.files
+    for file_name in file_names:
+        if file_index.participant_id(file_name) is None:
+            print(f"Could not extract participant ID from file name: {file_name}. Skipping.")
 
-    for index, file_name in enumerate(os.listdir(trial_data_path), start=1):
-        if file_name.endswith((".csv", ".xlsx")):
-            file_path = os.path.join(trial_data_path, file_name)
+    # Add participant IDs and concatenate all files at once
+    named_files = [file_name for file_name in file_names if file_index.participant_id(file_name) is not None]
+    tables = file_index.read_all(selected_columns, n_workers, file_names=named_files)
+    frames = [
+        data.loc[:, selected_columns].assign(participant_id=file_index.participant_id(file_name))
+        for file_name, data in zip(named_files, tables)
+        if data is not None
+    ]
+    record(files=len(file_names), skipped=len(file_names) - len(frames))
+    if not frames:
+        return pd.DataFrame(columns=[*selected_columns, "participant_id"])
+    combined_data = pd.concat(frames, ignore_index=True)
 
-            if file_name.endswith(".csv"):
-                data = pd.read_csv(file_path)
-            elif file_name.endswith(".xlsx"):
-                data = pd.read_excel(file_path)
+    # Remove NaN values
+    combined_data = combined_data.dropna()
+    if "session" in combined_data.columns:
+        combined_data["session"] = combined_data["session"].astype("int64")
+    record(rows=len(combined_data))
+    return combined_data
 
-            if all(col in data.columns for col in selected_columns):
-                data_filtered = data.loc[:, selected_columns].copy()
-                data_filtered["participant_id"] = index  # Add participant ID
-                combined_data = pd.concat([combined_data, data_filtered], ignore_index=True)
-            else:
-                print(f"File {file_name} is missing one or more required columns: {selected_columns}")
 
-    # Remove NaN values
-    df_cleaned = combined_data.dropna()
+@instrumented
+def filter_to_new_excel(trial_data_path: str, selected_columns: list[str], combined_data_file: str) -> None:
+    """Reads CSV and Excel files from a folder, extracts selected columns,
+    and saves cleaned data to an Excel file without averaging valence ratings.
+
+    Args:
+        trial_data_path (str): Path to the folder containing trial data files.
+        selected_columns (list[str]): List of column names to extract.
+        combined_data_file (str): Path to save the final combined Excel file.
+    """
+    df_cleaned = combine_trial_data(trial_data_path, selected_columns)
 
     # Save final dataset
     output_path = Path(combined_data_file) / "combined_data_trial.xlsx"
-    df_cleaned.to_excel(output_path, index=False)
+    with stage("write_excel"):
+        df_cleaned.to_excel(output_path, index=False)
     print("Trial data cleaned and added to the combined_data_trial file.")
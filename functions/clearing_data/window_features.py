@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+
+# Bump when the features change, so the PPG matching that computes them runs again
+WINDOW_FEATURES_VERSION = 1
+WINDOW_FEATURES = ["mean", "var", "range", "slope"]
+
+# Trial windows as (name, column of the start, column of the end); the ITI ends when the next trial's music starts
+TRIAL_WINDOWS = [
+    ("music", "PPG_music_start", "PPG_response_start"),
+    ("response", "PPG_response_start", "PPG_ITI_start"),
+    ("ITI", "PPG_ITI_start", None),
+]
+
+
+class PrefixStats:
+    """Mean, variance, amplitude range and slope of any window of a uniformly sampled signal in constant time.
+
+    Cumulative sums of the samples, their squares and their products with the sample index are computed
+    once, so the sums over a window are the difference of two entries. Minima and maxima come from
+    sparse tables, whose level k holds the extremes of all windows of 2**k samples; two overlapping
+    power-of-two windows cover any window. Levels are built on demand, up to the longest window asked
+    for. Missing samples (NaN) are left out of every statistic.
+
+    Args:
+        signal (np.ndarray): The samples.
+        sample_rate (float): Sample rate in Hz, which gives the slope per second.
+    """
+
+    __slots__ = (
+        "sample_rate",
+        "_offset",
+        "_counts",
+        "_sums",
+        "_squares",
+        "_index_products",
+        "_missing_indices",
+        "_missing_squares",
+        "_minima",
+        "_maxima",
+    )
+
+    def __init__(self, signal: np.ndarray, sample_rate: float):
+        self.sample_rate = sample_rate
+        values = np.asarray(signal, dtype=np.float64)
+        valid = ~np.isnan(values)
+
+        # Centered values keep the differences of the cumulative sums precise
+        self._offset = values[valid].mean() if valid.any() else 0.0
+        centered = np.where(valid, values - self._offset, 0)
+        index = np.arange(len(values), dtype=np.float64)
+        missing = np.where(valid, 0, index)
+
+        def prefix(terms):
+            return np.concatenate([[0], np.cumsum(terms, dtype=np.float64)])
+
+        self._counts = prefix(valid)
+        self._sums = prefix(centered)
+        self._squares = prefix(centered**2)
+        self._index_products = prefix(index * centered)
+        self._missing_indices = prefix(missing)
+        self._missing_squares = prefix(missing**2)
+        self._minima = [np.where(valid, signal, np.inf).astype(np.float32)]
+        self._maxima = [np.where(valid, signal, -np.inf).astype(np.float32)]
+
+    def _build_levels(self, level: int) -> None:
+        """Adds sparse table levels up to the given one."""
+        while len(self._minima) <= level:
+            half = 1 << (len(self._minima) - 1)
+            self._minima.append(np.minimum(self._minima[-1][:-half], self._minima[-1][half:]))
+            self._maxima.append(np.maximum(self._maxima[-1][:-half], self._maxima[-1][half:]))
+
+    def windows(self, starts: np.ndarray, ends: np.ndarray) -> pd.DataFrame:
+        """Computes the statistics of many windows at once.
+
+        Args:
+            starts (np.ndarray): Index of the first sample of every window.
+            ends (np.ndarray): Index after the last sample of every window.
+
+        Returns:
+            pd.DataFrame: One row per window with the ``WINDOW_FEATURES``: the mean, the sample variance,
+            the amplitude range (max - min) and the least-squares slope per second. Statistics of
+            windows with too few samples are NaN.
+        """
+        n_samples = len(self._counts) - 1
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, n_samples)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), starts, n_samples)
+
+        def window_sum(prefix):
+            return prefix[ends] - prefix[starts]
+
+        n, sums, squares = window_sum(self._counts), window_sum(self._sums), window_sum(self._squares)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums / n
+            variance = np.clip((squares - sums * mean) / (n - 1), 0, None)
+
+            # Slope from the covariance of sample index and value over the variance of the index. Indices
+            # are counted from the window start, with the sums over all indices in closed form and those of
+            # the missing samples subtracted, which keeps them precise far into long recordings.
+            length, n_missing = (ends - starts).astype(np.float64), ends - starts - n
+            missing_indices = window_sum(self._missing_indices) - starts * n_missing
+            missing_squares = window_sum(self._missing_squares) - starts * (2 * window_sum(self._missing_indices))
+            missing_squares += starts.astype(np.float64) ** 2 * n_missing
+            indices = length * (length - 1) / 2 - missing_indices
+            index_squares = (length - 1) * length * (2 * length - 1) / 6 - missing_squares
+            covariance = window_sum(self._index_products) - starts * sums - indices * mean
+            slope = covariance / (index_squares - indices**2 / n) * self.sample_rate
+
+        # Extremes from the two windows of 2**level samples at both ends of every window
+        lengths = ends - starts
+        levels = np.zeros(len(lengths), dtype=np.int64)
+        levels[lengths > 0] = np.floor(np.log2(lengths[lengths > 0])).astype(np.int64)
+        self._build_levels(int(levels.max()) if len(levels) else 0)
+        minimum, maximum = np.full(len(lengths), np.nan), np.full(len(lengths), np.nan)
+        for level in np.unique(levels[lengths > 0]):
+            rows = np.flatnonzero((levels == level) & (lengths > 0))
+            last = ends[rows] - (1 << level)
+            minimum[rows] = np.minimum(self._minima[level][starts[rows]], self._minima[level][last])
+            maximum[rows] = np.maximum(self._maxima[level][starts[rows]], self._maxima[level][last])
+
+        return pd.DataFrame(
+            {
+                "mean": np.where(n > 0, mean + self._offset, np.nan),
+                "var": np.where(n > 1, variance, np.nan),
+                "range": np.where(n > 0, maximum - minimum, np.nan),
+                "slope": np.where(n > 1, slope, np.nan),
+            }
+        )
+
+
+def trial_window_features(stats: PrefixStats, sample_indices: dict) -> pd.DataFrame:
+    """Computes the window features of the trials of one recording with a single call of ``PrefixStats.windows``.
+
+    Args:
+        stats (PrefixStats): Prefix sums of the recording.
+        sample_indices (dict): Sample index of every available trial time column of ``TRIAL_WINDOWS``,
+            with -1 for missing times.
+
+    Returns:
+        pd.DataFrame: A ``PPG_<window>_<feature>`` column for every feature of every window whose times
+        are available, one row per trial. Features of windows that are missing or empty are NaN.
+    """
+    bounds = {}
+    for name, start_column, end_column in TRIAL_WINDOWS:
+        if start_column not in sample_indices or (end_column or "PPG_music_start") not in sample_indices:
+            continue
+        starts = sample_indices[start_column]
+        if end_column is not None:
+            ends = sample_indices[end_column]
+        else:
+            # The next music start after the window start, over the trials of the recording
+            music_starts = np.sort(sample_indices["PPG_music_start"][sample_indices["PPG_music_start"] >= 0])
+            following = np.searchsorted(music_starts, starts, side="right")
+            ends = np.append(music_starts, -1)[following]
+        valid = (starts >= 0) & (ends > starts)
+        bounds[name] = (np.where(valid, starts, 0), np.where(valid, ends, 0))
+
+    if not bounds:
+        return pd.DataFrame()
+    features = stats.windows(
+        np.concatenate([starts for starts, _ in bounds.values()]), np.concatenate([ends for _, ends in bounds.values()])
+    )
+    n_trials = len(next(iter(bounds.values()))[0])
+    return pd.DataFrame(
+        {
+            f"PPG_{name}_{feature}": features[feature].to_numpy()[position * n_trials : (position + 1) * n_trials]
+            for position, name in enumerate(bounds)
+            for feature in WINDOW_FEATURES
+        }
+    )
@@ -1,20 +1,38 @@
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
-from scipy.stats import pearsonr
 
+from functions.clearing_data.dataset import AnalysisDataset, load_cube, load_trial_table
+from functions.data_analysis.figures import show_or_save
+from functions.data_analysis.resampling import resample_pearson
+from functions.pipeline.instrumentation import instrumented, record
 
-def analyze_valence_vs_IS(combined_data_file: str):
+
+@instrumented
+def analyze_valence_vs_IS(
+    combined_data_file: str | AnalysisDataset,
+    output_files: list[str] | None = None,
+    n_resamples: int = 0,
+    n_workers: int = 1,
+) -> dict:
     """Analyzes and visualizes the relationship between the average valence score and IS for each participant.
 
     Parameters:
-        combined_data_file (str): Path to the combined data file containing valence scores and IS.
+        combined_data_file (str | AnalysisDataset): Path to the combined data file containing valence
+            scores and IS, or the loaded dataset.
+        output_files (list[str] | None): Files the figure is saved to instead of being shown.
+        n_resamples (int): If positive, the correlation is also tested with this many permutations of
+            IS between participants and gets a bootstrap confidence interval over participants.
+        n_workers (int): Number of worker processes for the resampling.
 
     Returns:
-        None
+        dict: Pearson correlation and p-value, whether it is significant and the number of participants
+        with both a valence rating and an IS value. With resampling also the permutation p-value and the
+        confidence interval of the correlation.
     """
     # Load data
-    df = pd.read_excel(combined_data_file)
+    df = load_trial_table(combined_data_file)
+    record(rows=len(df))
 
     # Ensure required columns exist
     required_columns = ["participant_id", "valence_rating", "IS"]
@@ -22,15 +40,15 @@ def analyze_valence_vs_IS(combined_data_file: str):
         if col not in df.columns:
             raise ValueError(f"Column '{col}' is missing in the input data.")
 
-    # Calculate mean valence rating per participant
-    grouped_data = (
-        df.groupby("participant_id")
-        .agg(
-            mean_valence=("valence_rating", "mean"),
-            IS=("IS", "first"),  # Assuming IS is the same for each participant
-        )
-        .reset_index()
-    )
+    # Mean valence rating and IS per participant, from the aggregate cube (IS is the same for every trial)
+    cube = load_cube(combined_data_file, df)
+    grouped_data = pd.concat(
+        {
+            "mean_valence": cube.group_stats("valence_rating", "participant_id")["mean"],
+            "IS": cube.group_stats("IS", "participant_id")["mean"],
+        },
+        axis=1,
+    ).reset_index()
 
     # Scatter plot with regression line
     plt.figure(figsize=(8, 6))
@@ -41,10 +59,10 @@ def analyze_valence_vs_IS(combined_data_file: str):
     plt.ylabel("Interoceptive Sensitivity (IS)", fontsize=12)
     plt.grid(alpha=0.3)
     plt.tight_layout()
-    plt.show()
+    show_or_save(output_files)
 
-    # Pearson correlation
-    correlation, p_value = pearsonr(grouped_data["mean_valence"], grouped_data["IS"])
+    # Pearson correlation over the participants with both values
+    correlation, p_value, n_participants = cube.correlation("valence_rating", "IS")
     print(f"Pearson Correlation: r = {correlation:.2f}, p-value = {p_value:.3e}")
 
     # Interpret correlation result
@@ -52,3 +70,24 @@ def analyze_valence_vs_IS(combined_data_file: str):
         print("There is a significant correlation between mean valence score and IS.")
     else:
         print("There is no significant correlation between mean valence score and IS.")
+
+    stats = {
+        "correlation": float(correlation),
+        "p_value": float(p_value),
+        "significant": bool(p_value < 0.05),
+        "n_participants": n_participants,
+    }
+
+    # The correlation is computed over participants, so participants are the resampled units
+    if n_resamples > 0:
+        stats.update(
+            resample_pearson(
+                grouped_data["mean_valence"], grouped_data["IS"], n_resamples=n_resamples, n_workers=n_workers
+            )
+        )
+        low, high = stats["correlation_ci"]
+        print(
+            f"Permutation test ({n_resamples} permutations): p-value = {stats['permutation_p_value']:.3e}, "
+            f"95% bootstrap CI of r = [{low:.2f}, {high:.2f}]"
+        )
+    return stats
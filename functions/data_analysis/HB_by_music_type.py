@@ -1,24 +1,49 @@
 import matplotlib.pyplot as plt
-import pandas as pd
 import seaborn as sns
-from scipy.stats import f_oneway
 
+from functions.clearing_data.beat_trial_join import beats_in_trials
+from functions.clearing_data.dataset import load_beat_table, load_cube, load_trial_table
+from functions.data_analysis.figures import show_or_save
+from functions.data_analysis.resampling import resample_anova
+from functions.pipeline.instrumentation import instrumented, record
 
-def plot_hr_by_music_type(R_peak_data_path, combined_data_file):
+
+@instrumented
+def plot_hr_by_music_type(
+    R_peak_data_path,
+    combined_data_file,
+    output_files: list[str] | None = None,
+    n_resamples: int = 0,
+    n_workers: int = 1,
+) -> dict:
     """Plots the distribution of heart rate (HR) by music type and performs ANOVA.
 
+    Every beat is assigned to the trial whose music window (PPG_music_start to PPG_response_start)
+    contains it, so each beat counts once, under the music that was playing.
+
     Args:
-        r_peaks_file (str): Path to the R-peaks file.
-        combined_data_file (str): Path to the combined data file.
+        R_peak_data_path (str | AnalysisDataset): Path to the R-peaks file or partitioned dataset written
+            by ``process_ppg_folder``, or the loaded dataset.
+        combined_data_file (str | AnalysisDataset): Path to the combined data file, or the loaded dataset.
+        output_files (list[str] | None): Files the figure is saved to instead of being shown.
+        n_resamples (int): If positive, the ANOVA is also tested with this many permutations of the
+            music types between the trials of each participant, and the mean HR per music type gets a
+            bootstrap confidence interval over participants. Beats of a trial are not independent, so
+            these are more reliable than the parametric p-value.
+        n_workers (int): Number of worker processes for the resampling.
+
+    Returns:
+        dict: ANOVA F-statistic and p-value, whether the effect is significant, and the number of
+        beats and mean HR per music type. With resampling also the permutation p-value and the
+        confidence intervals of the means.
     """
-    # Load data
-    hr_data = pd.read_excel(R_peak_data_path)
-    combined_data = pd.read_excel(combined_data_file)
+    # Load data, only the beats of the participants in the trial table
+    combined_data = load_trial_table(combined_data_file)
+    hr_data = load_beat_table(R_peak_data_path, combined_data["participant_id"].unique())
+    record(rows=len(hr_data))
 
-    # Merge HR data with music type
-    merged_data = hr_data.merge(
-        combined_data, how="inner", left_on=["participant_id", "session_id"], right_on=["participant_id", "session"]
-    )
+    # Assign the beats to the music windows of the trials
+    merged_data = beats_in_trials(hr_data, combined_data)
 
     # Plotting HR by music type
     plt.figure(figsize=(8, 6))
@@ -28,13 +53,12 @@ def plot_hr_by_music_type(R_peak_data_path, combined_data_file):
     plt.ylabel("Heart Rate (bpm)", fontsize=12)
     plt.grid(alpha=0.3)
     plt.tight_layout()
-    plt.show()
+    show_or_save(output_files)
 
-    # ANOVA test for HR by music type
-    tonal = merged_data[merged_data["music_type"] == "tonal"]["HR"]
-    atonal = merged_data[merged_data["music_type"] == "atonal"]["HR"]
-    discord = merged_data[merged_data["music_type"] == "discord"]["HR"]
-    f_stat, p_value = f_oneway(tonal, atonal, discord)
+    # ANOVA test for HR by music type, from the HR sums of the aggregate cube
+    cube = load_cube(combined_data_file, combined_data, hr_data)
+    f_stat, p_value = cube.anova("HR")
+    hr_stats = cube.group_stats("HR")
 
     # Print ANOVA results
     print(f"ANOVA Test Results: F-statistic = {f_stat:.2f}, p-value = {p_value:.3e}")
@@ -42,3 +66,26 @@ def plot_hr_by_music_type(R_peak_data_path, combined_data_file):
         print("There is a significant effect of music type on heart rate.")
     else:
         print("No significant effect of music type on heart rate.")
+
+    stats = {
+        "f_statistic": float(f_stat),
+        "p_value": float(p_value),
+        "significant": bool(p_value < 0.05),
+        "n_beats": hr_stats["n"].to_dict(),
+        "mean_hr": hr_stats["mean"].to_dict(),
+    }
+
+    # Permute the music types of whole trials within participants
+    if n_resamples > 0:
+        stats.update(
+            resample_anova(
+                merged_data["HR"],
+                merged_data["music_type"],
+                units=merged_data["trial"],
+                clusters=merged_data["participant_id"],
+                n_resamples=n_resamples,
+                n_workers=n_workers,
+            )
+        )
+        print(f"Permutation test ({n_resamples} permutations of trials): p-value = {stats['permutation_p_value']:.3e}")
+    return stats
@@ -0,0 +1,211 @@
+import hashlib
+import html
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import matplotlib
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from functions.clearing_data.dataset import AnalysisDataset, load_beat_table, load_trial_table
+from functions.data_analysis.Average_valence_scrore_to_IS import analyze_valence_vs_IS
+from functions.data_analysis.HB_by_music_type import plot_hr_by_music_type
+from functions.data_analysis.is_to_music_type import analyze_music_type_vs_IS
+from functions.data_analysis.music_type_to_rt import analyze_rt_by_music_type, rt_by_music_type_stats
+from functions.data_analysis.valence_rating_by_music_type import plot_valence_by_music_type
+from functions.pipeline.instrumentation import instrumented, record
+
+MANIFEST_FILE_NAME = "figures.json"
+REPORT_FILE_NAME = "report.html"
+
+# Bump when a figure or its statistics change, so every figure is rendered again
+FIGURE_VERSION = 2
+
+# Columns of the trial table and of the beat table (None if not needed) that each figure depends on
+FIGURE_INPUTS = {
+    "valence_by_music_type": (["participant_id", "music_type", "valence_rating"], None),
+    "hr_by_music_type": (
+        ["participant_id", "session", "music_type", "PPG_music_start", "PPG_response_start"],
+        ["participant_id", "session_id", "r_peak_time", "HR"],
+    ),
+    "is_by_music_type": (["music_type", "IS"], None),
+    "rt_by_music_type": (["participant_id", "music_type", "RT"], None),
+    "valence_vs_is": (["participant_id", "valence_rating", "IS"], None),
+}
+
+
+def _render_figure(
+    name: str,
+    trials: pd.DataFrame,
+    beats: pd.DataFrame | None,
+    output_files: list[str],
+    n_resamples: int = 0,
+    n_workers: int = 1,
+) -> dict:
+    """Draws one figure into files and returns its statistics.
+
+    What the figure functions print is discarded, since the same statistics go into the manifest and the
+    HTML report.
+    """
+    dataset = AnalysisDataset(trials, beats)
+    with redirect_stdout(io.StringIO()):
+        if name == "valence_by_music_type":
+            return plot_valence_by_music_type(dataset, output_files, n_resamples, n_workers)
+        if name == "hr_by_music_type":
+            return plot_hr_by_music_type(dataset, dataset, output_files, n_resamples, n_workers)
+        if name == "is_by_music_type":
+            return analyze_music_type_vs_IS(dataset, output_files)
+        if name == "rt_by_music_type":
+            stats = rt_by_music_type_stats(trials, n_resamples, n_workers)
+            analyze_rt_by_music_type(dataset, output_files, n_resamples, n_workers, stats)
+            return stats
+        if name == "valence_vs_is":
+            return analyze_valence_vs_IS(dataset, output_files, n_resamples, n_workers)
+    raise ValueError(f"Unknown figure: {name}")
+
+
+def _input_key(
+    name: str, trials: pd.DataFrame, beats: pd.DataFrame | None, formats: list[str], n_resamples: int = 0
+) -> str:
+    """Hashes the input data of a figure together with its name, version, output formats and resamples."""
+    content_hash = hashlib.blake2b(
+        json.dumps([FIGURE_VERSION, name, list(formats), n_resamples]).encode(), digest_size=16
+    )
+    for table in (trials, beats):
+        if table is not None:
+            content_hash.update(json.dumps(list(table.columns)).encode())
+            content_hash.update(pd.util.hash_pandas_object(table, index=False).to_numpy().tobytes())
+    return content_hash.hexdigest()
+
+
+def _write_html_report(report_path: Path, formats: list[str], figure_stats: dict) -> None:
+    """Writes one HTML page with every figure and a table of its statistics."""
+    image_format = "svg" if "svg" in formats else formats[0]
+    sections = []
+    for name, stats in figure_stats.items():
+        rows = "".join(
+            f"<tr><th>{html.escape(key)}</th><td>{html.escape(str(value))}</td></tr>" for key, value in stats.items()
+        )
+        sections.append(
+            f'<h2>{html.escape(name.replace("_", " "))}</h2>\n<img src="{name}.{image_format}" alt="{name}">\n'
+            f"<table>{rows}</table>"
+        )
+    report_path.write_text(
+        "<!DOCTYPE html>\n<html><head><meta charset='utf-8'><title>Analysis report</title></head><body>\n"
+        "<h1>Analysis report</h1>\n" + "\n".join(sections) + "\n</body></html>\n"
+    )
+
+
+@instrumented
+def render_report(
+    combined_data_file,
+    R_peak_data_path,
+    output_dir: str,
+    formats: list[str] = ("png",),
+    n_workers: int = 1,
+    html_report: bool = True,
+    n_resamples: int = 0,
+) -> dict:
+    """Renders every analysis figure to files with a non-interactive backend and collects the statistics.
+
+    The figures are drawn in parallel worker processes. The input data of every figure is hashed, and
+    figures whose data, version and formats are unchanged since the last report are not drawn again;
+    their statistics are taken from the manifest of the output folder.
+
+    Args:
+        combined_data_file (str | AnalysisDataset): Path to the combined data file, or the loaded dataset.
+        R_peak_data_path (str | AnalysisDataset | None): Path to the R-peaks file, or the loaded dataset.
+            If None or a dataset without beats, the HR figure is skipped.
+        output_dir (str): Folder where the figures, the manifest and the HTML report are written.
+        formats (list[str]): Image formats of every figure, e.g. ["png", "svg"].
+        n_workers (int): Number of worker processes drawing the figures.
+        html_report (bool): If True, all figures and statistics are also combined into report.html.
+        n_resamples (int): If positive, the ANOVAs and the correlation of valence and IS also get
+            permutation p-values and bootstrap confidence intervals from this many resamples.
+
+    Returns:
+        dict: Statistics of every rendered figure, keyed by figure name.
+    """
+    output_dir = Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = output_dir / MANIFEST_FILE_NAME
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    trials = load_trial_table(combined_data_file)
+    participant_ids = trials["participant_id"].unique() if "participant_id" in trials.columns else None
+    # A dataset stored before the ppg stage ran has no beats, which only rules out the HR figure
+    if R_peak_data_path is None or (isinstance(R_peak_data_path, AnalysisDataset) and R_peak_data_path.beats is None):
+        beats = None
+    else:
+        beats = load_beat_table(R_peak_data_path, participant_ids)
+
+    figure_stats = {}
+    pending = []
+    for name, (trial_columns, beat_columns) in FIGURE_INPUTS.items():
+        missing_columns = [col for col in trial_columns if col not in trials.columns]
+        if beat_columns is not None:
+            missing_columns += [col for col in beat_columns if beats is None or col not in beats.columns]
+        if missing_columns:
+            print(f"Skipping the {name} figure, missing columns: {', '.join(missing_columns)}")
+            record(skipped=1)
+            continue
+
+        # Only the columns a figure depends on are hashed and sent to the workers
+        figure_trials = trials.loc[:, trial_columns].copy()
+        figure_beats = beats.loc[:, beat_columns].copy() if beat_columns is not None else None
+        key = _input_key(name, figure_trials, figure_beats, formats, n_resamples)
+        output_files = [str(output_dir / f"{name}.{image_format}") for image_format in formats]
+
+        entry = manifest.get(name)
+        if entry and entry["key"] == key and all(os.path.exists(output_file) for output_file in output_files):
+            figure_stats[name] = entry["stats"]
+        else:
+            pending.append((name, figure_trials, figure_beats, output_files, key))
+
+    names, trial_tables, beat_tables, output_file_lists, keys = zip(*pending) if pending else ([],) * 5
+    resamples = [n_resamples] * len(pending)
+    if n_workers > 1 and len(pending) > 1:
+        # The figures already use the workers, so each one resamples in its own process
+        with ProcessPoolExecutor(
+            max_workers=min(n_workers, len(pending)), initializer=matplotlib.use, initargs=("Agg",)
+        ) as executor:
+            rendered = list(
+                executor.map(_render_figure, names, trial_tables, beat_tables, output_file_lists, resamples)
+            )
+    else:
+        previous_backend = matplotlib.get_backend()
+        plt.switch_backend("Agg")
+        try:
+            rendered = list(
+                map(
+                    _render_figure,
+                    names,
+                    trial_tables,
+                    beat_tables,
+                    output_file_lists,
+                    resamples,
+                    [n_workers] * len(pending),
+                )
+            )
+        finally:
+            plt.switch_backend(previous_backend)
+
+    for name, key, stats in zip(names, keys, rendered):
+        manifest[name] = {"key": key, "stats": stats}
+        figure_stats[name] = stats
+    record(files=len(pending), skipped=len(figure_stats) - len(pending))
+
+    # Keep the figures in a fixed order and store the manifest only after all figures were written
+    figure_stats = {name: figure_stats[name] for name in FIGURE_INPUTS if name in figure_stats}
+    tmp_path = manifest_path.with_name(MANIFEST_FILE_NAME + ".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, manifest_path)
+
+    if html_report:
+        _write_html_report(output_dir / REPORT_FILE_NAME, list(formats), figure_stats)
+    print(f"{len(pending)} figures rendered, {len(figure_stats) - len(pending)} unchanged, in {output_dir}.")
+    return figure_stats
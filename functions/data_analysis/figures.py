@@ -0,0 +1,21 @@
+import os
+
+import matplotlib.pyplot as plt
+
+
+def show_or_save(output_files: list[str] | None = None) -> None:
+    """Shows the current figure, or saves it to the given files and closes it.
+
+    Args:
+        output_files (list[str] | None): Files to write the figure to, in the format given by their
+            extension (e.g. .png or .svg). If None, the figure is shown in an interactive window.
+    """
+    if output_files is None:
+        plt.show()
+        return
+
+    figure = plt.gcf()
+    for output_file in output_files:
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        figure.savefig(output_file)
+    plt.close(figure)
@@ -1,21 +1,26 @@
 import matplotlib.pyplot as plt
-import pandas as pd
 import seaborn as sns
-import statsmodels.api as sm
-from statsmodels.formula.api import ols
 
+from functions.clearing_data.dataset import AnalysisDataset, load_cube, load_trial_table
+from functions.data_analysis.figures import show_or_save
+from functions.pipeline.instrumentation import instrumented, record
 
-def analyze_music_type_vs_IS(combined_data_file: str):
+
+@instrumented
+def analyze_music_type_vs_IS(combined_data_file: str | AnalysisDataset, output_files: list[str] | None = None) -> dict:
     """Analyze the relationship between 'music_type' and 'IS' using correlation, ANOVA, and visualization.
 
     Parameters:
-        combined_data_file (str): Path to the combined data file.
+        combined_data_file (str | AnalysisDataset): Path to the combined data file, or the loaded dataset.
+        output_files (list[str] | None): Files the figure is saved to instead of being shown.
 
     Returns:
-        None
+        dict: Correlation between the coded music type and IS, the ANOVA p-value and whether the
+        effect is significant.
     """
     # Reading the file
-    df = pd.read_excel(combined_data_file)
+    df = load_trial_table(combined_data_file)
+    record(rows=len(df))
 
     # Ensure required columns exist
     required_columns = ["music_type", "IS"]
@@ -26,9 +31,10 @@ def analyze_music_type_vs_IS(combined_data_file: str):
     # Drop rows with missing IS values
     df = df.dropna(subset=["IS"])
 
-    # 1. Correlation between 'music_type' and 'IS'
-    df["music_type_numeric"] = df["music_type"].astype("category").cat.codes  # Convert music_type to numeric
-    correlation = df["music_type_numeric"].corr(df["IS"])
+    cube = load_cube(combined_data_file, df)
+
+    # 1. Correlation between 'music_type' and 'IS', with the music types coded as 0, 1, 2 in sorted order
+    correlation = cube.code_correlation("IS", "music_type")
     print(f"Correlation between music type and Introspective sensitivity (IS): {correlation:.3f}")
 
     # Interpret correlation result
@@ -42,8 +48,7 @@ def analyze_music_type_vs_IS(combined_data_file: str):
         print("There is a strong correlation between music type and IS.")
 
     # 2. ANOVA test for 'music_type' and 'IS'
-    model = ols("IS ~ C(music_type)", data=df).fit()  # Fit the model
-    p_value = sm.stats.anova_lm(model, typ=2)["PR(>F)"].iloc[0]  # Get the p-value
+    _, p_value = cube.anova("IS", "music_type")
 
     # Interpret ANOVA result
     print(f"ANOVA p-value: {p_value:.3e}")
@@ -60,4 +65,6 @@ def analyze_music_type_vs_IS(combined_data_file: str):
     plt.ylabel("Interoceptive Sensitivity (IS)", fontsize=12)
     plt.grid(alpha=0.3)
     plt.tight_layout()
-    plt.show()
+    show_or_save(output_files)
+
+    return {"correlation": float(correlation), "p_value": float(p_value), "significant": bool(p_value < 0.05)}
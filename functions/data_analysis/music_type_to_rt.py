@@ -2,36 +2,44 @@ import logging
 
 import matplotlib.pyplot as plt
 import pandas as pd
-from scipy.stats import f_oneway
+
+from functions.clearing_data.aggregate_cube import AggregateCube
+from functions.clearing_data.dataset import AnalysisDataset, load_cube, load_trial_table
+from functions.data_analysis.figures import show_or_save
+from functions.data_analysis.resampling import resample_anova
+from functions.pipeline.instrumentation import instrumented, record
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 
-def analyze_rt_by_music_type(combined_data_file: str) -> str:
-    """Analyzes reaction time (RT) differences between music types and performs ANOVA.
+def rt_by_music_type_stats(
+    data: pd.DataFrame, n_resamples: int = 0, n_workers: int = 1, cube: AggregateCube | None = None
+) -> dict:
+    """Tests reaction time (RT) differences between music types with an ANOVA.
 
-    Parameters:
-        trial_combined_path (str): Path to the Excel file containing the data.
+    Args:
+        data (pd.DataFrame): Trial data with participant_id, music_type and RT columns.
+        n_resamples (int): If positive, the ANOVA is also tested with this many permutations of the
+            music types within participants, and the mean RT per music type gets a bootstrap
+            confidence interval over participants.
+        n_workers (int): Number of worker processes for the resampling.
+        cube (AggregateCube | None): Aggregates of the data the ANOVA is computed from; built from
+            ``data`` if not given.
 
     Returns:
-        str: Conclusion based on the ANOVA test result.
+        dict: ANOVA F-statistic and p-value, whether the effect is significant, the conclusion and
+        the mean and standard deviation of RT per music type. With resampling also the permutation
+        p-value and the confidence intervals of the means.
     """
-    # Read the Excel file
-    data = pd.read_excel(combined_data_file)
-
     # Ensure the required columns are present
     required_columns = ["participant_id", "music_type", "RT"]
     if not all(col in data.columns for col in required_columns):
         raise ValueError(f"The input file must contain the following columns: {required_columns}")
 
     # Perform ANOVA to check for significant differences between music types
-    tonal = data[data["music_type"] == "tonal"]["RT"]
-    atonal = data[data["music_type"] == "atonal"]["RT"]
-    discord = data[data["music_type"] == "discord"]["RT"]
-
-    f_stat, p_value = f_oneway(tonal, atonal, discord)
-    logging.info(f"ANOVA F-statistic: {f_stat:.2f}, p-value: {p_value:.4f}")
+    cube = cube if cube is not None else AggregateCube.from_tables(data)
+    f_stat, p_value = cube.anova("RT")
 
     # Interpret the results
     if p_value < 0.05:
@@ -39,8 +47,65 @@ def analyze_rt_by_music_type(combined_data_file: str) -> str:
     else:
         conclusion = "Music type does not have a significant effect on reaction time (RT)."
 
-    # Calculate mean and standard deviation of RT for each music type
-    summary_stats = data.groupby("music_type")["RT"].agg(["mean", "std"]).reset_index()
+    summary_stats = cube.group_stats("RT")
+    stats = {
+        "f_statistic": float(f_stat),
+        "p_value": float(p_value),
+        "significant": bool(p_value < 0.05),
+        "conclusion": conclusion,
+        "mean_rt": summary_stats["mean"].to_dict(),
+        "std_rt": summary_stats["std"].to_dict(),
+    }
+
+    if n_resamples > 0:
+        stats.update(
+            resample_anova(
+                data["RT"],
+                data["music_type"],
+                clusters=data["participant_id"],
+                n_resamples=n_resamples,
+                n_workers=n_workers,
+            )
+        )
+    return stats
+
+
+@instrumented
+def analyze_rt_by_music_type(
+    combined_data_file: str | AnalysisDataset,
+    output_files: list[str] | None = None,
+    n_resamples: int = 0,
+    n_workers: int = 1,
+    stats: dict | None = None,
+) -> str:
+    """Analyzes reaction time (RT) differences between music types and performs ANOVA.
+
+    Parameters:
+        trial_combined_path (str | AnalysisDataset): Path to the Excel file containing the data, or the
+            loaded dataset.
+        output_files (list[str] | None): Files the figure is saved to instead of being shown.
+        n_resamples (int): Number of permutation and bootstrap resamples, see ``rt_by_music_type_stats``.
+        n_workers (int): Number of worker processes for the resampling.
+        stats (dict | None): Statistics already computed by ``rt_by_music_type_stats``, which are then
+            only logged and plotted instead of being computed again.
+
+    Returns:
+        str: Conclusion based on the ANOVA test result. The full statistics are returned by
+        ``rt_by_music_type_stats``.
+    """
+    # Read the Excel file
+    data = load_trial_table(combined_data_file)
+    record(rows=len(data))
+
+    cube = load_cube(combined_data_file, data)
+    if stats is None:
+        stats = rt_by_music_type_stats(data, n_resamples, n_workers, cube)
+    logging.info(f"ANOVA F-statistic: {stats['f_statistic']:.2f}, p-value: {stats['p_value']:.4f}")
+    if n_resamples > 0:
+        logging.info(f"Permutation test ({n_resamples} permutations): p-value: {stats['permutation_p_value']:.4f}")
+
+    # Mean and standard deviation of RT for each music type
+    summary_stats = cube.group_stats("RT").reset_index()
 
     # Plot the bar chart with error bars
     plt.figure(figsize=(6, 4))
@@ -60,6 +125,6 @@ def analyze_rt_by_music_type(combined_data_file: str) -> str:
 
     # Show the plot
     plt.tight_layout()
-    plt.show()
+    show_or_save(output_files)
 
-    return conclusion
+    return stats["conclusion"]
@@ -0,0 +1,225 @@
+import json
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# Imported up front, so the first query does not pay for importing the statistics of the cube
+import scipy.stats  # noqa: F401
+
+from functions.clearing_data.aggregate_cube import BEAT_MEASURES, CUBE_DIMENSIONS, TRIAL_MEASURES, AggregateCube
+from functions.clearing_data.dataset import AnalysisDataset
+
+DEFAULT_PORT = 8765
+
+QUERIES = ("/", "/anova", "/correlation", "/summary")
+
+# Query parameters that select cells of the cube, with the dimension they filter and the type of their values
+FILTERS = {"participant": ("participant_id", int), "session": ("session", int), "music_type": ("music_type", str)}
+
+
+def _number(value) -> float | None:
+    """Returns a statistic as a JSON number, with None for NaN and infinity."""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def _group_name(value):
+    """Returns a group of a dimension as a JSON object key."""
+    if isinstance(value, float) and np.isnan(value):
+        return "missing"
+    return str(value.item() if isinstance(value, np.generic) else value)
+
+
+class QueryEngine:
+    """Answers filtered versions of the analyses from the aggregate cube of a dataset held in memory.
+
+    The cube holds the count, sum and sum of squares of every measure per participant, session and
+    music type, so an ANOVA, correlation or summary of any selection of cells is computed without
+    touching the trials or beats. Every dimension is indexed by its values, so a selection is the
+    intersection of a few index lookups. Answers are cached with LRU eviction.
+
+    Args:
+        dataset (AnalysisDataset): The cleaned dataset; its cube is built if it has none.
+        cache_size (int): Number of answers kept in the cache.
+
+    Attributes:
+        cube (AggregateCube): The cube of the dataset.
+        indexes (dict): For every dimension, the positions of the cells of every value.
+        measures (list[str]): The measures of the cube.
+    """
+
+    def __init__(self, dataset: AnalysisDataset, cache_size: int = 1024):
+        if dataset.cube is not None:
+            self.cube = dataset.cube
+        else:
+            self.cube = AggregateCube.from_tables(dataset.trials, dataset.beats)
+        cells = self.cube.cells
+        self.indexes = {
+            dim: cells.groupby(dim, dropna=False, sort=False).indices if dim in cells.columns else {}
+            for dim in CUBE_DIMENSIONS
+        }
+        self.measures = [measure for measure in TRIAL_MEASURES + BEAT_MEASURES if f"{measure}_n" in cells.columns]
+        self.answer = lru_cache(maxsize=cache_size)(self._answer)
+
+    def select(self, include: dict, exclude_participants: tuple = ()) -> AggregateCube:
+        """Returns the cube of the cells with the given dimension values.
+
+        Args:
+            include (dict): Allowed values per dimension, e.g. {"session": (1,)}; other dimensions are
+                not filtered.
+            exclude_participants (tuple): Participants left out.
+
+        Returns:
+            AggregateCube: The selected cells.
+        """
+        selected = np.ones(len(self.cube.cells), dtype=bool)
+        for dim, values in include.items():
+            rows = np.zeros(len(selected), dtype=bool)
+            for value in values:
+                rows[self.indexes[dim].get(value, [])] = True
+            selected &= rows
+        for participant_id in exclude_participants:
+            selected[self.indexes["participant_id"].get(participant_id, [])] = False
+        return AggregateCube(self.cube.cells[selected])
+
+    def query(self, path: str, params: dict) -> dict:
+        """Answers a query given as an URL path and its parameters, from the cache if it was asked before.
+
+        Args:
+            path (str): "/anova", "/correlation", "/summary" or "/" for a description of the dataset.
+            params (dict): Parameter values, as lists of strings per name like ``parse_qs`` returns them.
+                Lists of values may also be given comma-separated.
+
+        Returns:
+            dict: The answer.
+
+        Raises:
+            KeyError: If the path is unknown.
+            ValueError: If a parameter is invalid.
+        """
+        if path not in QUERIES:
+            raise KeyError(path)
+        if path == "/":
+            return self.describe()
+        # One hashable key per distinct query, independent of the order of the parameters and values
+        key = []
+        for name, items in sorted(params.items()):
+            key.append((name, tuple(sorted({value for item in items for value in item.split(",") if value}))))
+        return self.answer(path, tuple(key))
+
+    def _answer(self, path: str, params: tuple) -> dict:
+        params = dict(params)
+
+        include = {}
+        for name, (dim, value_type) in FILTERS.items():
+            if name in params:
+                try:
+                    include[dim] = tuple(value_type(value) for value in params[name])
+                except ValueError:
+                    raise ValueError(f"Invalid {name} values: {', '.join(params[name])}") from None
+        try:
+            exclude = tuple(int(value) for value in params.get("exclude", ()))
+        except ValueError:
+            raise ValueError(f"Invalid participants to exclude: {', '.join(params['exclude'])}") from None
+        cube = self.select(include, exclude)
+
+        def parameter(name, default):
+            value = params.get(name, (default,))
+            if len(value) != 1:
+                raise ValueError(f"Expected a single value of '{name}'.")
+            return value[0]
+
+        by = parameter("by", "participant_id" if path == "/correlation" else "music_type")
+        if by not in CUBE_DIMENSIONS:
+            raise ValueError(f"Cannot group by '{by}', expected one of {CUBE_DIMENSIONS}.")
+        answer = {"parameters": {name: list(values) for name, values in params.items()}, "cells": len(cube.cells)}
+
+        if path == "/anova":
+            measure = parameter("measure", "HR")
+            f_stat, p_value = cube.anova(measure, by)
+            answer.update(
+                {
+                    "f_statistic": _number(f_stat),
+                    "p_value": _number(p_value),
+                    "significant": bool(p_value < 0.05),
+                    "groups": self._groups(cube, measure, by),
+                }
+            )
+        elif path == "/correlation":
+            measure_x, measure_y = parameter("x", "valence_rating"), parameter("y", "IS")
+            correlation, p_value, n_groups = cube.correlation(measure_x, measure_y, by)
+            answer.update(
+                {
+                    "correlation": _number(correlation),
+                    "p_value": _number(p_value),
+                    "significant": bool(p_value < 0.05),
+                    "n": n_groups,
+                }
+            )
+        else:
+            measure = parameter("measure", "HR")
+            answer["groups"] = self._groups(cube, measure, by)
+        return answer
+
+    @staticmethod
+    def _groups(cube: AggregateCube, measure: str, by: str) -> dict:
+        """Returns the number of values, mean and standard deviation of a measure per group."""
+        stats = cube.group_stats(measure, by)
+        return {
+            _group_name(group): {"n": int(row["n"]), "mean": _number(row["mean"]), "std": _number(row["std"])}
+            for group, row in stats.iterrows()
+        }
+
+    def describe(self) -> dict:
+        """Returns the measures, the values of every dimension and the state of the cache."""
+        cache = self.answer.cache_info()
+        return {
+            "measures": self.measures,
+            "cells": len(self.cube.cells),
+            "dimensions": {dim: sorted(_group_name(value) for value in index) for dim, index in self.indexes.items()},
+            "cache": {"hits": cache.hits, "misses": cache.misses, "size": cache.currsize, "max_size": cache.maxsize},
+        }
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    """Answers GET requests with the JSON answers of the query engine of the server."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            status, answer = 200, self.server.engine.query(url.path.rstrip("/") or "/", parse_qs(url.query))
+        except KeyError:
+            status, answer = 404, {"error": f"Unknown query {url.path}, expected /anova, /correlation or /summary."}
+        except ValueError as e:
+            status, answer = 400, {"error": str(e)}
+
+        body = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(dataset: AnalysisDataset, host: str = "127.0.0.1", port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+    """Creates the query server of a dataset; ``serve_forever`` starts answering requests.
+
+    Queries are GET requests with the filters as parameters, e.g.
+    ``/anova?measure=HR&session=1``, ``/correlation?x=valence_rating&y=IS&exclude=3,7`` or
+    ``/summary?measure=RT&by=session&music_type=tonal,atonal``. Filters select the cells of the
+    participants, sessions and music types given as comma-separated lists, and ``exclude`` leaves
+    participants out. ``/`` describes the dataset.
+
+    Args:
+        dataset (AnalysisDataset): The cleaned dataset.
+        host (str): Address to listen on, only this machine by default.
+        port (int): Port to listen on; 0 picks a free port.
+
+    Returns:
+        ThreadingHTTPServer: The server, with its ``QueryEngine`` as ``engine``.
+    """
+    server = ThreadingHTTPServer((host, port), _QueryHandler)
+    server.engine = QueryEngine(dataset)
+    return server
@@ -0,0 +1,408 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Resamples are drawn in chunks of this size, each with its own seed, so the results do not depend on
+# the number of workers the chunks are spread over
+CHUNK_SIZE = 10_000
+
+# Upper bound on the number of elements of the matrices of one batch of resamples (about 32 MiB each)
+BATCH_ELEMENTS = 4_000_000
+
+
+def _batches(n_resamples: int, n_columns: int):
+    """Yields the sizes of the batches a chunk of resamples is split into."""
+    batch_size = max(BATCH_ELEMENTS // max(n_columns, 1), 1)
+    for start in range(0, n_resamples, batch_size):
+        yield min(batch_size, n_resamples - start)
+
+
+def _run_chunks(chunk_function, n_resamples: int, seed: int, n_workers: int, *args) -> list:
+    """Runs ``chunk_function(seed_sequence, n, *args)`` on chunks of the resamples, in parallel if requested."""
+    chunk_sizes = [CHUNK_SIZE] * (n_resamples // CHUNK_SIZE)
+    if n_resamples % CHUNK_SIZE:
+        chunk_sizes.append(n_resamples % CHUNK_SIZE)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunk_args = [[arg] * len(chunk_sizes) for arg in args]
+
+    if n_workers > 1 and len(chunk_sizes) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(chunk_sizes))) as executor:
+            return list(executor.map(chunk_function, seeds, chunk_sizes, *chunk_args))
+    return list(map(chunk_function, seeds, chunk_sizes, *chunk_args))
+
+
+def _strata(cluster_codes: np.ndarray) -> list[tuple[int, int]]:
+    """Returns the (start, stop) slices of the runs of equal codes in a sorted code array."""
+    boundaries = np.flatnonzero(np.diff(cluster_codes)) + 1
+    starts = np.concatenate([[0], boundaries])
+    stops = np.concatenate([boundaries, [len(cluster_codes)]])
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def _permuted(rng: np.random.Generator, labels: np.ndarray, strata: list[tuple[int, int]], n: int) -> np.ndarray:
+    """Returns ``n`` rows of the labels, each shuffled independently within every stratum."""
+    permuted = np.tile(labels, (n, 1))
+    for start, stop in strata:
+        if stop - start > 1:
+            permuted[:, start:stop] = rng.permuted(permuted[:, start:stop], axis=1)
+    return permuted
+
+
+def _resampled_weights(rng: np.random.Generator, n_clusters: int, n: int) -> np.ndarray:
+    """Returns ``n`` rows of bootstrap weights: how often every cluster is drawn, with replacement."""
+    draws = rng.integers(0, n_clusters, size=(n, n_clusters))
+    draws += np.arange(n)[:, None] * n_clusters
+    return np.bincount(draws.ravel(), minlength=n * n_clusters).reshape(n, n_clusters).astype(np.float64)
+
+
+def _percentile_interval(samples: np.ndarray, confidence: float) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the percentile bootstrap interval of every column, ignoring undefined resamples."""
+    tail = (1 - confidence) / 2 * 100
+    return np.nanpercentile(samples, tail, axis=0), np.nanpercentile(samples, 100 - tail, axis=0)
+
+
+def _factorize(labels) -> tuple[np.ndarray, np.ndarray]:
+    """Codes the labels as 0..n-1 in sorted order; missing labels get -1."""
+    codes, uniques = pd.factorize(pd.Series(labels).to_numpy(), sort=True)
+    return codes, np.asarray(uniques)
+
+
+class _GroupedUnits:
+    """Observations collapsed into exchangeable units with their count, sum and group.
+
+    A unit (e.g. a trial) keeps its observations (e.g. its beats) together when the group labels are
+    permuted or the units are resampled. Units are ordered by cluster, so the units of a cluster
+    form one contiguous stratum.
+    """
+
+    def __init__(self, values, groups, units=None, clusters=None):
+        values = np.asarray(values, dtype=np.float64)
+        group_codes, self.group_names = _factorize(groups)
+        unit_codes = _factorize(units)[0] if units is not None else np.arange(len(values))
+        cluster_codes = _factorize(clusters)[0] if clusters is not None else np.zeros(len(values), dtype=np.int64)
+
+        valid = ~np.isnan(values) & (group_codes >= 0) & (unit_codes >= 0) & (cluster_codes >= 0)
+        values, group_codes = values[valid], group_codes[valid]
+        unit_codes, cluster_codes = np.unique(unit_codes[valid], return_inverse=True)[1], cluster_codes[valid]
+
+        self.n_groups = len(self.group_names)
+        self.n_observations = len(values)
+        if self.n_groups < 2 or self.n_observations <= self.n_groups:
+            raise ValueError("At least two groups and more observations than groups are needed.")
+
+        # Center the values so the sums stay small and the grand sum is zero
+        centered = values - values.mean()
+        self.total_ss = float(centered @ centered)
+
+        n_units = unit_codes.max() + 1
+        unit_group = np.full(n_units, -1)
+        unit_group[unit_codes] = group_codes
+        unit_cluster = np.zeros(n_units, dtype=np.int64)
+        unit_cluster[unit_codes] = cluster_codes
+        if (unit_group[unit_codes] != group_codes).any() or (unit_cluster[unit_codes] != cluster_codes).any():
+            raise ValueError("Every unit must belong to a single group and a single cluster.")
+
+        order = np.argsort(unit_cluster, kind="stable")
+        self.unit_group = unit_group[order]
+        self.unit_cluster = unit_cluster[order]
+        self.unit_counts = np.bincount(unit_codes, minlength=n_units).astype(np.float64)[order]
+        self.unit_sums = np.bincount(unit_codes, weights=centered, minlength=n_units)[order]
+        self.grand_mean = float(values.mean())
+        self.strata = _strata(self.unit_cluster)
+
+
+def _f_statistics(labels, unit_counts, unit_sums, n_groups, total_ss, n_observations) -> np.ndarray:
+    """Computes the one-way ANOVA F of every row of unit group labels from the group counts and sums."""
+    unit_stats = np.stack([unit_sums, unit_counts], axis=1)
+    between_ss = np.zeros(len(labels))
+    remaining = np.zeros((len(labels), 2))
+    for group in range(n_groups - 1):
+        group_sum, group_count = ((labels == group).astype(np.float64) @ unit_stats).T
+        between_ss += group_sum**2 / group_count
+        remaining[:, 0] += group_sum
+        remaining[:, 1] += group_count
+
+    # The values are centered, so the last group holds minus the sum of the others, and the grand mean
+    # term of the between-group sum of squares is zero
+    between_ss += remaining[:, 0] ** 2 / (n_observations - remaining[:, 1])
+    within_ss = total_ss - between_ss
+    return (between_ss / (n_groups - 1)) / (within_ss / (n_observations - n_groups))
+
+
+def _anova_permutation_chunk(
+    seed, n, unit_group, unit_counts, unit_sums, strata, n_groups, total_ss, n_observations, observed
+) -> int:
+    """Counts the permutations of one chunk whose F is at least the observed F."""
+    rng = np.random.default_rng(seed)
+    n_extreme = 0
+    for batch_size in _batches(n, len(unit_group)):
+        labels = _permuted(rng, unit_group, strata, batch_size)
+        f_stats = _f_statistics(labels, unit_counts, unit_sums, n_groups, total_ss, n_observations)
+        n_extreme += int(np.count_nonzero(f_stats >= observed))
+    return n_extreme
+
+
+def permutation_anova(
+    values, groups, units=None, clusters=None, n_resamples: int = 10_000, seed: int = 0, n_workers: int = 1
+) -> dict:
+    """Tests the difference between group means with a one-way ANOVA F and a permutation p-value.
+
+    The group labels of the units are shuffled in large batches, and the F of every permutation is
+    computed from the group counts and sums of the units instead of from the observations. With
+    clusters, labels are only shuffled within each cluster (e.g. between the trials of a participant),
+    which keeps the repeated-measures structure of the data.
+
+    Args:
+        values (array-like): One value per observation, e.g. the HR of every beat.
+        groups (array-like): Group label of every observation, e.g. the music type.
+        units (array-like | None): Exchangeable unit of every observation, e.g. the trial of a beat.
+            Observations of a unit keep their shared label. By default every observation is a unit.
+        clusters (array-like | None): Cluster of every observation, e.g. the participant. Labels are
+            permuted within clusters. By default all units are exchangeable.
+        n_resamples (int): Number of permutations.
+        seed (int): Seed of the random permutations.
+        n_workers (int): Number of worker processes the chunks of permutations are spread over.
+
+    Returns:
+        dict: The observed F-statistic, its permutation p-value and the number of permutations.
+    """
+    data = _GroupedUnits(values, groups, units, clusters)
+    args = (data.unit_counts, data.unit_sums, data.n_groups, data.total_ss, data.n_observations)
+    observed = float(_f_statistics(data.unit_group[None, :], *args)[0])
+
+    # Allow for rounding when a permutation reproduces the observed grouping
+    threshold = observed - 1e-9 * abs(observed)
+    n_extreme = sum(
+        _run_chunks(
+            _anova_permutation_chunk,
+            n_resamples,
+            seed,
+            n_workers,
+            data.unit_group,
+            data.unit_counts,
+            data.unit_sums,
+            data.strata,
+            data.n_groups,
+            data.total_ss,
+            data.n_observations,
+            threshold,
+        )
+    )
+    return {
+        "f_statistic": observed,
+        "p_value": (n_extreme + 1) / (n_resamples + 1),
+        "n_resamples": n_resamples,
+    }
+
+
+def _group_means_bootstrap_chunk(seed, n, cluster_counts, cluster_sums) -> np.ndarray:
+    """Returns the group means of every bootstrap resample of one chunk."""
+    rng = np.random.default_rng(seed)
+    means = []
+    for batch_size in _batches(n, len(cluster_counts)):
+        weights = _resampled_weights(rng, len(cluster_counts), batch_size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means.append((weights @ cluster_sums) / (weights @ cluster_counts))
+    return np.concatenate(means)
+
+
+def bootstrap_group_means(
+    values,
+    groups,
+    units=None,
+    clusters=None,
+    n_resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    n_workers: int = 1,
+) -> dict:
+    """Computes percentile bootstrap confidence intervals of the group means.
+
+    Whole clusters are drawn with replacement if given (e.g. participants, with all their trials),
+    otherwise whole units. Every resample is summarized by the counts and sums of the drawn clusters.
+
+    Args:
+        values, groups, units, clusters: As in ``permutation_anova``.
+        n_resamples (int): Number of bootstrap resamples.
+        confidence (float): Coverage of the intervals, e.g. 0.95.
+        seed (int): Seed of the random resamples.
+        n_workers (int): Number of worker processes the chunks of resamples are spread over.
+
+    Returns:
+        dict: For every group, its mean and the lower and upper bound of its interval.
+    """
+    data = _GroupedUnits(values, groups, units, clusters)
+    resampled = data.unit_cluster if clusters is not None else np.arange(len(data.unit_group))
+    n_resampled = resampled.max() + 1
+
+    # Counts and sums of every group in every resampled cluster
+    cells = resampled * data.n_groups + data.unit_group
+    cluster_counts = np.bincount(cells, weights=data.unit_counts, minlength=n_resampled * data.n_groups)
+    cluster_sums = np.bincount(cells, weights=data.unit_sums, minlength=n_resampled * data.n_groups)
+    cluster_counts = cluster_counts.reshape(n_resampled, data.n_groups)
+    cluster_sums = cluster_sums.reshape(n_resampled, data.n_groups)
+
+    samples = np.concatenate(
+        _run_chunks(_group_means_bootstrap_chunk, n_resamples, seed, n_workers, cluster_counts, cluster_sums)
+    )
+    low, high = _percentile_interval(samples, confidence)
+    means = cluster_sums.sum(axis=0) / cluster_counts.sum(axis=0)
+    offset = data.grand_mean
+    return {
+        name: {"mean": float(mean + offset), "ci_low": float(lower + offset), "ci_high": float(upper + offset)}
+        for name, mean, lower, upper in zip(data.group_names.tolist(), means, low, high)
+    }
+
+
+def _paired(x, y, clusters) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Drops incomplete pairs, centers both variables and orders the pairs by cluster."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    cluster_codes = _factorize(clusters)[0] if clusters is not None else np.zeros(len(x), dtype=np.int64)
+    valid = ~np.isnan(x) & ~np.isnan(y) & (cluster_codes >= 0)
+    if valid.sum() < 3:
+        raise ValueError("At least three complete pairs are needed.")
+
+    order = np.argsort(cluster_codes[valid], kind="stable")
+    x, y, cluster_codes = x[valid][order], y[valid][order], cluster_codes[valid][order]
+    return x - x.mean(), y - y.mean(), cluster_codes
+
+
+def _pearson_permutation_chunk(seed, n, x, y, strata, observed) -> int:
+    """Counts the permutations of one chunk whose absolute correlation is at least the observed one."""
+    rng = np.random.default_rng(seed)
+    scale = np.sqrt((x @ x) * (y @ y))
+    n_extreme = 0
+    for batch_size in _batches(n, len(y)):
+        correlations = (_permuted(rng, y, strata, batch_size) @ x) / scale
+        n_extreme += int(np.count_nonzero(np.abs(correlations) >= observed))
+    return n_extreme
+
+
+def permutation_pearson(x, y, clusters=None, n_resamples: int = 10_000, seed: int = 0, n_workers: int = 1) -> dict:
+    """Tests a Pearson correlation with a two-sided permutation p-value.
+
+    Only the cross product changes between permutations, so every batch of permutations costs one
+    matrix-vector product. With clusters, y is only shuffled within each cluster.
+
+    Args:
+        x, y (array-like): The paired values; incomplete pairs are dropped.
+        clusters (array-like | None): Cluster of every pair, e.g. the participant.
+        n_resamples (int): Number of permutations.
+        seed (int): Seed of the random permutations.
+        n_workers (int): Number of worker processes the chunks of permutations are spread over.
+
+    Returns:
+        dict: The observed correlation, its permutation p-value and the number of permutations.
+    """
+    x, y, cluster_codes = _paired(x, y, clusters)
+    observed = float((x @ y) / np.sqrt((x @ x) * (y @ y)))
+    threshold = abs(observed) - 1e-9 * abs(observed)
+    n_extreme = sum(
+        _run_chunks(
+            _pearson_permutation_chunk, n_resamples, seed, n_workers, x, y, _strata(cluster_codes), threshold
+        )
+    )
+    return {
+        "correlation": observed,
+        "p_value": (n_extreme + 1) / (n_resamples + 1),
+        "n_resamples": n_resamples,
+    }
+
+
+def _pearson_bootstrap_chunk(seed, n, cluster_stats) -> np.ndarray:
+    """Returns the correlation of every bootstrap resample of one chunk."""
+    rng = np.random.default_rng(seed)
+    correlations = []
+    for batch_size in _batches(n, len(cluster_stats)):
+        n_pairs, sum_x, sum_y, sum_xx, sum_yy, sum_xy = (
+            _resampled_weights(rng, len(cluster_stats), batch_size) @ cluster_stats
+        ).T
+        with np.errstate(invalid="ignore", divide="ignore"):
+            covariance = sum_xy - sum_x * sum_y / n_pairs
+            correlations.append(
+                covariance / np.sqrt((sum_xx - sum_x**2 / n_pairs) * (sum_yy - sum_y**2 / n_pairs))
+            )
+    return np.concatenate(correlations)
+
+
+def bootstrap_pearson(
+    x, y, clusters=None, n_resamples: int = 10_000, confidence: float = 0.95, seed: int = 0, n_workers: int = 1
+) -> dict:
+    """Computes a percentile bootstrap confidence interval of a Pearson correlation.
+
+    Whole clusters are drawn with replacement if given, otherwise single pairs. Every resample is
+    summarized by the sums and cross products of the drawn clusters.
+
+    Args:
+        x, y (array-like): The paired values; incomplete pairs are dropped.
+        clusters (array-like | None): Cluster of every pair, e.g. the participant.
+        n_resamples (int): Number of bootstrap resamples.
+        confidence (float): Coverage of the interval, e.g. 0.95.
+        seed (int): Seed of the random resamples.
+        n_workers (int): Number of worker processes the chunks of resamples are spread over.
+
+    Returns:
+        dict: The correlation and the lower and upper bound of its interval.
+    """
+    x, y, cluster_codes = _paired(x, y, clusters)
+    resampled = cluster_codes if clusters is not None else np.arange(len(x))
+    cluster_stats = np.stack(
+        [
+            np.bincount(resampled, weights=weights)
+            for weights in (np.ones_like(x), x, y, x * x, y * y, x * y)
+        ],
+        axis=1,
+    )
+
+    samples = np.concatenate(_run_chunks(_pearson_bootstrap_chunk, n_resamples, seed, n_workers, cluster_stats))
+    low, high = _percentile_interval(samples[:, None], confidence)
+    return {
+        "correlation": float((x @ y) / np.sqrt((x @ x) * (y @ y))),
+        "ci_low": float(low[0]),
+        "ci_high": float(high[0]),
+    }
+
+
+def resample_anova(
+    values,
+    groups,
+    units=None,
+    clusters=None,
+    n_resamples: int = 10_000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    n_workers: int = 1,
+) -> dict:
+    """Runs ``permutation_anova`` and ``bootstrap_group_means`` with the same resampling structure.
+
+    Returns:
+        dict: "permutation_p_value", "n_resamples" and "mean_ci", the [lower, upper] interval of the
+        mean of every group, to be added to the statistics of an analysis.
+    """
+    test = permutation_anova(values, groups, units, clusters, n_resamples, seed, n_workers)
+    intervals = bootstrap_group_means(values, groups, units, clusters, n_resamples, confidence, seed, n_workers)
+    return {
+        "permutation_p_value": test["p_value"],
+        "n_resamples": n_resamples,
+        "mean_ci": {group: [interval["ci_low"], interval["ci_high"]] for group, interval in intervals.items()},
+    }
+
+
+def resample_pearson(
+    x, y, clusters=None, n_resamples: int = 10_000, confidence: float = 0.95, seed: int = 0, n_workers: int = 1
+) -> dict:
+    """Runs ``permutation_pearson`` and ``bootstrap_pearson`` with the same resampling structure.
+
+    Returns:
+        dict: "permutation_p_value", "n_resamples" and "correlation_ci", the [lower, upper] interval of
+        the correlation, to be added to the statistics of an analysis.
+    """
+    test = permutation_pearson(x, y, clusters, n_resamples, seed, n_workers)
+    interval = bootstrap_pearson(x, y, clusters, n_resamples, confidence, seed, n_workers)
+    return {
+        "permutation_p_value": test["p_value"],
+        "n_resamples": n_resamples,
+        "correlation_ci": [interval["ci_low"], interval["ci_high"]],
+    }
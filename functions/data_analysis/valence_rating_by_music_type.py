@@ -1,27 +1,41 @@
 import matplotlib.pyplot as plt
-import pandas as pd
 import seaborn as sns
 
+from functions.clearing_data.dataset import load_cube, load_trial_table
+from functions.data_analysis.figures import show_or_save
+from functions.data_analysis.resampling import resample_anova
+from functions.pipeline.instrumentation import instrumented, record
 
-def plot_valence_by_music_type(combined_data_file):
-    from scipy.stats import f_oneway
 
+@instrumented
+def plot_valence_by_music_type(
+    combined_data_file, output_files: list[str] | None = None, n_resamples: int = 0, n_workers: int = 1
+) -> dict:
     """
     Plots the distribution of valence rating by music type.
 
     Args:
-        combined_data_file (str): Path to the combined data file.
+        combined_data_file (str | AnalysisDataset): Path to the combined data file, or the loaded dataset.
+        output_files (list[str] | None): Files the figure is saved to instead of being shown.
+        n_resamples (int): If positive, the ANOVA is also tested with this many permutations of the
+            music types (within participants, if the data has a participant_id column), and the mean
+            valence per music type gets a bootstrap confidence interval.
+        n_workers (int): Number of worker processes for the resampling.
+
+    Returns:
+        dict: ANOVA F-statistic and p-value, whether the effect is significant and the mean valence
+        rating per music type. With resampling also the permutation p-value and the confidence
+        intervals of the means.
     """
-    data = pd.read_excel(combined_data_file)
+    data = load_trial_table(combined_data_file)
+    record(rows=len(data))
 
     plt.figure(figsize=(8, 6))
     sns.boxplot(x="music_type", y="valence_rating", hue="music_type", palette="pastel", data=data)
 
     # ANOVA test to check if music type affects valence rating
-    tonal = data[data["music_type"] == "tonal"]["valence_rating"]
-    atonal = data[data["music_type"] == "atonal"]["valence_rating"]
-    discord = data[data["music_type"] == "discord"]["valence_rating"]
-    f_stat, p_value = f_oneway(tonal, atonal, discord)
+    cube = load_cube(combined_data_file, data)
+    f_stat, p_value = cube.anova("valence_rating")
 
     print(f"ANOVA Test Results: F-statistic = {f_stat:.2f}, p-value = {p_value:.3e}")
     if p_value < 0.05:
@@ -33,4 +47,25 @@ def plot_valence_by_music_type(combined_data_file):
     plt.ylabel("Valence Rating", fontsize=12)
     plt.grid(alpha=0.3)
     plt.tight_layout()
-    plt.show()
+    show_or_save(output_files)
+
+    stats = {
+        "f_statistic": float(f_stat),
+        "p_value": float(p_value),
+        "significant": bool(p_value < 0.05),
+        "mean_valence": cube.group_stats("valence_rating")["mean"].to_dict(),
+    }
+
+    if n_resamples > 0:
+        clusters = data["participant_id"] if "participant_id" in data.columns else None
+        stats.update(
+            resample_anova(
+                data["valence_rating"],
+                data["music_type"],
+                clusters=clusters,
+                n_resamples=n_resamples,
+                n_workers=n_workers,
+            )
+        )
+        print(f"Permutation test ({n_resamples} permutations): p-value = {stats['permutation_p_value']:.3e}")
+    return stats
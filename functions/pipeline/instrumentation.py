@@ -0,0 +1,266 @@
+import cProfile
+import functools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak working set is read through the Win32 API instead
+    resource = None
+
+# The report collecting the stages of the current run, if any. Stages run outside of a report, which includes
+# the stages run in worker processes, are not measured.
+_active_report = None
+
+
+def _peak_rss_mib() -> tuple[float | None, float | None]:
+    """Returns the peak resident set size of this process and of its finished child processes in MiB."""
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS and in KiB elsewhere
+        scale = 2**20 if sys.platform == "darwin" else 2**10
+        return (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+        )
+
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (field, ctypes.c_size_t)
+                for field in [
+                    "PeakWorkingSetSize",
+                    "WorkingSetSize",
+                    "QuotaPeakPagedPoolUsage",
+                    "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage",
+                    "QuotaNonPagedPoolUsage",
+                    "PagefileUsage",
+                    "PeakPagefileUsage",
+                ]
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / 2**20, None
+    except (AttributeError, OSError):
+        pass
+    return None, None
+
+
+class StageRecord:
+    """Measurements of one stage, summed over all its calls during a run.
+
+    Attributes:
+        name (str): Path of the stage, e.g. "match_ppg_data/write_excel" for a stage run inside another.
+        calls (int): Number of times the stage ran.
+        wall_s (float): Elapsed time in seconds.
+        cpu_s (float): CPU time of this process in seconds.
+        children_cpu_s (float): CPU time of worker processes that finished during the stage.
+        peak_rss_mib (float | None): Peak resident memory of the process at the end of the stage.
+        peak_children_rss_mib (float | None): Peak resident memory of the largest finished worker process.
+        rss_growth_mib (float): How much the stage raised the peak resident memory.
+        rows, files, skipped, failed (int): Rows and files processed, and files skipped or failed.
+        errors (int): Calls that ended with an exception.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.children_cpu_s = 0.0
+        self.peak_rss_mib = None
+        self.peak_children_rss_mib = None
+        self.rss_growth_mib = 0.0
+        self.rows = 0
+        self.files = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = 0
+
+    def to_dict(self) -> dict:
+        """Returns the measurements with rounded times and memory."""
+        return {key: round(value, 4) if isinstance(value, float) else value for key, value in vars(self).items()}
+
+
+class RunReport:
+    """Collects the stage measurements of one run and writes them as a JSON report.
+
+    Stages may run on several threads, e.g. in a thread pool. Each thread has its own stack of running
+    stages, and the stages of another thread are nested in the stages that the thread which opened the
+    report was running when that thread measured its first stage.
+
+    Args:
+        profile_stage (str | None): Name of a stage to run under cProfile, e.g. "extract_beats".
+        profile_dir (str | None): Folder of the "<stage>.prof" dump, by default the working directory.
+    """
+
+    def __init__(self, profile_stage: str | None = None, profile_dir: str | None = None):
+        self.started = datetime.now()
+        self.records = {}
+        self.profile_stage = profile_stage
+        self.profile_dir = Path(profile_dir) if profile_dir else Path.cwd()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._main_stack = self._local.stack = []
+        self._profiler = cProfile.Profile() if profile_stage else None
+        self._profiling = False
+        self._wall_start = time.perf_counter()
+
+    @property
+    def _stack(self) -> list[str]:
+        """The running stages of the calling thread."""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = list(self._main_stack)
+        return stack
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measures the enclosed code as a stage, nested in the stage that is currently running."""
+        stack = self._stack
+        stack.append(name)
+        path = "/".join(stack)
+        with self._lock:
+            stage_record = self.records.get(path)
+            if stage_record is None:
+                stage_record = self.records[path] = StageRecord(path)
+            profile = name == self.profile_stage and not self._profiling
+            if profile:
+                self._profiling = True
+
+        start_rss, _ = _peak_rss_mib()
+        start_times = os.times()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profile:
+            self._profiler.enable()
+        try:
+            yield stage_record
+        except BaseException:
+            stage_record.errors += 1
+            raise
+        finally:
+            if profile:
+                self._profiler.disable()
+            end_times = os.times()
+            wall_s, cpu_s = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            end_rss, children_rss = _peak_rss_mib()
+            with self._lock:
+                if profile:
+                    self._profiling = False
+                stage_record.calls += 1
+                stage_record.wall_s += wall_s
+                stage_record.cpu_s += cpu_s
+                stage_record.children_cpu_s += (end_times.children_user + end_times.children_system) - (
+                    start_times.children_user + start_times.children_system
+                )
+                if end_rss is not None:
+                    stage_record.peak_rss_mib = max(stage_record.peak_rss_mib or 0.0, end_rss)
+                    stage_record.rss_growth_mib += end_rss - start_rss
+                if children_rss is not None:
+                    stage_record.peak_children_rss_mib = children_rss
+            stack.pop()
+
+    def current(self) -> StageRecord | None:
+        """Returns the record of the innermost stage running on the calling thread."""
+        stack = self._stack
+        return self.records["/".join(stack)] if stack else None
+
+    def add(self, rows: int = 0, files: int = 0, skipped: int = 0, failed: int = 0) -> None:
+        """Adds processed rows and files and skipped or failed files to the innermost running stage."""
+        stage_record = self.current()
+        if stage_record is not None:
+            with self._lock:
+                stage_record.rows += rows
+                stage_record.files += files
+                stage_record.skipped += skipped
+                stage_record.failed += failed
+
+    def to_dict(self) -> dict:
+        """Returns the report as a JSON-serializable dict."""
+        peak_rss, peak_children_rss = _peak_rss_mib()
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_s": round(time.perf_counter() - self._wall_start, 4),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "peak_rss_mib": round(peak_rss, 4) if peak_rss is not None else None,
+            "peak_children_rss_mib": round(peak_children_rss, 4) if peak_children_rss is not None else None,
+            "profile_stage": self.profile_stage,
+            "stages": [stage_record.to_dict() for stage_record in self.records.values()],
+        }
+
+    def save(self, report_path: str) -> None:
+        """Writes the JSON report and, if a stage was profiled, its cProfile dump."""
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        Path(report_path).write_text(json.dumps(self.to_dict(), indent=2))
+        if self._profiler is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self._profiler.dump_stats(self.profile_dir / f"{self.profile_stage}.prof")
+
+
+@contextmanager
+def run_report(report_path: str | None = None, profile_stage: str | None = None, profile_dir: str | None = None):
+    """Measures every instrumented stage that runs inside the block.
+
+    Args:
+        report_path (str | None): Where the JSON report is written when the block ends, if given.
+        profile_stage (str | None): Name of a stage to run under cProfile. The dump can be read with
+            ``python -m pstats <stage>.prof`` or a viewer such as snakeviz.
+        profile_dir (str | None): Folder of the cProfile dump, by default the working directory.
+
+    Yields:
+        RunReport: The report of the run.
+    """
+    global _active_report
+    previous_report = _active_report
+    _active_report = RunReport(profile_stage, profile_dir)
+    try:
+        yield _active_report
+    finally:
+        report, _active_report = _active_report, previous_report
+        if report_path is not None:
+            report.save(report_path)
+            print(f"Run report saved to {report_path}.")
+
+
+@contextmanager
+def stage(name: str):
+    """Measures the enclosed code as a stage of the active run report; does nothing outside of a report."""
+    if _active_report is None:
+        yield None
+    else:
+        with _active_report.stage(name) as stage_record:
+            yield stage_record
+
+
+def instrumented(function):
+    """Decorator measuring every call of a function as a stage named after it, e.g. "AnalysisDataset.save"."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _active_report is None:
+            return function(*args, **kwargs)
+        with _active_report.stage(function.__qualname__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def record(rows: int = 0, files: int = 0, skipped: int = 0, failed: int = 0) -> None:
+    """Adds processed rows and files and skipped or failed files to the innermost running stage."""
+    if _active_report is not None:
+        _active_report.add(rows, files, skipped, failed)
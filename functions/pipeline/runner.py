@@ -0,0 +1,431 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from functions.clearing_data.adding_ppg_to_trial_comb import add_ppg_data
+from functions.clearing_data.aggregate_cube import AggregateCube
+from functions.clearing_data.beat_sinks import open_beat_sink
+from functions.clearing_data.dataset import DATASET_FILE_NAME, AnalysisDataset
+from functions.clearing_data.loaders import FileIndex, file_key
+from functions.clearing_data.trial_combined import combine_trial_data
+from functions.clearing_data.window_features import WINDOW_FEATURES_VERSION
+from functions.pipeline.instrumentation import instrumented, stage
+
+STATE_FILE_NAME = "pipeline_state.json"
+PIPELINE_STAGES = ("ingest", "ppg", "is", "hrv")
+
+# Bump when the stored per-recording beats change, so they are extracted again
+BEAT_UNIT_VERSION = 2
+
+
+def stage_key(*parts) -> str:
+    """Hashes the inputs and parameters of a stage into a single key."""
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class PipelineState:
+    """Content hashes of the pipeline inputs and the keys of the last completed stages.
+
+    Hashes are stored together with the size and modification time of each file, so unchanged
+    files are not read again on the next run.
+    """
+
+    def __init__(self, state_dir: str):
+        self.state_dir = Path(state_dir)
+        self.state_path = self.state_dir / STATE_FILE_NAME
+
+        data = json.loads(self.state_path.read_text()) if self.state_path.exists() else {}
+        self.file_hashes = data.get("file_hashes", {})
+        self.stages = data.get("stages", {})
+
+    def file_hash(self, file_path: str) -> str:
+        """Returns the content hash of a file."""
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+
+        entry = self.file_hashes.get(file_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["hash"]
+
+        content_hash = hashlib.blake2b(digest_size=16)
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                content_hash.update(block)
+
+        self.file_hashes[file_path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": content_hash.hexdigest(),
+        }
+        return content_hash.hexdigest()
+
+    def folder_hashes(self, folder: str, file_names: list[str]) -> dict:
+        """Returns the content hash of each of the given files of a folder."""
+        return {file_name: self.file_hash(os.path.join(folder, file_name)) for file_name in file_names}
+
+    def save(self) -> None:
+        """Writes the state to disk."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = self.state_path.with_name(STATE_FILE_NAME + ".tmp")
+        tmp_path.write_text(json.dumps({"file_hashes": self.file_hashes, "stages": self.stages}))
+        os.replace(tmp_path, self.state_path)
+
+
+def _save_beat_unit(unit_path: Path, file_result: tuple) -> None:
+    """Stores the beats extracted from one PPG file."""
+    participant_id, session_id, beats, message = file_result
+    if beats is None:
+        np.savez(unit_path, message=message)
+    else:
+        np.savez(unit_path, participant_id=participant_id, session_id=session_id, **beats)
+
+
+def _load_beat_unit(unit_path: Path) -> tuple:
+    """Loads the beats of one PPG file stored by ``_save_beat_unit``."""
+    with np.load(unit_path) as unit:
+        if "message" in unit:
+            return None, None, None, str(unit["message"])
+        beats = {key: unit[key] for key in unit.files if key not in ("participant_id", "session_id")}
+        return int(unit["participant_id"]), int(unit["session_id"]), beats, None
+
+
+@instrumented
+def run_pipeline(
+    trial_data_path: str,
+    PPG_data_path: str,
+    HBD_data_path: str,
+    final_data_path: str,
+    selected_columns: list[str],
+    cache_dir: str | None = None,
+    n_workers: int = 1,
+    state_dir: str | None = None,
+    export_excel: bool = False,
+    stages: list[str] | None = None,
+    participants=None,
+    sink: str | None = None,
+) -> tuple[AnalysisDataset, dict]:
+    """Runs the cleaning stages, recomputing only what changed since the previous run.
+
+    Each input folder is scanned once and the resulting file index is shared by the stages. Every
+    input file and stage parameter is content-hashed. The trial ingest is kept per trial data file, the
+    PPG matching per participant, and R-peaks, IS values and the HRV of the trial windows per PPG
+    recording and per HBD file, so only new or modified files and participants are recomputed and the
+    stored results are reused for all others.
+
+    All stages work on one in-memory ``AnalysisDataset``, which is stored in a SQLite file in
+    final_data_path and returned so the analyses can use it without reading any file. Its aggregate
+    cube is built on the first run and afterwards only rebuilt for the participants whose trials, beats
+    or IS changed.
+
+    Args:
+        trial_data_path (str): Path to the folder containing trial data files.
+        PPG_data_path (str): Path to the folder containing the PPG CSV files.
+        HBD_data_path (str): Path to the folder containing Heartbeat Discrimination Test CSV files.
+        final_data_path (str): Folder where the dataset (and optionally the Excel files) is saved.
+        selected_columns (list[str]): List of trial data column names to extract.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        n_workers (int): Number of worker processes for the PPG stage, and of threads loading the PPG
+            recordings for the matching.
+        state_dir (str | None): Folder of the stored hashes and per-unit results. Defaults to
+            "pipeline_state" inside final_data_path.
+        export_excel (bool): If True, combined_data_trial.xlsx and R-peaks_and_HR.xlsx are also
+            written at the end.
+        stages (list[str] | None): Stages to run out of "ingest" (trial data, PPG matching and window features), "ppg"
+            (R-peaks and HR), "is" and "hrv" (HRV of the music windows). Defaults to all of them; the
+            others keep their stored results.
+        participants (container | None): If given, e.g. ``range(1, 51)``, only the files of these
+            participants are processed. This runs one shard of a cohort; see ``functions.pipeline.shards``.
+        sink (str | None): If given, the ppg stage also writes the beat table to final_data_path through
+            this output sink of ``open_beat_sink``, e.g. "parquet", one recording at a time. It is
+            rewritten when the beats changed or the output is missing.
+
+    Returns:
+        tuple[AnalysisDataset, dict]: The dataset and, for each stage, which files ("ingest", "ppg", "is",
+        "hrv") or participants ("match") were recomputed.
+    """
+    run_stages = set(stages) if stages is not None else set(PIPELINE_STAGES)
+    unknown_stages = run_stages - set(PIPELINE_STAGES)
+    if unknown_stages:
+        raise ValueError(f"Unknown pipeline stages: {', '.join(sorted(unknown_stages))}")
+    # Checked before any stage runs, so an unknown sink or a missing pyarrow fails early
+    beat_sink = open_beat_sink(sink, final_data_path) if sink is not None and "ppg" in run_stages else None
+
+    state_dir = Path(state_dir) if state_dir else Path(final_data_path) / "pipeline_state"
+    state = PipelineState(state_dir)
+    store_path = Path(final_data_path) / DATASET_FILE_NAME
+    stage_keys = state.stages.get("keys", {}) if store_path.exists() else {}
+    dataset = AnalysisDataset.load(store_path) if stage_keys else AnalysisDataset(pd.DataFrame())
+    summary = {"ingest": [], "match": [], "ppg": [], "is": [], "hrv": []}
+
+    # Stages that are not run keep the keys of their last run
+    ingest_key, match_key, ppg_key, is_key, hrv_key = (
+        stage_keys.get(key) for key in ("ingest", "match", "ppg", "is", "hrv")
+    )
+    update_trials = rebuild_beats = update_is = update_hrv = update_cube = False
+    changed_participants = set()
+
+    def scan(folder: str, kind: str) -> FileIndex:
+        file_index = FileIndex.scan(folder, kind)
+        return file_index.subset(participants) if participants is not None else file_index
+
+    if run_stages & {"ingest", "ppg"}:
+        ppg_index = scan(PPG_data_path, "ppg")
+        ppg_files = ppg_index.files
+        with stage("hash_inputs"):
+            ppg_hashes = state.folder_hashes(PPG_data_path, ppg_files)
+
+    if "ingest" in run_stages:
+        # 1. Trial data ingest, per trial data file
+        trial_index = scan(trial_data_path, "trial")
+        with stage("hash_inputs"):
+            trial_hashes = state.folder_hashes(trial_data_path, trial_index.files)
+        ingest_units = {
+            file_name: stage_key("ingest", selected_columns, file_hash) for file_name, file_hash in trial_hashes.items()
+        }
+        # The stored units only hold for the stored trials
+        stored_ingest_units = state.stages.get("ingest_units", {}) if "participant_id" in dataset.trials.columns else {}
+        changed_files = [
+            file_name
+            for file_name in trial_index.files
+            if stored_ingest_units.get(file_name) != ingest_units[file_name]
+        ]
+        removed_files = [file_name for file_name in stored_ingest_units if file_name not in ingest_units]
+        summary["ingest"] = changed_files
+        ingest_key = stage_key("ingest", ingest_units)
+
+        # 2. Matching PPG values to the trials, per participant
+        participant_ppg_hashes = {}
+        for file_name, file_hash in ppg_hashes.items():
+            participant_ppg_hashes.setdefault(ppg_index.participant_id(file_name), {})[file_name] = file_hash
+        match_units = {}
+        for file_name in trial_index.files:
+            participant_id = trial_index.participant_id(file_name)
+            if participant_id is not None:
+                match_units[str(participant_id)] = stage_key(
+                    "match",
+                    WINDOW_FEATURES_VERSION,
+                    ingest_units[file_name],
+                    participant_ppg_hashes.get(participant_id, {}),
+                )
+        stored_match_units = state.stages.get("match_units", {}) if stored_ingest_units else {}
+        matched_participants = {
+            int(participant_id)
+            for participant_id, unit_key in match_units.items()
+            if stored_match_units.get(participant_id) != unit_key
+        }
+        summary["match"] = sorted(matched_participants)
+        match_key = stage_key("match", match_units)
+
+        # The trials of all other participants are kept as stored
+        ingested_participants = {file_key(file_name, "trial") for file_name in changed_files + removed_files}
+        ingested_participants = {key[0] for key in ingested_participants if key is not None}
+        if ingested_participants or matched_participants:
+            stored_trials = dataset.trials if "participant_id" in dataset.trials.columns else None
+            trials = []
+            if changed_files:
+                changed_index = FileIndex(trial_data_path, "trial", changed_files)
+                trials.append(combine_trial_data(trial_data_path, selected_columns, file_index=changed_index))
+                print("Trial data cleaned and combined.")
+            rematched_only = matched_participants - ingested_participants
+            if rematched_only:
+                rows = stored_trials["participant_id"].isin(rematched_only)
+                trials.append(stored_trials.loc[rows, [*selected_columns, "participant_id"]])
+            trials = pd.concat(trials, ignore_index=True) if trials else pd.DataFrame()
+
+            if matched_participants:
+                add_ppg_data(
+                    trials,
+                    PPG_data_path,
+                    cache_dir,
+                    grouped=True,
+                    file_index=ppg_index.subset(matched_participants),
+                    n_workers=n_workers,
+                    window_features=True,
+                )
+                print("PPG is added to the combined trial data.")
+
+            changed_participants.update(ingested_participants | matched_participants)
+            if stored_trials is not None:
+                kept = stored_trials[~stored_trials["participant_id"].isin(changed_participants)]
+                trials = trials.astype({col: dtype for col, dtype in kept.dtypes.items() if col in trials.columns})
+                trials = pd.concat([kept, trials], ignore_index=True)
+            dataset.trials = trials.sort_values("participant_id", kind="stable", ignore_index=True)
+            update_trials = True
+        else:
+            print("Trial data and PPG files unchanged, reusing the combined trial data and the matched PPG values.")
+
+    if "ppg" in run_stages:
+        # Imported here so that the other stages do not pay for importing scipy.signal
+        from functions.clearing_data.calc_r_peaks_from_ppg import build_beat_table, extract_beats
+
+        # 3. R-peaks and HR, per PPG recording
+        unit_dir = state_dir / "ppg"
+        os.makedirs(unit_dir, exist_ok=True)
+        ppg_units = state.stages.get("ppg_units", {})
+        removed_files = [file_name for file_name in ppg_units if file_name not in ppg_hashes]
+        unit_keys = {
+            file_name: stage_key("ppg", BEAT_UNIT_VERSION, file_hash) for file_name, file_hash in ppg_hashes.items()
+        }
+        changed_files = [
+            file_name
+            for file_name in ppg_files
+            if ppg_units.get(file_name) != unit_keys[file_name] or not (unit_dir / f"{file_name}.npz").exists()
+        ]
+        summary["ppg"] = changed_files
+
+        file_results = extract_beats(PPG_data_path, changed_files, cache_dir, n_workers)
+        for file_name, file_result in zip(changed_files, file_results):
+            _save_beat_unit(unit_dir / f"{file_name}.npz", file_result)
+        state.stages["ppg_units"] = unit_keys
+        state.save()
+
+        ppg_key = stage_key("ppg", unit_keys)
+        rebuild_beats = stage_keys.get("ppg") != ppg_key
+        if rebuild_beats:
+            for file_name in changed_files + removed_files:
+                key = file_key(file_name, "ppg")
+                if key:
+                    changed_participants.add(key[0])
+            file_results = [_load_beat_unit(unit_dir / f"{file_name}.npz") for file_name in ppg_files]
+            dataset.beats = build_beat_table(file_results)
+            print("R-peaks and HR are extracted." if dataset.beats is not None else "No R-peaks or HR were extracted.")
+        else:
+            print("PPG files unchanged, reusing the R-peaks and HR.")
+
+        if beat_sink is not None and (rebuild_beats or not beat_sink.path.exists()):
+            with stage("write_beats"):
+                for file_name in ppg_files:
+                    beats = build_beat_table([_load_beat_unit(unit_dir / f"{file_name}.npz")])
+                    if beats is not None:
+                        beat_sink.write(beats)
+                beat_sink.close()
+
+    if "is" in run_stages:
+        # Imported here so that the other stages do not pay for importing scipy.optimize
+        from functions.clearing_data.is_to_excel import apply_is_values, participant_is
+
+        # 4. Interoceptive sensitivity, per HBD file
+        hbd_files = scan(HBD_data_path, "hbd").files
+        with stage("hash_inputs"):
+            hbd_hashes = state.folder_hashes(HBD_data_path, hbd_files)
+        stored_units = state.stages.get("is_units", {})
+        is_units = {file: unit for file, unit in stored_units.items() if unit["hash"] == hbd_hashes.get(file)}
+        changed_files = [file for file in hbd_files if file not in is_units]
+        summary["is"] = changed_files
+
+        for file in changed_files:
+            with stage("participant_is"):
+                participant_id, IS_value = participant_is(HBD_data_path, file)
+            is_units[file] = {"hash": hbd_hashes[file], "participant_id": participant_id, "IS": IS_value}
+        state.stages["is_units"] = is_units
+        state.save()
+
+        if "participant_id" not in dataset.trials.columns:
+            print("No combined trial data to add the IS values to. Run the ingest stage first.")
+        else:
+            is_key = stage_key("is", match_key, hbd_hashes)
+            update_is = update_trials or stage_keys.get("is") != is_key
+            if update_is:
+                is_values = {
+                    unit["participant_id"]: unit["IS"] for unit in is_units.values() if unit["IS"] is not None
+                }
+                apply_is_values(dataset.trials, is_values)
+                changed_participants.update(is_units[file]["participant_id"] for file in changed_files)
+                changed_participants.update(
+                    unit["participant_id"] for file, unit in stored_units.items() if file not in is_units
+                )
+                print("Calculation complete. IS values have been added to the combined trial data.")
+            else:
+                print("HBD files unchanged, reusing the IS values.")
+
+    if "hrv" in run_stages:
+        from functions.clearing_data.hrv import HRV_COLUMNS, HRV_VERSION, trial_hrv
+
+        # 5. HRV of the music window of every trial, per PPG recording
+        ppg_units = state.stages.get("ppg_units", {})
+        if dataset.beats is None or "PPG_music_start" not in dataset.trials.columns:
+            print("No trial data or R-peaks to compute the HRV from. Run the ingest and ppg stages first.")
+        else:
+            # A recording is recomputed when its beats or the windows of its trials change
+            unit_dir = state_dir / "hrv"
+            os.makedirs(unit_dir, exist_ok=True)
+            trial_groups = dataset.trials.groupby(["participant_id", "session"], sort=False).indices
+            windows = dataset.trials[["PPG_music_start", "PPG_response_start"]].to_numpy(dtype=np.float64)
+            recordings, hrv_units = {}, {}
+            for file_name, unit_key in ppg_units.items():
+                rows = trial_groups.get(file_key(file_name, "ppg"))
+                if rows is not None:
+                    recordings[file_name] = rows
+                    hrv_units[file_name] = stage_key("hrv", HRV_VERSION, unit_key, windows[rows].tolist())
+            stored_units = state.stages.get("hrv_units", {})
+            changed_files = [
+                file_name
+                for file_name in recordings
+                if stored_units.get(file_name) != hrv_units[file_name] or not (unit_dir / f"{file_name}.npz").exists()
+            ]
+            summary["hrv"] = changed_files
+
+            if changed_files:
+                # All changed recordings are computed together
+                with stage("trial_hrv"):
+                    keys = pd.MultiIndex.from_tuples([file_key(file_name, "ppg") for file_name in changed_files])
+                    beats = dataset.beats[
+                        pd.MultiIndex.from_frame(dataset.beats[["participant_id", "session_id"]]).isin(keys)
+                    ]
+                    rows = np.concatenate([recordings[file_name] for file_name in changed_files])
+                    metrics = trial_hrv(beats, dataset.trials.iloc[rows].reset_index(drop=True))
+                offsets = np.cumsum([0] + [len(recordings[file_name]) for file_name in changed_files])
+                for file_name, start, end in zip(changed_files, offsets[:-1], offsets[1:]):
+                    unit = {col: metrics[col].to_numpy()[start:end] for col in HRV_COLUMNS}
+                    np.savez(unit_dir / f"{file_name}.npz", **unit)
+            state.stages["hrv_units"] = hrv_units
+            state.save()
+
+            hrv_key = stage_key("hrv", match_key, hrv_units)
+            update_hrv = (
+                update_trials
+                or stage_keys.get("hrv") != hrv_key
+                or not set(HRV_COLUMNS) <= set(dataset.trials.columns)
+            )
+            if update_hrv:
+                values = {col: np.full(len(dataset.trials), np.nan) for col in HRV_COLUMNS}
+                for file_name, rows in recordings.items():
+                    with np.load(unit_dir / f"{file_name}.npz") as unit:
+                        for col in HRV_COLUMNS:
+                            values[col][rows] = unit[col]
+                for col in HRV_COLUMNS:
+                    dataset.trials[col] = values[col]
+                print("HRV of the music windows is added to the combined trial data.")
+            else:
+                print("R-peaks and trials unchanged, reusing the HRV.")
+
+    # 6. Aggregate cube, rebuilt as a whole on the first run and otherwise per changed participant
+    if "participant_id" in dataset.trials.columns:
+        cube = dataset.cube
+        rebuild_cube = cube is None or (dataset.beats is not None and "HR_n" not in cube.cells.columns)
+        if rebuild_cube or changed_participants:
+            with stage("aggregate_cube"):
+                if rebuild_cube:
+                    dataset.cube = AggregateCube.from_tables(dataset.trials, dataset.beats)
+                else:
+                    changed_participants.discard(None)
+                    dataset.cube = cube.update(dataset.trials, dataset.beats, changed_participants)
+            update_cube = True
+
+    # Store the dataset before recording the stages as done
+    if update_trials or rebuild_beats or update_is or update_hrv or update_cube:
+        dataset.save(store_path)
+        if "ingest" in run_stages:
+            state.stages["ingest_units"] = ingest_units
+            state.stages["match_units"] = match_units
+        state.stages["keys"] = {"ingest": ingest_key, "match": match_key, "ppg": ppg_key, "is": is_key, "hrv": hrv_key}
+        state.save()
+
+    if export_excel:
+        dataset.export_excel(final_data_path)
+
+    return dataset, summary
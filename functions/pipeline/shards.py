@@ -0,0 +1,95 @@
+from pathlib import Path
+
+from functions.clearing_data.dataset import DATASET_FILE_NAME, AnalysisDataset
+from functions.pipeline.instrumentation import instrumented, record
+from functions.pipeline.runner import run_pipeline
+
+
+def parse_participant_range(text: str) -> range:
+    """Parses a participant range such as "1-50" (inclusive) or "7" into a range."""
+    first, _, last = text.partition("-")
+    try:
+        return range(int(first), int(last or first) + 1)
+    except ValueError:
+        raise ValueError(f"Invalid participant range {text}, expected e.g. 1-50.") from None
+
+
+@instrumented
+def run_shard(
+    trial_data_path: str,
+    PPG_data_path: str,
+    HBD_data_path: str,
+    shard_path: str,
+    selected_columns: list[str],
+    participants: range,
+    cache_dir: str | None = None,
+    n_workers: int = 1,
+    sink: str | None = None,
+) -> AnalysisDataset:
+    """Runs all cleaning stages for one range of participants, e.g. on one of several machines.
+
+    The shard folder gets the trial and beat tables and the aggregate cube of its participants. Files of
+    other participants, and files whose name has no participant ID, are ignored. Like a full run, a shard
+    only recomputes what changed when it is run again.
+
+    Args:
+        trial_data_path (str): Path to the folder containing trial data files.
+        PPG_data_path (str): Path to the folder containing the PPG CSV files.
+        HBD_data_path (str): Path to the folder containing Heartbeat Discrimination Test CSV files.
+        shard_path (str): Output folder of the shard.
+        selected_columns (list[str]): List of trial data column names to extract.
+        participants (range): Participant IDs of the shard.
+        cache_dir (str | None): Folder of the binary PPG cache, if used.
+        n_workers (int): Number of worker processes for the PPG stage.
+        sink (str | None): Output sink of the shard's beat table, as for ``run_pipeline``.
+
+    Returns:
+        AnalysisDataset: The dataset of the shard.
+    """
+    Path(shard_path).mkdir(parents=True, exist_ok=True)
+    dataset, _ = run_pipeline(
+        trial_data_path,
+        PPG_data_path,
+        HBD_data_path,
+        shard_path,
+        selected_columns,
+        cache_dir=cache_dir,
+        n_workers=n_workers,
+        participants=participants,
+        sink=sink,
+    )
+    print(f"Shard of participants {participants.start}-{participants.stop - 1} saved to {shard_path}.")
+    return dataset
+
+
+@instrumented
+def merge_shards(shard_paths: list[str], final_data_path: str) -> AnalysisDataset:
+    """Combines the datasets of the shards into the final dataset.
+
+    The shards hold disjoint participants and their cubes hold counts, sums and sums of squares, which
+    add up, so the merged dataset equals the one of a single run over all participants and the
+    analyses give the same results on it.
+
+    Args:
+        shard_paths (list[str]): Output folders of ``run_shard``.
+        final_data_path (str): Folder where the merged dataset is saved.
+
+    Returns:
+        AnalysisDataset: The merged dataset.
+
+    Raises:
+        ValueError: If a shard folder has no dataset or the shards share participants.
+    """
+    datasets = []
+    for shard_path in shard_paths:
+        store_path = Path(shard_path) / DATASET_FILE_NAME
+        if not store_path.exists():
+            raise ValueError(f"No shard dataset found in {shard_path}.")
+        datasets.append(AnalysisDataset.load(store_path))
+
+    dataset = AnalysisDataset.merge(datasets)
+    Path(final_data_path).mkdir(parents=True, exist_ok=True)
+    dataset.save(Path(final_data_path) / DATASET_FILE_NAME)
+    record(files=len(shard_paths), rows=len(dataset.trials))
+    print(f"{len(shard_paths)} shards merged into {final_data_path}.")
+    return dataset
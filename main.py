@@ -1,46 +1,239 @@
-"""This script is the main code with all the functions neede to filter the data.
+"""This script is the command-line entry point with all the functions needed to clean and analyze the data.
 
-It uses the combine_ppg_averages function to calculate PPG averages and the filter_to_new_excel function
-to filter the trial data based on selected columns.
+Every subcommand runs one part of the pipeline on the folders of the data directory:
+
+    python main.py all                     # clean the data and analyze it
+    python main.py ingest                  # combine the trial data and match the PPG values
+    python main.py ppg                     # extract R-peaks and HR from the PPG recordings
+    python main.py is                      # calculate the interoceptive sensitivity
+    python main.py hrv                     # compute the HRV of every trial's music window
+    python main.py analyze --batch         # render the figures to files instead of showing them
+    python main.py shard --participants 1-50 --output shards/a    # clean one range of participants
+    python main.py merge --shards shards/a shards/b               # combine the shards and analyze them
+    python main.py serve --port 8765       # answer filtered analyses as JSON, e.g. /anova?measure=HR&session=1
+    python main.py sweep --prominence 0.1 0.15 0.2 --distance 0.4 0.6    # compare peak-detection settings
+
+The cleaning stages only recompute what changed since the previous run. Libraries are imported by the
+subcommands that need them, so e.g. "ingest" does not load matplotlib, seaborn or scipy.
 """
 
-# Import the functions
-from functions.clearing_data.adding_ppg_to_trial_comb import match_ppg_data
-from functions.clearing_data.calc_r_peaks_from_ppg import process_ppg_folder
-from functions.clearing_data.is_to_excel import calculate_is
-from functions.clearing_data.trial_combined import filter_to_new_excel
-from functions.data_analysis.Average_valence_scrore_to_IS import analyze_valence_vs_IS
-from functions.data_analysis.HB_by_music_type import plot_hr_by_music_type
-from functions.data_analysis.is_to_music_type import analyze_music_type_vs_IS
-from functions.data_analysis.music_type_to_rt import analyze_rt_by_music_type
-from functions.data_analysis.valence_rating_by_music_type import plot_valence_by_music_type
-
-# Path to the final data folder
-final_data_path = r"C:\Users\Home\Desktop\Studies\Phyton\projects 2024-2025\Final_project\data"
-# Path to the folder with trial data
-trial_data_path = r"C:\Users\Home\Desktop\Studies\Phyton\projects 2024-2025\Final_project\data\trial_data"
-# Path to the folder with PPG files
-PPG_data_path = r"C:\Users\Home\Desktop\Studies\Phyton\projects 2024-2025\Final_project\data\PPG_data"
-# Path to the folder with HBD data
-HBD_data_path = r"C:\Users\Home\Desktop\Studies\Phyton\projects 2024-2025\Final_project\data\HBD_data"
-# Path to R-peaks data
-R_peak_data_path = r"C:\Users\Home\Desktop\Studies\Phyton\projects 2024-2025\Final_project\data\R-peaks.xlsx"
-# Path to the trial_combined
-combined_data_file = (
-    r"C:\Users\Home\Desktop\Studies\Phyton\projects 2024-2025\Final_project\data\combined_data_trial.xlsx"
-)
-selected_columns = ["session", "music_type", "valence_rating", "RT", "PPG_music_start", "PPG_response_start"]
-
-
-# Call the clearing and calculating data functions
-filter_to_new_excel(trial_data_path, selected_columns, final_data_path)
-match_ppg_data(combined_data_file, PPG_data_path)
-process_ppg_folder(PPG_data_path, final_data_path)
-calculate_is(HBD_data_path, combined_data_file)
-
-# Call the analyzing functions
-plot_valence_by_music_type(combined_data_file)
-plot_hr_by_music_type(R_peak_data_path, combined_data_file)
-analyze_music_type_vs_IS(combined_data_file)
-analyze_rt_by_music_type(combined_data_file)
-analyze_valence_vs_IS(combined_data_file)
+import argparse
+import os
+from pathlib import Path
+
+# Path to the data folder, next to this script by default
+DEFAULT_DATA_PATH = Path(__file__).resolve().parent / "data"
+SELECTED_COLUMNS = [
+    "session",
+    "music_type",
+    "valence_rating",
+    "RT",
+    "PPG_music_start",
+    "PPG_response_start",
+    "PPG_ITI_start",
+]
+
+
+def run_stages(args: argparse.Namespace, stages: list[str] | None = None):
+    """Runs the given cleaning stages (all if None) and returns the dataset."""
+    from functions.pipeline.runner import run_pipeline
+
+    dataset, _ = run_pipeline(
+        args.trial_data,
+        args.ppg_data,
+        args.hbd_data,
+        args.output,
+        SELECTED_COLUMNS,
+        cache_dir=args.ppg_cache,
+        n_workers=args.workers,
+        export_excel=args.export_excel,
+        stages=stages,
+        sink=args.sink,
+    )
+    return dataset
+
+
+def load_dataset(args: argparse.Namespace):
+    """Loads the dataset stored by the last cleaning run, or returns None if there is none."""
+    from functions.clearing_data.dataset import DATASET_FILE_NAME, AnalysisDataset
+
+    store_path = Path(args.output) / DATASET_FILE_NAME
+    if not store_path.exists():
+        print(f"No cleaned dataset found in {args.output}. Run the ingest, ppg and is stages first.")
+        return None
+    return AnalysisDataset.load(store_path)
+
+
+def analyze(args: argparse.Namespace, dataset=None) -> None:
+    """Runs the analyses on the given dataset, or on the dataset stored by the last cleaning run."""
+    if dataset is None:
+        dataset = load_dataset(args)
+        if dataset is None:
+            return
+
+    if args.batch:
+        from functions.data_analysis.batch_report import render_report
+
+        render_report(
+            dataset, dataset, args.figures, formats=args.formats, n_workers=args.workers, n_resamples=args.resamples
+        )
+        return
+
+    from functions.data_analysis.Average_valence_scrore_to_IS import analyze_valence_vs_IS
+    from functions.data_analysis.HB_by_music_type import plot_hr_by_music_type
+    from functions.data_analysis.is_to_music_type import analyze_music_type_vs_IS
+    from functions.data_analysis.music_type_to_rt import analyze_rt_by_music_type
+    from functions.data_analysis.valence_rating_by_music_type import plot_valence_by_music_type
+
+    plot_valence_by_music_type(dataset, n_resamples=args.resamples, n_workers=args.workers)
+    plot_hr_by_music_type(dataset, dataset, n_resamples=args.resamples, n_workers=args.workers)
+    analyze_music_type_vs_IS(dataset)
+    analyze_rt_by_music_type(dataset, n_resamples=args.resamples, n_workers=args.workers)
+    analyze_valence_vs_IS(dataset, n_resamples=args.resamples, n_workers=args.workers)
+
+
+def run_shard(args: argparse.Namespace) -> None:
+    """Runs the cleaning stages for the participant range of the shard."""
+    from functions.pipeline.shards import parse_participant_range, run_shard
+
+    run_shard(
+        args.trial_data,
+        args.ppg_data,
+        args.hbd_data,
+        args.output,
+        SELECTED_COLUMNS,
+        parse_participant_range(args.participants),
+        cache_dir=args.ppg_cache,
+        n_workers=args.workers,
+        sink=args.sink,
+    )
+
+
+def merge_shards(args: argparse.Namespace):
+    """Combines the shard datasets into the dataset in the output folder and returns it."""
+    from functions.pipeline.shards import merge_shards
+
+    return merge_shards(args.shards, args.output)
+
+
+def serve(args: argparse.Namespace) -> None:
+    """Answers analysis queries over HTTP from the stored dataset until interrupted."""
+    from functions.data_analysis.query_server import make_server
+
+    dataset = load_dataset(args)
+    if dataset is None:
+        return
+    server = make_server(dataset, args.host, args.port)
+    print(f"Answering queries on http://{args.host}:{server.server_port}/ (Ctrl+C to stop).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def sweep(args: argparse.Namespace) -> None:
+    """Runs the peak detection with every combination of the given settings and saves the HR summaries."""
+    from functions.clearing_data.peak_sweep import parameter_grid, parse_limits, summarize_sweep, sweep_folder
+
+    grid = parameter_grid(
+        [parse_limits(band) for band in args.bands],
+        args.prominence,
+        args.distance,
+        [parse_limits(limits) for limits in args.rr_limits],
+        [parse_limits(limits) for limits in args.hr_limits],
+    )
+    results = sweep_folder(args.ppg_data, grid, cache_dir=args.ppg_cache, n_workers=args.workers)
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    results.to_csv(Path(args.output) / "peak_sweep.csv", index=False)
+    print(summarize_sweep(results).to_string(index=False))
+    print(f"HR summaries of {len(grid)} parameter sets saved to {Path(args.output) / 'peak_sweep.csv'}.")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Builds the parser of the subcommands and their path and configuration arguments."""
+    paths = argparse.ArgumentParser(add_help=False)
+    paths.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_PATH, help="data folder (default: %(default)s)")
+    paths.add_argument("--trial-data", help="folder with the trial data (default: DATA_DIR/trial_data)")
+    paths.add_argument("--ppg-data", help="folder with the PPG files (default: DATA_DIR/PPG_data)")
+    paths.add_argument("--hbd-data", help="folder with the HBD files (default: DATA_DIR/HBD_data)")
+    paths.add_argument("--ppg-cache", help="binary cache of the PPG files (default: DATA_DIR/PPG_cache)")
+    paths.add_argument("--no-cache", action="store_true", help="parse the PPG CSV files instead of using the cache")
+    paths.add_argument("--output", help="folder of the cleaned dataset and reports (default: DATA_DIR)")
+    paths.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: all cores)")
+    paths.add_argument("--export-excel", action="store_true", help="also write the cleaned data as Excel files")
+    paths.add_argument(
+        "--sink",
+        choices=["excel", "csv", "sqlite", "parquet", "feather"],
+        help="also write the beat table to R-peaks_and_HR in this format, one recording at a time",
+    )
+    paths.add_argument("--report", help="JSON run report with the time and memory of every stage")
+    paths.add_argument("--profile-stage", help="stage to profile with cProfile, e.g. extract_beats")
+
+    figures = argparse.ArgumentParser(add_help=False)
+    figures.add_argument("--batch", action="store_true", help="render the figures to files instead of showing them")
+    figures.add_argument("--figures", help="folder of the rendered figures (default: OUTPUT/figures)")
+    figures.add_argument("--formats", nargs="+", default=["png", "svg"], help="image formats of the figures")
+    figures.add_argument(
+        "--resamples", type=int, default=0, help="permutation and bootstrap resamples of the tests (default: none)"
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("ingest", parents=[paths], help="combine the trial data and match the PPG values")
+    subcommands.add_parser("ppg", parents=[paths], help="extract R-peaks and HR from the PPG recordings")
+    subcommands.add_parser("is", parents=[paths], help="calculate the interoceptive sensitivity")
+    subcommands.add_parser("hrv", parents=[paths], help="compute the HRV of every trial's music window")
+    subcommands.add_parser("analyze", parents=[paths, figures], help="run the analyses on the cleaned dataset")
+    subcommands.add_parser("all", parents=[paths, figures], help="run all cleaning stages and the analyses")
+    shard = subcommands.add_parser("shard", parents=[paths], help="run the cleaning stages for some participants")
+    shard.add_argument("--participants", required=True, help="participant IDs of the shard, e.g. 1-50")
+    merge = subcommands.add_parser("merge", parents=[paths, figures], help="combine shards and run the analyses")
+    merge.add_argument("--shards", nargs="+", required=True, help="output folders of the shards")
+    server = subcommands.add_parser("serve", parents=[paths], help="answer analysis queries over HTTP")
+    server.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    server.add_argument("--port", type=int, default=8765, help="port to listen on (default: %(default)s)")
+    peaks = subcommands.add_parser("sweep", parents=[paths], help="compare PPG peak-detection settings")
+    peaks.add_argument("--bands", nargs="+", default=["0.5-5"], help="filter pass bands in Hz (default: %(default)s)")
+    peaks.add_argument("--prominence", nargs="+", type=float, default=[0.15], help="prominence factors")
+    peaks.add_argument("--distance", nargs="+", type=float, default=[0.6], help="minimum peak distances in seconds")
+    peaks.add_argument("--rr-limits", nargs="+", default=["0.3-1.5"], help="valid RR intervals in seconds")
+    peaks.add_argument("--hr-limits", nargs="+", default=["40-200"], help="valid HR values in bpm")
+    return parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = build_parser().parse_args(argv)
+
+    # Paths that were not given default to the layout of the data folder
+    args.trial_data = args.trial_data or str(args.data_dir / "trial_data")
+    args.ppg_data = args.ppg_data or str(args.data_dir / "PPG_data")
+    args.hbd_data = args.hbd_data or str(args.data_dir / "HBD_data")
+    args.ppg_cache = None if args.no_cache else args.ppg_cache or str(args.data_dir / "PPG_cache")
+    args.output = args.output or str(args.data_dir)
+    if hasattr(args, "figures"):
+        args.figures = args.figures or str(Path(args.output) / "figures")
+
+    from functions.pipeline.instrumentation import run_report
+
+    with run_report(args.report, args.profile_stage, profile_dir=args.output):
+        if args.command == "analyze":
+            analyze(args)
+        elif args.command == "all":
+            analyze(args, run_stages(args))
+        elif args.command == "shard":
+            run_shard(args)
+        elif args.command == "merge":
+            analyze(args, merge_shards(args))
+        elif args.command == "serve":
+            serve(args)
+        elif args.command == "sweep":
+            sweep(args)
+        else:
+            run_stages(args, [args.command])
+
+
+# The guard keeps the worker processes of the parallel stages from re-running the pipeline
+if __name__ == "__main__":
+    main()
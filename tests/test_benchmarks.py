@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks.run_benchmarks import compare_runs
+from benchmarks.synthetic_cohort import generate_cohort
+from functions.clearing_data.calc_r_peaks_from_ppg import calculate_hr, rpeaks_from_ppg
+
+
+def test_generate_cohort_layout_and_heart_rate(tmp_path):
+    """Test that a synthetic cohort has the layout of the data folder and a detectable pulse."""
+    generate_cohort(tmp_path, n_participants=2, session_minutes=3)
+
+    assert sorted(p.name for p in (tmp_path / "PPG_data").iterdir()) == [
+        "sub-01_sess1_PPG.csv",
+        "sub-01_sess2_PPG.csv",
+        "sub-02_sess1_PPG.csv",
+        "sub-02_sess2_PPG.csv",
+    ]
+    trial_data = pd.read_csv(tmp_path / "trial_data" / "sub-01_trial_data.csv")
+    assert set(trial_data["music_type"]) <= {"tonal", "atonal", "discord"}
+    assert (trial_data["PPG_response_start"] > trial_data["PPG_music_start"]).all()
+    hbd_data = pd.read_csv(tmp_path / "HBD_data" / "sub-01_HBD.csv")
+    assert len(hbd_data) == 24 and hbd_data["resting_RRI"].notna().sum() == 1
+
+    ppg_data = pd.read_csv(tmp_path / "PPG_data" / "sub-01_sess1_PPG.csv")
+    assert np.allclose(np.diff(ppg_data["time"]), 0.01)
+    _, hr_values, valid = calculate_hr(rpeaks_from_ppg(ppg_data["PPG"].values, 100), 100)
+    resting_hr = 60 / hbd_data["resting_RRI"].dropna().iloc[0]
+    assert valid.mean() > 0.95
+    assert abs(np.median(hr_values[valid]) - resting_hr) < 5
+
+
+def test_compare_runs_reports_regressions():
+    """Test that only steps that grew beyond the tolerance are reported."""
+    previous = {"commit": "abc123", "steps": {"a": {"wall_s": 1.0, "peak_mib": 10.0}, "b": {"wall_s": 1.0}}}
+    current = {"steps": {"a": {"wall_s": 1.1, "peak_mib": 20.0}, "b": {"wall_s": 2.0}, "c": {"wall_s": 5.0}}}
+
+    regressions = compare_runs(previous, current, tolerance=0.2)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("a: peak_mib") and regressions[1].startswith("b: wall_s")
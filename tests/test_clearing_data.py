@@ -1,13 +1,32 @@
+import os
 from unittest.mock import patch
 
 import numpy as np
 import pandas as pd
+import pytest
+from scipy.stats import f_oneway
+
 from functions.clearing_data.adding_ppg_to_trial_comb import match_ppg_data
-from functions.clearing_data.calc_r_peaks_from_ppg import process_ppg_folder
+from functions.clearing_data.aggregate_cube import AggregateCube
+from functions.clearing_data.beat_sinks import ARROW_AVAILABLE, read_beat_table
+from functions.clearing_data.beat_trial_join import assign_beats_to_trials, summarize_trial_hr
+from functions.clearing_data.calc_r_peaks_from_ppg import (
+    calculate_hr,
+    process_ppg_folder,
+    rpeaks_from_ppg,
+    rpeaks_from_ppg_chunked,
+)
+from functions.clearing_data.dataset import AnalysisDataset
+from functions.clearing_data.hrv import window_hrv
+from functions.clearing_data.loaders import FileIndex, read_table
+from functions.clearing_data.peak_sweep import parameter_grid, summarize_sweep, sweep_folder
+from functions.clearing_data.ppg_cache import load_ppg_recording
+from functions.clearing_data.streaming_beats import StreamingBeatDetector
 
 # Importing functions from clearing_data module
-from functions.clearing_data.is_to_excel import calculate_is
-from functions.clearing_data.trial_combined import filter_to_new_excel
+from functions.clearing_data.is_to_excel import calculate_is, compute_is_values, compute_is_values_batch
+from functions.clearing_data.trial_combined import combine_trial_data, filter_to_new_excel
+from functions.clearing_data.window_features import PrefixStats, trial_window_features
 
 
 @patch("os.listdir", return_value=["sub-1_sess1_HBD.csv", "sub-2_sess1_HBD.csv"])
@@ -46,6 +65,27 @@ def test_filter_to_new_excel(mock_to_excel, mock_read_csv, mock_listdir, mock_re
     mock_to_excel.assert_called_once()
 
 
+@patch(
+    "os.listdir",
+    return_value=["sub-07_trial_data.csv", "notes.txt", "trial_data_pilot.csv", "sub-03_trial_data.csv"],
+)
+@patch("pandas.read_csv")
+def test_combine_trial_data_participant_ids(mock_read_csv, mock_listdir, capsys):
+    """Test that participant IDs come from the file names, and that files without one are skipped."""
+    mock_read_csv.side_effect = lambda file_path, **kwargs: pd.DataFrame(
+        {"session": [1.0, None], "RT": [float(os.path.basename(file_path)[4:6]), 2.0]}
+    )
+
+    combined_data = combine_trial_data("mock_trial_data", ["session", "RT"])
+
+    assert combined_data["participant_id"].tolist() == [3, 7]
+    assert combined_data["RT"].tolist() == [3.0, 7.0]
+    assert combined_data["session"].dtype == "int64"
+    assert mock_read_csv.call_count == 2
+    assert "trial_data_pilot.csv. Skipping." in capsys.readouterr().out
+    assert mock_read_csv.call_args.kwargs["usecols"] == ["session", "RT"]
+
+
 @patch("pandas.read_excel")
 @patch("pandas.read_csv")
 @patch("os.listdir", return_value=["sub-1_sess1_PPG.csv"])
@@ -77,3 +117,352 @@ def test_process_ppg_folder(mock_to_excel, mock_listdir, mock_read_csv):
     process_ppg_folder("mock_PPG_folder", "mock_output.xlsx")
 
     mock_to_excel.assert_called_once()
+
+
+def test_ppg_cache_rebuilds_on_change(tmp_path):
+    """Test that the binary PPG cache stores float32 samples and follows changes of the source CSV."""
+    csv_path = tmp_path / "sub-1_sess1_PPG.csv"
+    pd.DataFrame({"PPG": [0.1, 0.2, 0.3], "time": [10.0, 10.01, 10.02]}).to_csv(csv_path, index=False)
+
+    recording = load_ppg_recording(csv_path, tmp_path / "cache")
+    assert recording.signal.dtype == np.float32
+    assert recording.start_time == 10.0
+    assert recording.sample_rate == 100
+
+    pd.DataFrame({"PPG": [0.5, 0.6, 0.7, 0.8], "time": [20.0, 20.01, 20.02, 20.03]}).to_csv(csv_path, index=False)
+    recording = load_ppg_recording(csv_path, tmp_path / "cache")
+    assert len(recording) == 4
+    assert recording.start_time == 20.0
+
+
+def test_window_hrv_matches_per_window_metrics():
+    """Test the batched HRV metrics against a per-window computation, with a gap and a short window."""
+    series = []
+    for window, frequency in enumerate([0.1, 0.3]):
+        rr = 0.8 + 0.05 * np.sin(2 * np.pi * frequency * np.arange(60) * 0.8)
+        series.append((window, np.cumsum(np.r_[0, rr[:-1]]), rr))
+    # A rejected interval leaves a gap in a window too short for the spectral metrics
+    rr = np.array([0.9, 0.85, 0.95, 0.9, 0.8, 0.9, 0.85, 0.9])
+    series.append((2, np.delete(np.cumsum(np.r_[0, rr[:-1]]), 5), np.delete(rr, 5)))
+
+    window, times, rr = (np.concatenate(parts) for parts in zip(*[(np.full(len(t), w), t, r) for w, t, r in series]))
+    order = np.random.default_rng(0).permutation(len(rr))
+    hrv = window_hrv(times[order], rr[order], window[order], 4)
+
+    for w, t, r in series:
+        differences = np.diff(r * 1000)[np.abs(t[:-1] + r[:-1] - t[1:]) < 1e-3]
+        assert hrv.loc[w, "n_intervals"] == len(r)
+        assert np.isclose(hrv.loc[w, "SDNN"], np.std(r * 1000, ddof=1))
+        assert np.isclose(hrv.loc[w, "RMSSD"], np.sqrt(np.mean(differences**2)))
+        assert np.isclose(hrv.loc[w, "pNN50"], 100 * np.mean(np.abs(differences) > 50))
+    assert hrv.loc[0, "LF_HF"] > 10 and hrv.loc[1, "LF_HF"] < 0.1
+    assert np.isnan(hrv.loc[2, "LF"]) and hrv.loc[3].drop("n_intervals").isna().all()
+
+
+def test_file_index_and_typed_reads(tmp_path):
+    """Test that a folder is indexed by participant and session and read with the schema types."""
+    for file_name in ["sub-10_sess1_PPG.csv", "sub-2_sess2_PPG.csv", "sub-2_sess1_PPG.csv", "notes.csv"]:
+        pd.DataFrame({"PPG": [0.5, "bad"], "time": [0.0, 0.01], "extra": [1, 2]}).to_csv(
+            tmp_path / file_name, index=False
+        )
+    (tmp_path / "readme.txt").write_text("not a recording")
+
+    file_index = FileIndex.scan(tmp_path, "ppg")
+    assert file_index.files == ["sub-2_sess1_PPG.csv", "sub-2_sess2_PPG.csv", "sub-10_sess1_PPG.csv", "notes.csv"]
+    assert file_index.find(2, 2) == "sub-2_sess2_PPG.csv"
+    assert file_index.participant_id("notes.csv") is None
+
+    data = read_table(file_index.path("sub-10_sess1_PPG.csv"), "ppg", ["PPG"], optional_columns=["time"])
+    assert sorted(data.columns) == ["PPG", "time"]
+    assert data["PPG"].dtype == np.float32 and np.isnan(data["PPG"].iloc[1])
+    assert file_index.read_all(["PPG", "missing"]) == [None] * 4
+
+
+def test_ppg_recording_time_to_index(tmp_path):
+    """Test that a PPG recording read from CSV stores float32 samples and finds samples by arithmetic."""
+    csv_path = tmp_path / "sub-1_sess1_PPG.csv"
+    time = 5.0 + np.arange(1000) / 100
+    pd.DataFrame({"time": time, "PPG": np.arange(1000.0)}).to_csv(csv_path, index=False)
+
+    recording = load_ppg_recording(csv_path)
+    assert not hasattr(recording, "__dict__")
+    assert recording.signal.dtype == np.float32 and recording.signal.flags["C_CONTIGUOUS"]
+    assert (recording.start_time, recording.sample_rate) == (5.0, 100)
+
+    targets = np.array([0.0, 5.0, 5.004, 5.006, 7.345, 100.0])
+    expected = [np.abs(time - target).argmin() for target in targets]
+    assert recording.time_to_index(targets).tolist() == expected
+    assert np.allclose(recording.times(), time)
+
+
+@pytest.mark.parametrize("grouped", [False, True])
+@patch("pandas.read_excel")
+@patch("pandas.read_csv")
+@patch("os.listdir", return_value=["sub-1_sess1_PPG.csv"])
+@patch("pandas.DataFrame.to_excel", autospec=True)
+def test_match_ppg_data_grouped(mock_to_excel, mock_listdir, mock_read_csv, mock_read_excel, grouped):
+    """Test that matching reads each recording once and resolves every trial, with and without grouping."""
+    mock_read_excel.return_value = pd.DataFrame(
+        {
+            "session": [1, 1, 1],
+            "participant_id": [1, 1, 1],
+            "PPG_music_start": [85, 95, 104],
+            "PPG_response_start": [100, 111, 94],
+        }
+    )
+    mock_read_csv.return_value = pd.DataFrame({"time": [90, 100, 110], "PPG": [0.5, 0.6, 0.7]})
+
+    match_ppg_data("mock_combined.xlsx", "mock_PPG_folder", grouped=grouped)
+
+    mock_read_csv.assert_called_once()
+    saved_data = mock_to_excel.call_args.args[0]
+    assert saved_data["PPG_data"].tolist() == np.float32([0.6, 0.7, 0.5]).tolist()
+    if not grouped:
+        return
+    assert saved_data["PPG_music_start_index"].tolist() == [0, 0, 1]
+    assert saved_data["PPG_response_start_index"].tolist() == [1, 2, 0]
+
+
+@patch("pandas.DataFrame.to_excel", autospec=True)
+def test_process_ppg_folder_parallel(mock_to_excel, tmp_path):
+    """Test that parallel processing gives the same, participant/session-sorted output as the serial mode."""
+    time = np.arange(0, 30, 0.01)
+    for file_name in ["sub-2_sess1_PPG.csv", "sub-10_sess2_PPG.csv", "sub-1_sess2_PPG.csv"]:
+        pd.DataFrame({"PPG": np.sin(2 * np.pi * 1.2 * time), "time": time}).to_csv(tmp_path / file_name, index=False)
+
+    process_ppg_folder(str(tmp_path), "mock_output")
+    serial_results = mock_to_excel.call_args.args[0]
+    process_ppg_folder(str(tmp_path), "mock_output", n_workers=2)
+    parallel_results = mock_to_excel.call_args.args[0]
+
+    pd.testing.assert_frame_equal(serial_results, parallel_results)
+    recordings = serial_results.drop_duplicates(["participant_id", "session_id"])
+    assert recordings["participant_id"].tolist() == [1, 2, 10]
+
+
+def test_beat_sinks_append_and_read_partitions(tmp_path):
+    """Test that every streaming sink writes the same beat table and reads back single participants."""
+    time = np.arange(0, 30, 0.01)
+    ppg_folder = tmp_path / "PPG_data"
+    ppg_folder.mkdir()
+    for file_name in ["sub-2_sess1_PPG.csv", "sub-10_sess2_PPG.csv", "sub-1_sess2_PPG.csv"]:
+        pd.DataFrame({"PPG": np.sin(2 * np.pi * 1.2 * time), "time": time}).to_csv(ppg_folder / file_name, index=False)
+
+    sinks = {"csv": "R-peaks_and_HR.csv.gz", "sqlite": "R-peaks_and_HR.sqlite"}
+    if ARROW_AVAILABLE:
+        sinks.update({"parquet": "R-peaks_and_HR.parquet", "feather": "R-peaks_and_HR.feather"})
+    tables = []
+    for sink, output_name in sinks.items():
+        process_ppg_folder(str(ppg_folder), str(tmp_path), sink=sink)
+        tables.append(read_beat_table(tmp_path / output_name))
+        subset = read_beat_table(tmp_path / output_name, participant_ids=[10])
+        assert subset["participant_id"].unique().tolist() == [10]
+        pd.testing.assert_frame_equal(subset, tables[-1][tables[-1]["participant_id"] == 10].reset_index(drop=True))
+
+    assert tables[0]["participant_id"].drop_duplicates().tolist() == [1, 2, 10]
+    for table in tables[1:]:
+        pd.testing.assert_frame_equal(table, tables[0])
+
+    # A table too large for an Excel sheet fails instead of leaving the file of a previous run in place
+    (tmp_path / "R-peaks_and_HR.xlsx").write_text("previous run")
+    with patch("functions.clearing_data.beat_sinks.EXCEL_MAX_ROWS", len(tables[0]) - 1):
+        with pytest.raises(ValueError):
+            process_ppg_folder(str(ppg_folder), str(tmp_path), sink="excel")
+    assert not (tmp_path / "R-peaks_and_HR.xlsx").exists()
+
+
+def test_prefix_stats_match_window_slices():
+    """Test that the prefix-sum window features equal the statistics of the sliced signal, skipping NaN."""
+    rng = np.random.default_rng(4)
+    signal = (np.sin(np.arange(50_000) / 40) + rng.normal(0, 0.1, 50_000)).astype(np.float32)
+    signal[[120, 7000, 7001]] = np.nan
+    stats = PrefixStats(signal, 100)
+
+    starts = np.append(rng.integers(0, 45_000, 200), [100, 10])
+    ends = np.append(starts[:-2] + rng.integers(2, 5000, 200), [200, 10])
+    features = stats.windows(starts, ends)
+    for position in range(200):
+        window = signal[starts[position] : ends[position]].astype(np.float64)
+        times = np.arange(len(window))[~np.isnan(window)] / 100
+        window = window[~np.isnan(window)]
+        expected = [window.mean(), window.var(ddof=1), window.max() - window.min(), np.polyfit(times, window, 1)[0]]
+        np.testing.assert_allclose(features.iloc[position].to_numpy(), expected, rtol=1e-6)
+    assert np.isclose(features["mean"].iloc[200], np.nanmean(signal[100:200]))
+    assert features.iloc[201].isna().all()
+
+    # The ITI of a trial ends when the next music starts; the last one has no end
+    sample_indices = {
+        "PPG_music_start": np.array([3000, 100]),
+        "PPG_response_start": np.array([3500, 600]),
+        "PPG_ITI_start": np.array([3900, 1000]),
+    }
+    trial_features = trial_window_features(stats, sample_indices)
+    assert np.isclose(trial_features["PPG_ITI_mean"].iloc[1], np.nanmean(signal[1000:3000]))
+    assert np.isnan(trial_features["PPG_ITI_mean"].iloc[0])
+    assert np.isclose(trial_features["PPG_response_range"].iloc[0], np.ptp(signal[3500:3900]))
+
+
+def test_rpeaks_from_ppg_chunked_matches_in_memory():
+    """Test that block-wise peak detection finds the same peaks as filtering the whole signal at once."""
+    rng = np.random.default_rng(0)
+    time = np.arange(0, 600, 0.01)
+    ppg_signal = np.sin(2 * np.pi * 1.1 * time) + 0.3 * np.sin(2 * np.pi * 2.2 * time)
+    ppg_signal += 0.1 * rng.standard_normal(len(time))
+
+    expected = rpeaks_from_ppg(ppg_signal, 100)
+    global_peaks = rpeaks_from_ppg_chunked(ppg_signal, 100, block_seconds=60, global_threshold=True)
+    window_peaks = rpeaks_from_ppg_chunked(ppg_signal, 100, block_seconds=60)
+
+    np.testing.assert_array_equal(global_peaks, expected)
+    np.testing.assert_array_equal(window_peaks, expected)
+
+
+def test_analysis_dataset_roundtrip(tmp_path):
+    """Test that the dataset keeps the trial and beat tables when stored in and loaded from SQLite."""
+    trials = pd.DataFrame({"participant_id": [1, 2], "music_type": ["tonal", "atonal"], "IS": [0.1, np.nan]})
+    beats = pd.DataFrame({"participant_id": [1, 1], "session_id": [1, 1], "HR": [60.0, 62.5]})
+
+    AnalysisDataset(trials, beats).save(tmp_path / "dataset.sqlite")
+    dataset = AnalysisDataset.load(tmp_path / "dataset.sqlite")
+
+    pd.testing.assert_frame_equal(dataset.trials, trials)
+    pd.testing.assert_frame_equal(dataset.beats, beats)
+
+
+def test_compute_is_values_batch_matches_per_participant(tmp_path):
+    """Test that the batch IS computation gives the same IS values as fitting one file at a time, also for
+    sync ratios that a degenerate Gaussian fits as well as a proper one."""
+    delays = np.repeat([0, 100, 200, 300], 6)
+    profiles = [(1, [3, 4, 3, 1]), (2, [6, 5, 1, 2]), (3, [5, 2, 1, 1]), (4, [4, 3, 3, 3]), (5, [3, 3, 3, 3])]
+    for participant_id, sync_counts in profiles:
+        responses = np.concatenate([["Sync"] * count + ["Async"] * (6 - count) for count in sync_counts])
+        pd.DataFrame(
+            {"delay": delays, "response": responses, "confidence": 50, "resting_RRI": [0.55] + [None] * 23}
+        ).to_csv(tmp_path / f"sub-{participant_id}_HBD.csv", index=False)
+
+    expected = compute_is_values(str(tmp_path))
+    batch_values = compute_is_values_batch(str(tmp_path), n_workers=2)
+
+    assert set(batch_values) == {1, 2, 3, 4, 5}
+    assert np.isnan(batch_values[5])
+    assert [batch_values[i] for i in range(1, 5)] == [expected[i] for i in range(1, 5)]
+
+
+def test_beat_trial_interval_join():
+    """Test that every beat is assigned once, to the trial whose music window contains it."""
+    trials = pd.DataFrame(
+        {
+            "participant_id": [1, 1, 1, 2],
+            "session": [1, 1, 2, 1],
+            "music_type": ["atonal", "tonal", "discord", "tonal"],
+            "PPG_music_start": [20.0, 0.0, 0.0, 0.0],
+            "PPG_response_start": [30.0, 10.0, 10.0, 10.0],
+        }
+    )
+    beats = pd.DataFrame(
+        {
+            "participant_id": [1, 1, 1, 1, 1, 2],
+            "session_id": [1, 1, 1, 1, 2, 2],
+            "r_peak_time": [1.0, 9.0, 15.0, 20.0, 5.0, 5.0],
+            "HR": [60.0, 70.0, 80.0, 90.0, 100.0, 110.0],
+        }
+    )
+
+    np.testing.assert_array_equal(assign_beats_to_trials(beats, trials), [1, 1, -1, 0, 2, -1])
+
+    summary = summarize_trial_hr(beats, trials)
+    assert summary["n_beats"].tolist() == [1, 2, 1, 0]
+    assert summary["HR_mean"].tolist()[:3] == [90.0, 65.0, 100.0]
+    assert np.isnan(summary["HR_mean"].iloc[3])
+
+
+def test_aggregate_cube_matches_raw_statistics():
+    """Test that the ANOVA, summaries and correlation of the cube equal those of the raw tables."""
+    rng = np.random.default_rng(0)
+    trials = pd.DataFrame(
+        {
+            "participant_id": np.repeat([1, 2, 3, 4], 6),
+            "session": np.tile([1, 1, 1, 2, 2, 2], 4),
+            "music_type": ["tonal", "atonal", "discord"] * 8,
+            "RT": rng.random(24) + 1,
+            "valence_rating": rng.random(24),
+            "IS": np.repeat(rng.random(4), 6),
+            "PPG_music_start": np.tile([0.0, 20.0, 40.0], 8),
+            "PPG_response_start": np.tile([10.0, 30.0, 50.0], 8),
+        }
+    )
+    beats = pd.DataFrame(
+        {
+            "participant_id": np.repeat([1, 2, 3, 4], 120),
+            "session_id": np.tile(np.repeat([1, 2], 60), 4),
+            "r_peak_time": np.tile(np.arange(60) * 1.0, 8),
+            "HR": rng.normal(70, 5, 480),
+        }
+    )
+    cube = AggregateCube.from_tables(trials, beats)
+
+    f_stat, p_value = cube.anova("RT")
+    expected = f_oneway(*[group["RT"] for _, group in trials.groupby("music_type")])
+    assert np.isclose(f_stat, expected.statistic) and np.isclose(p_value, expected.pvalue)
+    stats = cube.group_stats("RT")
+    assert np.allclose(stats["std"], trials.groupby("music_type")["RT"].std())
+    assert cube.group_stats("HR")["n"].sum() == 4 * 2 * 3 * 10
+
+    participant_means = trials.groupby("participant_id")[["valence_rating", "IS"]].mean()
+    correlation, _, n_participants = cube.correlation("valence_rating", "IS")
+    assert np.isclose(correlation, participant_means.corr().iloc[0, 1]) and n_participants == 4
+
+    # Updating a participant gives the same cells as a full rebuild
+    trials.loc[trials["participant_id"] == 2, "RT"] += 1
+    updated = cube.update(trials, beats, [2])
+    pd.testing.assert_frame_equal(updated.cells, AggregateCube.from_tables(trials, beats).cells)
+
+
+def test_streaming_beat_detector_matches_offline():
+    """Test that pushing a PPG stream in blocks of any size finds the offline beats with low latency."""
+    rng = np.random.default_rng(0)
+    time = np.arange(0, 120, 0.01)
+    # Slowly varying heart rate around 72 bpm
+    phase = 2 * np.pi * np.cumsum(1.2 + 0.1 * np.sin(2 * np.pi * time / 30)) * 0.01
+    ppg_signal = np.sin(phase) + 0.3 * np.sin(2 * phase) + 0.05 * rng.standard_normal(len(time))
+    offline_peaks = rpeaks_from_ppg(ppg_signal, 100)
+
+    detector = StreamingBeatDetector(100)
+    block_ends = np.sort(rng.choice(np.arange(1, len(time)), 300, replace=False))
+    blocks = [detector.push(block) for block in np.split(ppg_signal, block_ends)]
+    online = {key: np.concatenate([beats[key] for beats in blocks]) for key in blocks[0]}
+
+    single_push = StreamingBeatDetector(100).push(ppg_signal)
+    assert np.array_equal(online["r_peak_index"], single_push["r_peak_index"])
+
+    # Apart from the filter settling at the start, every offline beat is found within 50 ms
+    offline_peaks = offline_peaks[offline_peaks > 300]
+    nearest = np.abs(online["r_peak_index"][:, None] - offline_peaks[None, :]).min(axis=0)
+    assert (nearest <= 5).all()
+    assert online["latency"].max() < 0.3
+    assert np.allclose(online["HR"][online["valid"]], 60 / online["RR"][online["valid"]])
+
+
+def test_peak_sweep_matches_single_runs(tmp_path):
+    """Test that every parameter set of a sweep gives the HR of a separate run with its settings."""
+    rng = np.random.default_rng(0)
+    time = np.arange(0, 120, 0.01)
+    for file_name, frequency in [("sub-1_sess1_PPG.csv", 1.1), ("sub-2_sess2_PPG.csv", 1.4)]:
+        ppg_signal = np.sin(2 * np.pi * frequency * time) + 0.3 * np.sin(4 * np.pi * frequency * time)
+        ppg_signal += 0.3 * rng.standard_normal(len(time))
+        pd.DataFrame({"PPG": ppg_signal, "time": time}).to_csv(tmp_path / file_name, index=False)
+
+    grid = parameter_grid([(0.5, 5), (0.7, 3)], [0.05, 0.15, 0.4], [0.3, 0.6], [(0.3, 1.5), (0.5, 1.2)])
+    results = sweep_folder(str(tmp_path), grid)
+    assert len(results) == 2 * len(grid)
+
+    for row in results.itertuples():
+        recording = load_ppg_recording(str(tmp_path / f"sub-{row.participant_id}_sess{row.session_id}_PPG.csv"))
+        band = (row.band_low, row.band_high)
+        r_peaks = rpeaks_from_ppg(recording.signal, 100, band, row.prominence_factor, row.min_distance)
+        _, hr_values, valid = calculate_hr(r_peaks, 100, (row.rr_min, row.rr_max), (row.hr_min, row.hr_max))
+        assert row.n_peaks == len(r_peaks) and row.n_beats == valid.sum()
+        assert np.isclose(row.mean_hr, hr_values[valid].mean())
+
+    summary = summarize_sweep(results)
+    assert summary["n_beats"].tolist() == results.groupby("parameter_set")["n_beats"].sum().tolist()
@@ -1,10 +1,22 @@
+import json
+import threading
+import urllib.error
+import urllib.request
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
+import pytest
+from scipy.stats import f_oneway, pearsonr
+
+from functions.clearing_data.dataset import AnalysisDataset
 
 # Importing functions from data_analysis module
+from functions.data_analysis.batch_report import FIGURE_INPUTS, render_report
 from functions.data_analysis.is_to_music_type import analyze_music_type_vs_IS
 from functions.data_analysis.music_type_to_rt import analyze_rt_by_music_type
+from functions.data_analysis.query_server import make_server
+from functions.data_analysis.resampling import bootstrap_group_means, permutation_anova, resample_pearson
 
 
 @patch("pandas.read_excel")
@@ -47,3 +59,133 @@ def test_analyze_rt_by_music_type(mock_read_excel):
     result = analyze_rt_by_music_type("mock_combined.xlsx")
 
     assert "significant effect" in result or "does not have a significant effect" in result
+
+
+def test_render_report_skips_unchanged_figures(tmp_path, capsys):
+    """Test that the batch report writes every figure with its statistics and only redraws changed figures."""
+    rng = np.random.default_rng(0)
+    trials = pd.DataFrame(
+        {
+            "participant_id": np.repeat([1, 2, 3, 4], 6),
+            "session": 1,
+            "music_type": ["tonal", "atonal", "discord"] * 8,
+            "valence_rating": rng.random(24),
+            "RT": rng.random(24) + 1,
+            "PPG_music_start": np.tile(np.arange(6) * 20.0, 4),
+            "PPG_response_start": np.tile(np.arange(6) * 20.0 + 10, 4),
+            "IS": np.repeat(rng.random(4), 6),
+        }
+    )
+    beats = pd.DataFrame(
+        {
+            "participant_id": np.repeat([1, 2, 3, 4], 120),
+            "session_id": 1,
+            "r_peak_time": np.tile(np.arange(120) * 1.0, 4),
+            "HR": rng.normal(70, 5, 480),
+        }
+    )
+    dataset = AnalysisDataset(trials, beats)
+
+    stats = render_report(dataset, dataset, tmp_path, formats=["png", "svg"])
+    assert list(stats) == list(FIGURE_INPUTS)
+    assert 0 <= stats["rt_by_music_type"]["p_value"] <= 1
+    assert sum(stats["hr_by_music_type"]["n_beats"].values()) == 4 * 6 * 10
+    assert all((tmp_path / f"{name}.{fmt}").exists() for name in FIGURE_INPUTS for fmt in ["png", "svg"])
+    assert (tmp_path / "report.html").exists()
+
+    trials.loc[0, "RT"] += 1
+    capsys.readouterr()
+    assert render_report(dataset, dataset, tmp_path, formats=["png", "svg"])["valence_vs_is"] == stats["valence_vs_is"]
+    assert "1 figures rendered, 4 unchanged" in capsys.readouterr().out
+
+    # A dataset stored before the ppg stage ran still gets every figure except the HR one
+    no_beats = AnalysisDataset(trials)
+    assert list(render_report(no_beats, no_beats, tmp_path / "no_beats")) == [
+        name for name in FIGURE_INPUTS if name != "hr_by_music_type"
+    ]
+
+
+def test_permutation_anova_matches_f_oneway_and_respects_units():
+    """Test that the resampled ANOVA reproduces the parametric F and that whole units keep their label."""
+    rng = np.random.default_rng(1)
+    n_trials = 60
+    participants = np.repeat(np.arange(10), 6)
+    music_types = np.tile(["tonal", "atonal", "discord"], 20)
+    # Trial effects are shared by all beats of a trial, which the beat-level ANOVA treats as independent
+    trial_effects = rng.normal(0, 5, n_trials)
+    trial_of_beat = np.repeat(np.arange(n_trials), 30)
+    hr = 70 + trial_effects[trial_of_beat] + rng.normal(0, 1, len(trial_of_beat))
+    groups = music_types[trial_of_beat]
+
+    f_stat, parametric_p = f_oneway(*[hr[groups == name] for name in ["atonal", "discord", "tonal"]])
+    result = permutation_anova(
+        hr, groups, units=trial_of_beat, clusters=participants[trial_of_beat], n_resamples=2000, seed=3
+    )
+    assert np.isclose(result["f_statistic"], f_stat)
+    assert 1 / 2001 <= result["p_value"] <= 1
+    assert result == permutation_anova(
+        hr, groups, units=trial_of_beat, clusters=participants[trial_of_beat], n_resamples=2000, seed=3
+    )
+
+    intervals = bootstrap_group_means(hr, groups, clusters=participants[trial_of_beat], n_resamples=2000)
+    for name, interval in intervals.items():
+        assert np.isclose(interval["mean"], hr[groups == name].mean())
+        assert interval["ci_low"] < interval["mean"] < interval["ci_high"]
+
+
+def test_resample_pearson():
+    """Test the permutation p-value and bootstrap interval of a strong and a null correlation."""
+    rng = np.random.default_rng(2)
+    x = rng.normal(size=40)
+    y = x + rng.normal(0, 0.5, 40)
+
+    strong = resample_pearson(x, y, n_resamples=5000)
+    assert strong["permutation_p_value"] < 0.001
+    assert strong["correlation_ci"][0] < pearsonr(x, y)[0] < strong["correlation_ci"][1]
+
+    null = resample_pearson(x, rng.normal(size=40), n_resamples=5000)
+    assert null["permutation_p_value"] > 0.01
+
+
+def test_query_server_answers_filtered_analyses():
+    """Test that the query server answers filtered ANOVAs and correlations like the raw data and caches them."""
+    rng = np.random.default_rng(3)
+    trials = pd.DataFrame(
+        {
+            "participant_id": np.repeat(np.arange(1, 9), 6),
+            "session": np.tile([1, 1, 1, 2, 2, 2], 8),
+            "music_type": ["tonal", "atonal", "discord"] * 16,
+            "valence_rating": rng.random(48),
+            "RT": rng.random(48) + 1,
+            "IS": np.repeat(rng.random(8), 6),
+        }
+    )
+    server = make_server(AnalysisDataset(trials), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def get(query):
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}{query}") as response:
+            return json.loads(response.read())
+
+    try:
+        selected = trials[(trials["session"] == 1) & ~trials["participant_id"].isin([2, 5])]
+        answer = get("/anova?measure=RT&session=1&exclude=2,5")
+        f_stat, p_value = f_oneway(*[group["RT"] for _, group in selected.groupby("music_type")])
+        assert np.isclose(answer["f_statistic"], f_stat) and np.isclose(answer["p_value"], p_value)
+        assert answer["groups"]["tonal"]["n"] == (selected["music_type"] == "tonal").sum()
+
+        means = trials[trials["participant_id"] != 3].groupby("participant_id")[["valence_rating", "IS"]].mean()
+        answer = get("/correlation?x=valence_rating&y=IS&exclude=3")
+        assert np.isclose(answer["correlation"], pearsonr(means["valence_rating"], means["IS"])[0])
+        assert answer["n"] == 7
+
+        # The same query with its parameters in another order is answered from the cache
+        assert get("/anova?exclude=5,2&session=1&measure=RT") == get("/anova?measure=RT&session=1&exclude=2,5")
+        assert get("/")["cache"]["hits"] == 2
+        with pytest.raises(urllib.error.HTTPError) as error:
+            get("/anova?measure=HR")
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
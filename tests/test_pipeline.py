@@ -0,0 +1,192 @@
+import json
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from functions.clearing_data.aggregate_cube import AggregateCube
+from functions.clearing_data.dataset import DATASET_FILE_NAME, AnalysisDataset
+from functions.pipeline.instrumentation import record, run_report, stage
+from functions.pipeline.runner import run_pipeline
+from functions.pipeline.shards import merge_shards, run_shard
+
+
+def _write_cohort(data_path):
+    """Writes a small cohort of trial, PPG and HBD files in the layout of the data folder."""
+    rng = np.random.default_rng(0)
+    for folder in ["trial_data", "PPG_data", "HBD_data"]:
+        (data_path / folder).mkdir()
+
+    time = np.arange(0, 60, 0.01)
+    for participant_id in [1, 2]:
+        pd.DataFrame(
+            {
+                "session": [1, 1, 2],
+                "music_type": ["tonal", "atonal", "discord"],
+                "valence_rating": rng.random(3),
+                "RT": rng.random(3) + 1,
+                "PPG_music_start": [5.0, 20.0, 5.0],
+                "PPG_response_start": [15.0, 30.0, 15.0],
+            }
+        ).to_csv(data_path / "trial_data" / f"sub-0{participant_id}_trial_data.csv", index=False)
+
+        for session in [1, 2]:
+            ppg_signal = np.sin(2 * np.pi * 1.2 * time) + 0.05 * rng.standard_normal(len(time))
+            pd.DataFrame({"PPG": ppg_signal, "time": time}).to_csv(
+                data_path / "PPG_data" / f"sub-0{participant_id}_sess{session}_PPG.csv", index=False
+            )
+
+        delays = np.repeat([0, 100, 200, 300, 400, 500], 4)
+        pd.DataFrame(
+            {
+                "delay": delays,
+                "response": rng.choice(["Sync", "Async"], len(delays)),
+                "confidence": 50,
+                "resting_RRI": [0.8] + [None] * (len(delays) - 1),
+            }
+        ).to_csv(data_path / "HBD_data" / f"sub-0{participant_id}_HBD.csv", index=False)
+
+
+def test_run_pipeline_is_incremental(tmp_path):
+    """Test that a second run reuses every stage and a changed HBD file only refits that participant."""
+    _write_cohort(tmp_path)
+    paths = [str(tmp_path / folder) for folder in ["trial_data", "PPG_data", "HBD_data"]] + [str(tmp_path)]
+    selected_columns = ["session", "music_type", "valence_rating", "RT", "PPG_music_start", "PPG_response_start"]
+
+    _, first_run = run_pipeline(*paths, selected_columns)
+    assert len(first_run["ingest"]) == 2
+    assert first_run["match"] == [1, 2]
+    assert len(first_run["ppg"]) == 4
+    assert len(first_run["is"]) == 2
+    assert len(first_run["hrv"]) == 4
+
+    _, second_run = run_pipeline(*paths, selected_columns)
+    assert second_run == {"ingest": [], "match": [], "ppg": [], "is": [], "hrv": []}
+
+    hbd_data = pd.read_csv(tmp_path / "HBD_data" / "sub-02_HBD.csv")
+    hbd_data["response"] = "Async"
+    hbd_data.loc[:3, "response"] = "Sync"
+    hbd_data.to_csv(tmp_path / "HBD_data" / "sub-02_HBD.csv", index=False)
+
+    dataset, third_run = run_pipeline(*paths, selected_columns)
+    assert third_run == {"ingest": [], "match": [], "ppg": [], "is": ["sub-02_HBD.csv"], "hrv": []}
+    assert "IS" in dataset.trials.columns
+    assert dataset.trials["RMSSD"].notna().all()
+    assert len(dataset.beats) > 0
+
+    # The cube was only updated for participant 2 and matches a full rebuild
+    pd.testing.assert_frame_equal(dataset.cube.cells, AggregateCube.from_tables(dataset.trials, dataset.beats).cells)
+
+
+def test_run_pipeline_reingests_changed_trial_file(tmp_path):
+    """Test that a changed trial data file only re-ingests and re-matches the trials of that participant."""
+    _write_cohort(tmp_path)
+    paths = [str(tmp_path / folder) for folder in ["trial_data", "PPG_data", "HBD_data"]]
+    selected_columns = ["session", "music_type", "valence_rating", "RT", "PPG_music_start", "PPG_response_start"]
+    run_pipeline(*paths, str(tmp_path), selected_columns)
+
+    trial_data = pd.read_csv(tmp_path / "trial_data" / "sub-02_trial_data.csv")
+    trial_data["RT"] += 1
+    trial_data.to_csv(tmp_path / "trial_data" / "sub-02_trial_data.csv", index=False)
+
+    with run_report(tmp_path / "run_report.json"):
+        dataset, summary = run_pipeline(*paths, str(tmp_path), selected_columns)
+    assert summary == {"ingest": ["sub-02_trial_data.csv"], "match": [2], "ppg": [], "is": [], "hrv": []}
+
+    report = json.loads((tmp_path / "run_report.json").read_text())
+    stages = {stage["name"]: stage for stage in report["stages"]}
+    assert stages["run_pipeline/combine_trial_data"]["files"] == 1
+    assert stages["run_pipeline/add_ppg_data"]["files"] == 2
+
+    # The stored dataset equals the one of a fresh run over the changed data
+    run_pipeline(*paths, str(tmp_path / "fresh"), selected_columns)
+    stored = AnalysisDataset.load(tmp_path / DATASET_FILE_NAME)
+    fresh = AnalysisDataset.load(tmp_path / "fresh" / DATASET_FILE_NAME)
+    pd.testing.assert_frame_equal(stored.trials, fresh.trials)
+    pd.testing.assert_frame_equal(stored.cube.cells, fresh.cube.cells)
+    assert dataset.trials.loc[dataset.trials["participant_id"] == 2, "RT"].tolist() == trial_data["RT"].tolist()
+
+
+def test_run_report_records_stages(tmp_path):
+    """Test that a run under a report records every stage with its file counts and profiles the chosen stage."""
+    _write_cohort(tmp_path)
+    paths = [str(tmp_path / folder) for folder in ["trial_data", "PPG_data", "HBD_data"]] + [str(tmp_path)]
+    selected_columns = ["session", "music_type", "valence_rating", "RT", "PPG_music_start", "PPG_response_start"]
+
+    with run_report(tmp_path / "run_report.json", profile_stage="extract_beats", profile_dir=tmp_path):
+        run_pipeline(*paths, selected_columns)
+
+    report = json.loads((tmp_path / "run_report.json").read_text())
+    stages = {stage["name"]: stage for stage in report["stages"]}
+    assert stages["run_pipeline"]["calls"] == 1
+    assert stages["run_pipeline/combine_trial_data"]["files"] == 2
+    assert stages["run_pipeline/combine_trial_data"]["rows"] == 6
+    assert stages["run_pipeline/extract_beats"]["files"] == 4
+    assert stages["run_pipeline/extract_beats"]["failed"] == 0
+    assert stages["run_pipeline/extract_beats/detect_peaks"]["calls"] == 4
+    assert stages["run_pipeline/participant_is/curve_fit"]["calls"] == 2
+    assert all(stage["wall_s"] >= 0 for stage in report["stages"])
+    assert (tmp_path / "extract_beats.prof").exists()
+
+
+def test_run_report_records_stages_of_threads():
+    """Test that stages run on a thread pool are nested in the calling stage and none of their counts is lost."""
+
+    def read(_):
+        with stage("read"):
+            time.sleep(0.001)
+            record(files=1)
+
+    with run_report() as report:
+        with stage("read_all"):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(read, range(200)))
+
+    assert list(report.records) == ["read_all", "read_all/read"]
+    assert report.records["read_all/read"].calls == 200
+    assert report.records["read_all/read"].files == 200
+    assert report.records["read_all"].files == 0
+
+
+def test_cli_ingest_does_not_import_heavy_libraries(tmp_path):
+    """Test that the ingest subcommand runs without importing the plotting, statistics or scipy libraries."""
+    _write_cohort(tmp_path)
+    script = (
+        "import sys, main; "
+        f"main.main(['ingest', '--data-dir', {str(tmp_path)!r}, '--workers', '1']); "
+        "print(sorted(m for m in ('matplotlib', 'seaborn', 'statsmodels', 'scipy') if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], cwd=Path(__file__).parent.parent, capture_output=True, text=True, check=True
+    ).stdout
+
+    assert "Trial data cleaned and combined." in output
+    assert output.strip().splitlines()[-1] == "[]"
+    assert (tmp_path / "analysis_dataset.sqlite").exists()
+
+
+def test_merged_shards_equal_single_run(tmp_path):
+    """Test that shards of single participants merge into the dataset of a run over all participants."""
+    _write_cohort(tmp_path)
+    paths = [str(tmp_path / folder) for folder in ["trial_data", "PPG_data", "HBD_data"]]
+    selected_columns = ["session", "music_type", "valence_rating", "RT", "PPG_music_start", "PPG_response_start"]
+
+    full_run, _ = run_pipeline(*paths, str(tmp_path), selected_columns)
+    for participant_id in [2, 1]:
+        shard_path = str(tmp_path / f"shard-{participant_id}")
+        run_shard(*paths, shard_path, selected_columns, range(participant_id, participant_id + 1))
+    merged = merge_shards([str(tmp_path / "shard-2"), str(tmp_path / "shard-1")], str(tmp_path / "merged"))
+
+    stored = AnalysisDataset.load(tmp_path / DATASET_FILE_NAME)
+    pd.testing.assert_frame_equal(merged.trials, stored.trials)
+    pd.testing.assert_frame_equal(merged.beats, stored.beats)
+    pd.testing.assert_frame_equal(merged.cube.cells, stored.cube.cells)
+    assert merged.cube.anova("HR") == full_run.cube.anova("HR")
+
+    with pytest.raises(ValueError):
+        merge_shards([str(tmp_path / "shard-1"), str(tmp_path / "shard-1")], str(tmp_path / "merged"))